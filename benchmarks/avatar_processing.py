@@ -0,0 +1,86 @@
+"""Compares the CPU time and peak memory of processing jpeg avatar uploads
+with decoder level downscaling (`process_image`) against decoding the
+full image before shrinking it, over synthetic photos with every exif
+orientation. Both variants encode the same renditions.
+
+Each variant runs in a fresh process so the peak RSS of one doesn't
+hide the other's.
+
+usage: env/bin/python -m benchmarks.avatar_processing [width] [height] [rounds]
+"""
+
+import io
+import multiprocessing
+import piexif
+import resource
+import sys
+import time
+
+from PIL import Image
+from PIL.JpegImagePlugin import JpegImageFile
+
+from toshiid.handlers import process_image
+
+def full_decode_process_image(data, mime_type):
+    """`process_image` with the jpeg decoder's downscaling disabled, so
+    both variants produce the same renditions and only differ in how the
+    upload is decoded"""
+
+    draft = JpegImageFile.draft
+    JpegImageFile.draft = lambda self, mode, size: None
+    try:
+        return process_image(data, mime_type)
+    finally:
+        JpegImageFile.draft = draft
+
+VARIANTS = {
+    'full decode': full_decode_process_image,
+    'draft': process_image
+}
+
+def make_corpus(width, height):
+    """Returns a photo sized jpeg for every exif orientation"""
+
+    img = Image.merge('RGB', [
+        Image.effect_mandelbrot((width, height), (-2, -1.5, 1, 1.5), 100),
+        Image.effect_noise((width, height), 32),
+        Image.effect_mandelbrot((width, height), (-1, -1, 0.5, 1), 50)])
+    corpus = []
+    for orientation in range(1, 9):
+        stream = io.BytesIO()
+        img.save(stream, format="JPEG", quality=90,
+                 exif=piexif.dump({"0th": {piexif.ImageIFD.Orientation: orientation}}))
+        corpus.append((orientation, stream.getvalue()))
+    return corpus
+
+def run(name, corpus, rounds, results):
+    fn = VARIANTS[name]
+    times = {}
+    for orientation, data in corpus:
+        start = time.process_time()
+        for i in range(rounds):
+            fn(data, 'image/jpeg')
+        times[orientation] = (time.process_time() - start) / rounds
+    # kilobytes on linux
+    results.put((name, times, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def main(width, height, rounds):
+    corpus = make_corpus(width, height)
+    print("{}x{} jpegs, {:.1f} MB on average, {} rounds".format(
+        width, height, sum(len(data) for _, data in corpus) / len(corpus) / 1024 / 1024, rounds))
+
+    results = multiprocessing.Queue()
+    for name in VARIANTS:
+        process = multiprocessing.Process(target=run, args=(name, corpus, rounds, results))
+        process.start()
+        name, times, maxrss = results.get()
+        process.join()
+        print("{:<12} {}  peak rss {:.0f} MB".format(
+            name, " ".join("{}:{:6.1f}ms".format(orientation, times[orientation] * 1000) for orientation in sorted(times)),
+            maxrss / 1024))
+
+if __name__ == '__main__':
+    width = int(sys.argv[1]) if len(sys.argv) > 1 else 4032
+    height = int(sys.argv[2]) if len(sys.argv) > 2 else 3024
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    main(width, height, rounds)
@@ -0,0 +1,75 @@
+"""Measures the throughput of reputation updates with the search vector
+rebuilt on every update against only rebuilding it when the name or
+username change.
+
+The updates are run against a temporary copy of the users table, using
+the database's `users_search_trigger` function, so this can be run
+against any database with the schema applied.
+
+usage: DATABASE_URL=postgres://... env/bin/python -m benchmarks.reputation_updates [users] [updates]
+"""
+
+import asyncio
+import asyncpg
+import os
+import random
+import sys
+import time
+
+SETUP = """
+CREATE TEMPORARY TABLE bench_users (
+    toshi_id VARCHAR PRIMARY KEY,
+    username VARCHAR,
+    name VARCHAR,
+    tsv TSVECTOR,
+    reputation_score DECIMAL,
+    review_count INTEGER DEFAULT 0,
+    average_rating DECIMAL DEFAULT 0
+);
+CREATE INDEX ON bench_users USING gin(tsv);
+CREATE TRIGGER bench_tsvectorinsert BEFORE INSERT
+ON bench_users FOR EACH ROW EXECUTE PROCEDURE users_search_trigger();
+"""
+
+TRIGGERS = {
+    'always': """
+        CREATE TRIGGER bench_tsvectorupdate BEFORE UPDATE
+        ON bench_users FOR EACH ROW EXECUTE PROCEDURE users_search_trigger();
+    """,
+    'conditional': """
+        CREATE TRIGGER bench_tsvectorupdate BEFORE UPDATE OF name, username
+        ON bench_users FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.username IS DISTINCT FROM NEW.username)
+        EXECUTE PROCEDURE users_search_trigger();
+    """
+}
+
+async def run(con, users, updates):
+    start = time.perf_counter()
+    for i in range(updates):
+        toshi_id = random.choice(users)
+        await con.execute("UPDATE bench_users SET reputation_score = $1, review_count = $2, average_rating = $3 WHERE toshi_id = $4",
+                          random.randint(0, 50) / 10, i, random.randint(0, 50) / 10, toshi_id)
+    return updates / (time.perf_counter() - start)
+
+async def main(user_count, update_count):
+    con = await asyncpg.connect(os.environ['DATABASE_URL'])
+    try:
+        await con.execute(SETUP)
+        users = ['0x{:040x}'.format(i) for i in range(user_count)]
+        await con.executemany("INSERT INTO bench_users (toshi_id, username, name) VALUES ($1, $2, $3)",
+                              [(toshi_id, 'user{}'.format(i), 'Some User Name {}'.format(i))
+                               for i, toshi_id in enumerate(users)])
+        for name, trigger in TRIGGERS.items():
+            await con.execute("DROP TRIGGER IF EXISTS bench_tsvectorupdate ON bench_users")
+            await con.execute(trigger)
+            # warm up
+            await run(con, users, min(update_count, 1000))
+            rate = await run(con, users, update_count)
+            print("{:<12} {:10.1f} updates/s".format(name, rate))
+    finally:
+        await con.close()
+
+if __name__ == '__main__':
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    update_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    asyncio.get_event_loop().run_until_complete(main(user_count, update_count))
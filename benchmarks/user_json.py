@@ -0,0 +1,56 @@
+"""Compares rendering search results with `user_row_for_json` and
+`json_encode` against the `UserJSONSerializer`.
+
+usage: env/bin/python -m benchmarks.user_json
+"""
+
+import timeit
+
+from decimal import Decimal
+from tornado.escape import json_encode
+
+from toshiid.handlers import user_row_for_json, UserJSONSerializer
+
+class MockRequest:
+    protocol = 'https'
+    host = 'identity.service.toshi.org'
+
+def make_row(i):
+    is_app = i % 3 == 0
+    return {
+        'toshi_id': '0x{:040x}'.format(i),
+        'username': 'user{}'.format(i),
+        'payment_address': '0x{:040x}'.format(i + 1000000),
+        'avatar': '/avatar/0x{:040x}.png'.format(i) if i % 2 else None,
+        'name': 'User Number {}'.format(i),
+        'about': 'About user {}'.format(i) if i % 2 else None,
+        'location': None,
+        'is_app': is_app,
+        'is_public': True,
+        'reputation_score': Decimal('4.25'),
+        'average_rating': Decimal('3.5'),
+        'review_count': i,
+        'featured': False,
+        'category_ids': [1, 2] if is_app else [],
+        'category_tags': ['games', 'social'] if is_app else [],
+        'category_names': ['Games', 'Social'] if is_app else []
+    }
+
+def main():
+    request = MockRequest()
+    for count in [10, 100]:
+        rows = [make_row(i) for i in range(count)]
+
+        def current():
+            return json_encode({'results': [user_row_for_json(request, row) for row in rows]})
+
+        def serializer():
+            return '{{"results":{}}}'.format(UserJSONSerializer(request).serialize_many(rows))
+
+        number = 10000 // count
+        for name, fn in [('user_row_for_json', current), ('UserJSONSerializer', serializer)]:
+            best = min(timeit.repeat(fn, number=number, repeat=5)) / number
+            print("{:>4} rows {:<20} {:8.1f}us per response".format(count, name, best * 1000000))
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,14 @@ CREATE TABLE IF NOT EXISTS users (
     -- showing up on the app store page
     blocked BOOLEAN DEFAULT FALSE,
     -- migration flag, whether or not the migrated user has logged in at all
-    active BOOLEAN DEFAULT TRUE
+    active BOOLEAN DEFAULT TRUE,
+    -- incremented on every change to the user's profile
+    version BIGINT DEFAULT 0,
+    -- denormalized copies of the user's app categories, maintained
+    -- by the triggers on the category tables
+    category_ids INTEGER[] DEFAULT '{}',
+    category_tags VARCHAR[] DEFAULT '{}',
+    category_names VARCHAR[] DEFAULT '{}'
 );
 
 CREATE TABLE IF NOT EXISTS dapps (
@@ -36,11 +43,18 @@ CREATE TABLE IF NOT EXISTS dapps (
 
 CREATE UNIQUE INDEX IF NOT EXISTS idx_users_lower_username ON users (lower(username));
 CREATE INDEX IF NOT EXISTS idx_users_apps ON users (is_app);
+CREATE INDEX IF NOT EXISTS idx_users_payment_address ON users (payment_address);
+CREATE INDEX IF NOT EXISTS idx_users_lower_payment_address ON users (lower(payment_address));
 
 CREATE INDEX IF NOT EXISTS idx_users_tsv ON users USING gin(tsv);
 
+-- sequence used to allocate autogenerated usernames
+CREATE SEQUENCE IF NOT EXISTS users_autoid_seq;
+
 CREATE INDEX IF NOT EXISTS idx_users_went_public ON users (went_public DESC NULLS LAST);
 
+CREATE INDEX IF NOT EXISTS idx_users_category_ids ON users USING gin(category_ids);
+
 CREATE FUNCTION users_search_trigger() RETURNS TRIGGER AS $$
 BEGIN
     NEW.tsv :=
@@ -50,9 +64,25 @@ BEGIN
 END
 $$ LANGUAGE plpgsql;
 
-CREATE TRIGGER tsvectorupdate BEFORE INSERT OR UPDATE
+CREATE TRIGGER tsvectorinsert BEFORE INSERT
 ON users FOR EACH ROW EXECUTE PROCEDURE users_search_trigger();
 
+-- only rebuild the search vector when the indexed columns change
+CREATE TRIGGER tsvectorupdate BEFORE UPDATE OF name, username
+ON users FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.username IS DISTINCT FROM NEW.username)
+EXECUTE PROCEDURE users_search_trigger();
+
+CREATE FUNCTION users_version_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.version := COALESCE(OLD.version, 0) + 1;
+    NEW.updated := (now() AT TIME ZONE 'utc');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_version_update BEFORE UPDATE
+ON users FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE users_version_trigger();
+
 CREATE TABLE IF NOT EXISTS avatars (
     toshi_id VARCHAR,
     img BYTEA,
@@ -96,6 +126,94 @@ CREATE TABLE IF NOT EXISTS app_categories (
     PRIMARY KEY (category_id, toshi_id)
 );
 
+CREATE FUNCTION refresh_users_categories(user_toshi_ids VARCHAR[]) RETURNS VOID AS $$
+BEGIN
+    UPDATE users SET category_ids = c.category_ids, category_tags = c.category_tags, category_names = c.category_names
+    FROM (
+        SELECT t.toshi_id,
+               COALESCE(array_agg(categories.category_id ORDER BY categories.category_id)
+                        FILTER (WHERE categories.category_id IS NOT NULL), '{}') AS category_ids,
+               COALESCE(array_agg(categories.tag ORDER BY categories.category_id)
+                        FILTER (WHERE categories.category_id IS NOT NULL), '{}') AS category_tags,
+               COALESCE(array_agg(category_names.name ORDER BY categories.category_id)
+                        FILTER (WHERE categories.category_id IS NOT NULL), '{}') AS category_names
+        FROM (SELECT DISTINCT toshi_id FROM UNNEST(user_toshi_ids) AS toshi_id) AS t
+        LEFT JOIN app_categories ON app_categories.toshi_id = t.toshi_id
+        LEFT JOIN categories ON app_categories.category_id = categories.category_id
+        LEFT JOIN category_names ON categories.category_id = category_names.category_id
+        AND category_names.language = 'en'
+        GROUP BY t.toshi_id) AS c
+    WHERE users.toshi_id = c.toshi_id
+    -- a statement can both delete and insert a user's categories
+    AND (users.category_ids, users.category_tags, users.category_names)
+        IS DISTINCT FROM (c.category_ids, c.category_tags, c.category_names);
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION app_categories_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM refresh_users_categories(ARRAY(SELECT toshi_id FROM old_rows));
+    ELSE
+        PERFORM refresh_users_categories(ARRAY(SELECT toshi_id FROM new_rows));
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER app_categories_insert AFTER INSERT ON app_categories
+REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE app_categories_trigger();
+
+CREATE TRIGGER app_categories_delete AFTER DELETE ON app_categories
+REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE app_categories_trigger();
+
+-- refreshes all the apps in categories whose tag changed
+CREATE FUNCTION categories_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM refresh_users_categories(ARRAY(
+        SELECT app_categories.toshi_id FROM app_categories
+        JOIN new_rows ON new_rows.category_id = app_categories.category_id
+        JOIN old_rows ON old_rows.category_id = new_rows.category_id
+        WHERE new_rows.tag IS DISTINCT FROM old_rows.tag));
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER categories_update AFTER UPDATE ON categories
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE categories_trigger();
+
+-- refreshes all the apps in categories whose english name changed
+CREATE FUNCTION category_names_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM refresh_users_categories(ARRAY(
+            SELECT toshi_id FROM app_categories WHERE category_id IN (
+                SELECT category_id FROM new_rows WHERE language = 'en')));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM refresh_users_categories(ARRAY(
+            SELECT toshi_id FROM app_categories WHERE category_id IN (
+                SELECT category_id FROM old_rows WHERE language = 'en')));
+    ELSE
+        PERFORM refresh_users_categories(ARRAY(
+            SELECT toshi_id FROM app_categories WHERE category_id IN (
+                SELECT category_id FROM new_rows WHERE language = 'en'
+                UNION SELECT category_id FROM old_rows WHERE language = 'en')));
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER category_names_insert AFTER INSERT ON category_names
+REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE category_names_trigger();
+
+CREATE TRIGGER category_names_update AFTER UPDATE ON category_names
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE category_names_trigger();
+
+CREATE TRIGGER category_names_delete AFTER DELETE ON category_names
+REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE category_names_trigger();
+
 CREATE TABLE IF NOT EXISTS websocket_sessions (
     websocket_session_id VARCHAR PRIMARY KEY,
     toshi_id VARCHAR NOT NULL,
@@ -105,4 +223,26 @@ CREATE TABLE IF NOT EXISTS websocket_sessions (
 CREATE INDEX IF NOT EXISTS idx_websocket_sessions_toshi_id ON websocket_sessions (toshi_id);
 CREATE INDEX IF NOT EXISTS idx_websocket_sessions_last_seen ON websocket_sessions (last_seen DESC);
 
-UPDATE database_version SET version_number = 26;
+-- responses of recent registrations, replayed for retried requests
+CREATE TABLE IF NOT EXISTS user_registrations (
+    toshi_id VARCHAR PRIMARY KEY REFERENCES users ON DELETE CASCADE,
+    idempotency_key VARCHAR,
+    request_hash VARCHAR NOT NULL,
+    response VARCHAR NOT NULL,
+    created TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc')
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_registrations_created ON user_registrations (created);
+
+-- the formats each avatar uploaded to S3 is stored in at every size,
+-- keyed by the hash in its url
+CREATE TABLE IF NOT EXISTS avatar_renditions (
+    toshi_id VARCHAR,
+    hash VARCHAR,
+    formats VARCHAR[] NOT NULL,
+    created TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc'),
+
+    PRIMARY KEY (toshi_id, hash)
+);
+
+UPDATE database_version SET version_number = 35;
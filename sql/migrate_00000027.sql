@@ -0,0 +1,28 @@
+ALTER TABLE users ADD COLUMN version BIGINT DEFAULT 0;
+
+CREATE FUNCTION users_version_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.version := COALESCE(OLD.version, 0) + 1;
+    NEW.updated := (now() AT TIME ZONE 'utc');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_version_update BEFORE UPDATE
+ON users FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE users_version_trigger();
+
+-- app categories are part of the user's profile, so changes to them
+-- need to bump the user's version
+CREATE FUNCTION app_categories_version_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        UPDATE users SET updated = (now() AT TIME ZONE 'utc') WHERE toshi_id = OLD.toshi_id;
+        RETURN OLD;
+    END IF;
+    UPDATE users SET updated = (now() AT TIME ZONE 'utc') WHERE toshi_id = NEW.toshi_id;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER app_categories_version_update AFTER INSERT OR DELETE
+ON app_categories FOR EACH ROW EXECUTE PROCEDURE app_categories_version_trigger();
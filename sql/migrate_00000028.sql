@@ -0,0 +1,59 @@
+-- denormalized copies of the user's app categories, so profiles can be
+-- read without joining the category tables
+ALTER TABLE users ADD COLUMN category_ids INTEGER[] DEFAULT '{}';
+ALTER TABLE users ADD COLUMN category_tags VARCHAR[] DEFAULT '{}';
+ALTER TABLE users ADD COLUMN category_names VARCHAR[] DEFAULT '{}';
+
+CREATE INDEX IF NOT EXISTS idx_users_category_ids ON users USING gin(category_ids);
+
+DROP TRIGGER app_categories_version_update ON app_categories;
+DROP FUNCTION app_categories_version_trigger();
+
+CREATE FUNCTION refresh_user_categories(user_toshi_id VARCHAR) RETURNS VOID AS $$
+BEGIN
+    UPDATE users SET (category_ids, category_tags, category_names) = (
+        SELECT COALESCE(array_agg(categories.category_id ORDER BY categories.category_id), '{}'),
+               COALESCE(array_agg(categories.tag ORDER BY categories.category_id), '{}'),
+               COALESCE(array_agg(category_names.name ORDER BY categories.category_id), '{}')
+        FROM app_categories
+        JOIN categories ON app_categories.category_id = categories.category_id
+        LEFT JOIN category_names ON categories.category_id = category_names.category_id
+        AND category_names.language = 'en'
+        WHERE app_categories.toshi_id = user_toshi_id)
+    WHERE toshi_id = user_toshi_id;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION app_categories_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM refresh_user_categories(OLD.toshi_id);
+        RETURN OLD;
+    END IF;
+    PERFORM refresh_user_categories(NEW.toshi_id);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER app_categories_update AFTER INSERT OR DELETE
+ON app_categories FOR EACH ROW EXECUTE PROCEDURE app_categories_trigger();
+
+-- refreshes all the apps in the changed category
+CREATE FUNCTION categories_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM refresh_user_categories(toshi_id) FROM app_categories WHERE category_id = OLD.category_id;
+        RETURN OLD;
+    END IF;
+    PERFORM refresh_user_categories(toshi_id) FROM app_categories WHERE category_id = NEW.category_id;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER categories_update AFTER UPDATE OF tag
+ON categories FOR EACH ROW EXECUTE PROCEDURE categories_trigger();
+
+CREATE TRIGGER category_names_update AFTER INSERT OR UPDATE OR DELETE
+ON category_names FOR EACH ROW EXECUTE PROCEDURE categories_trigger();
+
+SELECT refresh_user_categories(toshi_id) FROM (SELECT DISTINCT toshi_id FROM app_categories) AS apps;
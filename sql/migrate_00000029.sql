@@ -0,0 +1,4 @@
+CREATE INDEX IF NOT EXISTS idx_users_payment_address ON users (payment_address);
+-- payment addresses are stored in the case they were given, batch lookups
+-- match them case insensitively
+CREATE INDEX IF NOT EXISTS idx_users_lower_payment_address ON users (lower(payment_address));
@@ -0,0 +1,9 @@
+-- only rebuild the search vector when the indexed columns change
+DROP TRIGGER tsvectorupdate ON users;
+
+CREATE TRIGGER tsvectorinsert BEFORE INSERT
+ON users FOR EACH ROW EXECUTE PROCEDURE users_search_trigger();
+
+CREATE TRIGGER tsvectorupdate BEFORE UPDATE OF name, username
+ON users FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.username IS DISTINCT FROM NEW.username)
+EXECUTE PROCEDURE users_search_trigger();
@@ -0,0 +1,10 @@
+-- sequence used to allocate autogenerated usernames
+CREATE SEQUENCE IF NOT EXISTS users_autoid_seq;
+
+-- usernames used to be generated randomly, starting with 5 digits and
+-- adding a digit after every collision. start allocating from the first
+-- length without any of those usernames so sign ups don't keep colliding
+-- with them
+SELECT setval('users_autoid_seq', SUM(10::NUMERIC ^ l)::BIGINT, false)
+FROM generate_series(5, (SELECT MAX(length(username)) - 4 FROM users WHERE username ~* '^user[0-9]{5,17}$')) AS l
+HAVING COUNT(*) > 0;
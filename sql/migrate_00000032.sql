@@ -0,0 +1,10 @@
+-- responses of recent registrations, replayed for retried requests
+CREATE TABLE IF NOT EXISTS user_registrations (
+    toshi_id VARCHAR PRIMARY KEY REFERENCES users ON DELETE CASCADE,
+    idempotency_key VARCHAR,
+    request_hash VARCHAR NOT NULL,
+    response VARCHAR NOT NULL,
+    created TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc')
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_registrations_created ON user_registrations (created);
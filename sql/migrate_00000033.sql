@@ -0,0 +1,2 @@
+-- identicons are rendered on request and cached in memory
+DELETE FROM avatars WHERE toshi_id LIKE '%\_identicon\_%';
@@ -0,0 +1,10 @@
+-- the formats each avatar uploaded to S3 is stored in at every size,
+-- keyed by the hash in its url
+CREATE TABLE IF NOT EXISTS avatar_renditions (
+    toshi_id VARCHAR,
+    hash VARCHAR,
+    formats VARCHAR[] NOT NULL,
+    created TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc'),
+
+    PRIMARY KEY (toshi_id, hash)
+);
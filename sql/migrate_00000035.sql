@@ -0,0 +1,97 @@
+-- refresh the denormalized categories with statement level triggers, so
+-- bulk changes to app categories or renaming a category update each
+-- affected user once rather than once per changed row
+DROP TRIGGER app_categories_update ON app_categories;
+DROP TRIGGER categories_update ON categories;
+DROP TRIGGER category_names_update ON category_names;
+DROP FUNCTION app_categories_trigger();
+DROP FUNCTION categories_trigger();
+DROP FUNCTION refresh_user_categories(VARCHAR);
+
+CREATE FUNCTION refresh_users_categories(user_toshi_ids VARCHAR[]) RETURNS VOID AS $$
+BEGIN
+    UPDATE users SET category_ids = c.category_ids, category_tags = c.category_tags, category_names = c.category_names
+    FROM (
+        SELECT t.toshi_id,
+               COALESCE(array_agg(categories.category_id ORDER BY categories.category_id)
+                        FILTER (WHERE categories.category_id IS NOT NULL), '{}') AS category_ids,
+               COALESCE(array_agg(categories.tag ORDER BY categories.category_id)
+                        FILTER (WHERE categories.category_id IS NOT NULL), '{}') AS category_tags,
+               COALESCE(array_agg(category_names.name ORDER BY categories.category_id)
+                        FILTER (WHERE categories.category_id IS NOT NULL), '{}') AS category_names
+        FROM (SELECT DISTINCT toshi_id FROM UNNEST(user_toshi_ids) AS toshi_id) AS t
+        LEFT JOIN app_categories ON app_categories.toshi_id = t.toshi_id
+        LEFT JOIN categories ON app_categories.category_id = categories.category_id
+        LEFT JOIN category_names ON categories.category_id = category_names.category_id
+        AND category_names.language = 'en'
+        GROUP BY t.toshi_id) AS c
+    WHERE users.toshi_id = c.toshi_id
+    -- a statement can both delete and insert a user's categories
+    AND (users.category_ids, users.category_tags, users.category_names)
+        IS DISTINCT FROM (c.category_ids, c.category_tags, c.category_names);
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION app_categories_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM refresh_users_categories(ARRAY(SELECT toshi_id FROM old_rows));
+    ELSE
+        PERFORM refresh_users_categories(ARRAY(SELECT toshi_id FROM new_rows));
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER app_categories_insert AFTER INSERT ON app_categories
+REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE app_categories_trigger();
+
+CREATE TRIGGER app_categories_delete AFTER DELETE ON app_categories
+REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE app_categories_trigger();
+
+-- refreshes all the apps in categories whose tag changed
+CREATE FUNCTION categories_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM refresh_users_categories(ARRAY(
+        SELECT app_categories.toshi_id FROM app_categories
+        JOIN new_rows ON new_rows.category_id = app_categories.category_id
+        JOIN old_rows ON old_rows.category_id = new_rows.category_id
+        WHERE new_rows.tag IS DISTINCT FROM old_rows.tag));
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER categories_update AFTER UPDATE ON categories
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE categories_trigger();
+
+-- refreshes all the apps in categories whose english name changed
+CREATE FUNCTION category_names_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM refresh_users_categories(ARRAY(
+            SELECT toshi_id FROM app_categories WHERE category_id IN (
+                SELECT category_id FROM new_rows WHERE language = 'en')));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM refresh_users_categories(ARRAY(
+            SELECT toshi_id FROM app_categories WHERE category_id IN (
+                SELECT category_id FROM old_rows WHERE language = 'en')));
+    ELSE
+        PERFORM refresh_users_categories(ARRAY(
+            SELECT toshi_id FROM app_categories WHERE category_id IN (
+                SELECT category_id FROM new_rows WHERE language = 'en'
+                UNION SELECT category_id FROM old_rows WHERE language = 'en')));
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER category_names_insert AFTER INSERT ON category_names
+REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE PROCEDURE category_names_trigger();
+
+CREATE TRIGGER category_names_update AFTER UPDATE ON category_names
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE category_names_trigger();
+
+CREATE TRIGGER category_names_delete AFTER DELETE ON category_names
+REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE PROCEDURE category_names_trigger();
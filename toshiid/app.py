@@ -25,6 +25,20 @@ def update_config():
     elif 'apps_public_by_default' not in toshi.config.config['general']:
         toshi.config.config['general']['apps_public_by_default'] = 'false'
 
+    for key in ['size', 'ttl', 'redis', 'redis_ttl', 'negative_ttl', 'negative_size', 'bloom', 'bloom_refresh']:
+        env_key = 'PROFILE_CACHE_{}'.format(key.upper())
+        if env_key in os.environ:
+            if 'profile_cache' not in toshi.config.config:
+                toshi.config.config['profile_cache'] = {}
+            toshi.config.config['profile_cache'][key] = os.environ[env_key]
+
+    for key in ['workers', 'queue_size', 'identicon_cache_size']:
+        env_key = 'IMAGE_{}'.format(key.upper())
+        if env_key in os.environ:
+            if 'images' not in toshi.config.config:
+                toshi.config.config['images'] = {}
+            toshi.config.config['images'][key] = os.environ[env_key]
+
 urls = [
     (r"^/v1/timestamp/?$", GenerateTimestamp),
 
@@ -35,6 +49,8 @@ urls = [
     # standard endpoints
     (r"^/v1/user/?$", handlers.UserCreationHandler),
     (r"^/v1/user/(?P<username>[^/]+)/?$", handlers.UserHandler),
+    (r"^/v1/avatar/?$", handlers.AvatarUploadHandler),
+    (r"^/v1/username/(?P<username>[^/]+)/available/?$", handlers.UsernameAvailabilityHandler),
     (r"^/v1/search/user/?$", handlers.SearchUserHandler),
     # app endpoints
     (r"^/v1/apps/(?P<username>0x[a-fA-F0-9]{40})/?$", handlers.UserHandler, {'apps_only': True}),
@@ -44,13 +60,17 @@ urls = [
     (r"^/v1/(?:search/)?dapps/?$", handlers.SearchDappHandler),
 
     (r"^/v1/report/?$", handlers.ReportHandler),
+    (r"^/v1/moderation/?$", handlers.ModerationHandler),
     # categories
+    (r"^/v1/apps/categories/?$", handlers.AppCategoriesHandler),
     (r"^/v1/categories", handlers.CategoryHandler),
 
     # avatar endpoints
     (r"^/identicon/(?P<address>0x[0-9a-fA-f]{40})\.(?P<format>[a-zA-Z]{3})$", handlers.IdenticonHandler),
     (r"^/avatar/(?P<address>0x[0-9a-fA-f]{40})(?:_(?P<hash>[a-fA-F0-9]+))?\.(?P<format>[a-zA-Z]{3})$", handlers.AvatarHandler),
 
+    (r"^/v1/status/images/?$", handlers.ImageServiceStatsHandler),
+
     # reputation update endpoint
     (r"^/v1/reputation/?$", handlers.ReputationUpdateHandler),
 
@@ -0,0 +1,620 @@
+import asyncio
+import json
+import time
+
+from collections import OrderedDict
+from decimal import Decimal
+from toshi.config import config
+from toshi.database import get_database_pool
+from toshi.redis import get_redis_connection
+from toshi.log import log
+from toshiid.bloom import BloomFilter
+
+# the cache is disabled unless a size is configured
+DEFAULT_PROFILE_CACHE_SIZE = 0
+DEFAULT_PROFILE_CACHE_TTL = 30
+DEFAULT_SHARED_PROFILE_CACHE_TTL = 300
+# negative caching is disabled unless a ttl is configured
+DEFAULT_NEGATIVE_CACHE_TTL = 0
+DEFAULT_NEGATIVE_CACHE_SIZE = 100000
+DEFAULT_REGISTERED_USERS_REFRESH = 300
+DEFAULT_REGISTERED_USERS_ERROR_RATE = 0.001
+
+PROFILE_KEY_PREFIX = "toshi:id:profile:"
+PROFILE_USERNAME_KEY_PREFIX = "toshi:id:profile_username:"
+PROFILE_INVALIDATION_CHANNEL = "toshi:id:profile_invalidation"
+# incremented on every invalidation of the profile, so profiles loaded
+# while they were invalidated aren't written to the shared cache
+PROFILE_INVALIDATIONS_KEY_PREFIX = "toshi:id:profile_invalidations:"
+
+# sets the profile and its username mapping unless the profile's
+# invalidation count has changed. KEYS: invalidation count, profile,
+# username mapping (ignored if ARGV[4] is empty). ARGV: expected count,
+# profile, ttl, toshi_id
+SET_PROFILE_IF_NOT_INVALIDATED = """
+if (redis.call('GET', KEYS[1]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+if ARGV[4] ~= '' then
+    redis.call('SET', KEYS[3], ARGV[4], 'EX', ARGV[3])
+end
+return 1
+"""
+
+# the columns needed to render a profile, to apply the apps filter
+# and to generate the profile's etag
+PROFILE_FIELDS = ('toshi_id', 'username', 'payment_address', 'avatar', 'name', 'about',
+                  'location', 'is_app', 'is_public', 'reputation_score', 'average_rating',
+                  'review_count', 'featured', 'blocked', 'category_ids', 'category_tags',
+                  'category_names', 'version')
+
+class UserRecord:
+    """Compact copy of the user columns in `PROFILE_FIELDS`, used to keep
+    profiles in the caches. Supports the same item access as database rows
+    so it can be rendered by `user_row_for_json`. Missing columns are None
+    and decimals are stored as floats so records can be stored as json."""
+
+    __slots__ = PROFILE_FIELDS
+
+    def __init__(self, row):
+        for field in PROFILE_FIELDS:
+            value = row[field] if field in row else None
+            if isinstance(value, Decimal):
+                value = float(value)
+            setattr(self, field, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in PROFILE_FIELDS
+
+    def __eq__(self, other):
+        return isinstance(other, UserRecord) and self.to_dict() == other.to_dict()
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in PROFILE_FIELDS}
+
+class ProfileCache:
+    """Bounded LRU cache of user profiles, keyed by toshi_id with a secondary
+    lookup by lowercased username. Entries expire after `ttl` seconds so
+    changes made outside of the service's write paths (e.g. category
+    deletes) are eventually picked up."""
+
+    def __init__(self, max_size=DEFAULT_PROFILE_CACHE_SIZE, ttl=DEFAULT_PROFILE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # toshi_id -> (expiry time, profile)
+        self._entries = OrderedDict()
+        # lower(username) -> toshi_id
+        self._usernames = {}
+        # incremented on every invalidation, used to avoid caching
+        # results of queries that were running during an invalidation
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def from_config():
+        if 'profile_cache' not in config:
+            return ProfileCache()
+        return ProfileCache(
+            max_size=config['profile_cache'].getint('size', DEFAULT_PROFILE_CACHE_SIZE),
+            ttl=config['profile_cache'].getfloat('ttl', DEFAULT_PROFILE_CACHE_TTL))
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the cached profile for the given toshi_id or username, or None"""
+
+        if not self.enabled:
+            return None
+
+        if key.startswith('0x'):
+            toshi_id = key
+            username = None
+        else:
+            username = key.lower()
+            toshi_id = self._usernames.get(username)
+
+        entry = self._entries.get(toshi_id) if toshi_id else None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires, row = entry
+        if expires < time.monotonic():
+            self._remove(toshi_id)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(toshi_id)
+        self.hits += 1
+        return row
+
+    def set(self, row):
+
+        if not self.enabled:
+            return
+
+        toshi_id = row['toshi_id']
+        if toshi_id in self._entries:
+            self._remove(toshi_id)
+        self._entries[toshi_id] = (time.monotonic() + self.ttl, row)
+        if row['username']:
+            self._usernames[row['username'].lower()] = toshi_id
+
+        while len(self._entries) > self.max_size:
+            evicted, (_, evicted_row) = self._entries.popitem(last=False)
+            self._remove_username(evicted, evicted_row)
+            self.evictions += 1
+
+    def invalidate(self, toshi_id):
+        self.generation += 1
+        if toshi_id in self._entries:
+            self._remove(toshi_id)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+        self._usernames.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+    def _remove(self, toshi_id):
+        _, row = self._entries.pop(toshi_id)
+        self._remove_username(toshi_id, row)
+
+    def _remove_username(self, toshi_id, row):
+        username = row['username']
+        if username and self._usernames.get(username.lower()) == toshi_id:
+            del self._usernames[username.lower()]
+
+class NegativeCache:
+    """Bounded cache of toshi_ids and lowercased usernames that recently
+    didn't match any user. Entries expire after `ttl` seconds so users
+    registered by other processes are eventually found."""
+
+    def __init__(self, ttl=DEFAULT_NEGATIVE_CACHE_TTL, max_size=DEFAULT_NEGATIVE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> expiry time
+        self._entries = OrderedDict()
+
+        self.hits = 0
+
+    @staticmethod
+    def from_config():
+        if 'profile_cache' not in config:
+            return NegativeCache()
+        return NegativeCache(
+            ttl=config['profile_cache'].getfloat('negative_ttl', DEFAULT_NEGATIVE_CACHE_TTL),
+            max_size=config['profile_cache'].getint('negative_size', DEFAULT_NEGATIVE_CACHE_SIZE))
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_size > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        expires = self._entries.get(key)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self._entries[key]
+            return False
+        self.hits += 1
+        return True
+
+    def add(self, key):
+        if not self.enabled:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = time.monotonic() + self.ttl
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+class RegisteredUsersFilter:
+    """Bloom filter of every registered toshi_id and lowercased username,
+    used to answer lookups for users that don't exist without a query.
+
+    The filter is loaded in the background and rebuilt every
+    `refresh_interval` seconds to pick up users added directly to the
+    database. Users registered by other processes are only added when
+    their invalidations are received through the shared profile cache, so
+    with more than one process this must be used with the shared cache.
+    Until the filter has been loaded, or if it hasn't been rebuilt for two
+    refresh intervals, every key is reported as possibly existing."""
+
+    def __init__(self, refresh_interval=DEFAULT_REGISTERED_USERS_REFRESH,
+                 error_rate=DEFAULT_REGISTERED_USERS_ERROR_RATE):
+        self.refresh_interval = refresh_interval
+        self.error_rate = error_rate
+        self._filter = None
+        self._loaded = 0
+        # keys added while the filter is being rebuilt
+        self._pending = None
+        self._running = False
+
+        self.hits = 0
+
+    @staticmethod
+    def from_config():
+        if 'profile_cache' not in config or not config['profile_cache'].getboolean('bloom', False):
+            return None
+        return RegisteredUsersFilter(
+            refresh_interval=config['profile_cache'].getfloat('bloom_refresh', DEFAULT_REGISTERED_USERS_REFRESH),
+            error_rate=config['profile_cache'].getfloat('bloom_error_rate', DEFAULT_REGISTERED_USERS_ERROR_RATE))
+
+    @property
+    def ready(self):
+        return self._filter is not None and time.monotonic() - self._loaded < self.refresh_interval * 2
+
+    def might_exist(self, key):
+        self._start()
+        if not self.ready or key in self._filter:
+            return True
+        self.hits += 1
+        return False
+
+    def add(self, key):
+        if self._filter is not None:
+            self._filter.add(key)
+        if self._pending is not None:
+            self._pending.append(key)
+
+    def invalidate(self):
+        """Stops using the filter until it has been rebuilt"""
+        self._loaded = 0
+
+    def _start(self):
+        if self._running:
+            return
+        self._running = True
+        asyncio.get_event_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.rebuild()
+            except Exception:
+                log.exception("error loading registered users filter")
+                await asyncio.sleep(min(self.refresh_interval, 10))
+            else:
+                await asyncio.sleep(self.refresh_interval)
+
+    async def rebuild(self):
+        self._pending = []
+        try:
+            async with get_database_pool().acquire() as con:
+                count = await con.fetchval("SELECT COUNT(*) FROM users")
+                # sized for the toshi_id and username of every user with room to grow
+                bloom = BloomFilter(int((count * 2 + 1000) * 1.5), self.error_rate)
+                async with con.transaction():
+                    async for row in con.cursor("SELECT toshi_id, lower(username) AS username FROM users",
+                                                prefetch=10000):
+                        bloom.add(row['toshi_id'])
+                        if row['username']:
+                            bloom.add(row['username'])
+            for key in self._pending:
+                bloom.add(key)
+            self._filter = bloom
+            self._loaded = time.monotonic()
+        finally:
+            self._pending = None
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key so that only one is
+    running at a time, with all callers sharing its result"""
+
+    def __init__(self):
+        self._flights = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def run(self, key, fn, *args):
+        future = self._flights.get(key)
+        if future is None:
+            future = self._flights[key] = asyncio.ensure_future(fn(*args))
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            self.coalesced += 1
+        # shielded so a cancelled caller doesn't cancel the other callers
+        return await asyncio.shield(future)
+
+    def _done(self, key, future):
+        if self._flights.get(key) is future:
+            del self._flights[key]
+
+class SharedProfileCache:
+    """Profile cache stored in redis so it can be shared between processes.
+
+    Invalidations are published on `PROFILE_INVALIDATION_CHANNEL` and evict
+    the entry from the local cache of every subscribed process. Redis errors
+    are logged and treated as cache misses."""
+
+    def __init__(self, local_cache, ttl=DEFAULT_SHARED_PROFILE_CACHE_TTL,
+                 negative_cache=None, registered_users=None):
+        self.local_cache = local_cache
+        self.negative_cache = negative_cache
+        self.registered_users = registered_users
+        self.ttl = ttl
+        self._running = False
+        self._channel = None
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def from_config(local_cache, negative_cache=None, registered_users=None):
+        if 'redis' not in config or 'profile_cache' not in config or \
+           not config['profile_cache'].getboolean('redis', False):
+            return None
+        return SharedProfileCache(
+            local_cache,
+            ttl=config['profile_cache'].getint('redis_ttl', DEFAULT_SHARED_PROFILE_CACHE_TTL),
+            negative_cache=negative_cache, registered_users=registered_users)
+
+    async def get(self, key):
+
+        self._start()
+        try:
+            redis = get_redis_connection()
+            if key.startswith('0x'):
+                toshi_id = key
+            else:
+                toshi_id = await redis.get(PROFILE_USERNAME_KEY_PREFIX + key.lower(), encoding='utf-8')
+            profile = None
+            if toshi_id is not None:
+                profile = await redis.get(PROFILE_KEY_PREFIX + toshi_id, encoding='utf-8')
+        except Exception:
+            log.exception("error reading shared profile cache")
+            profile = None
+
+        if profile is not None:
+            profile = UserRecord(json.loads(profile))
+            # the username mapping is never removed, so make sure it
+            # still points to a user with that username
+            if key.startswith('0x') or (profile['username'] or '').lower() == key.lower():
+                self.hits += 1
+                return profile
+
+        self.misses += 1
+        return None
+
+    async def invalidation_count(self, toshi_id):
+        """Returns the profile's current invalidation count, to be passed to
+        `set` when caching the profile loaded after calling this. Returns
+        None if it can't be read, in which case the profile shouldn't be
+        cached"""
+
+        try:
+            return await get_redis_connection().get(PROFILE_INVALIDATIONS_KEY_PREFIX + toshi_id,
+                                                    encoding='utf-8') or ''
+        except Exception:
+            log.exception("error reading shared profile cache")
+            return None
+
+    async def set(self, profile, invalidation_count=None):
+        """Caches the profile. If `invalidation_count` is given the profile is
+        only cached if it hasn't been invalidated since it was read,
+        otherwise a profile loaded before a concurrent update could be
+        written after the update's invalidation"""
+
+        self._start()
+        profile_key = PROFILE_KEY_PREFIX + profile['toshi_id']
+        data = json.dumps(profile.to_dict())
+        username_key = PROFILE_USERNAME_KEY_PREFIX + profile['username'].lower() if profile['username'] else None
+        redis = get_redis_connection()
+        try:
+            if invalidation_count is not None:
+                await redis.eval(SET_PROFILE_IF_NOT_INVALIDATED,
+                                 keys=[PROFILE_INVALIDATIONS_KEY_PREFIX + profile['toshi_id'],
+                                       profile_key, username_key or profile_key],
+                                 args=[invalidation_count, data, self.ttl, profile['toshi_id'] if username_key else ''])
+            else:
+                pipe = redis.pipeline()
+                pipe.set(profile_key, data, expire=self.ttl)
+                if username_key:
+                    pipe.set(username_key, profile['toshi_id'], expire=self.ttl)
+                await pipe.execute()
+        except Exception:
+            log.exception("error writing to shared profile cache")
+
+    async def invalidate(self, toshi_id, username=None):
+        await self.invalidate_many([toshi_id], [username])
+
+    async def invalidate_many(self, toshi_ids, usernames=None):
+        """Invalidates all the given profiles with a single round trip"""
+
+        self._start()
+        pipe = get_redis_connection().pipeline()
+        # counted before deleting so loads that finish in between aren't
+        # cached. the counts only need to outlive the loads running now
+        for toshi_id in toshi_ids:
+            pipe.incr(PROFILE_INVALIDATIONS_KEY_PREFIX + toshi_id)
+            pipe.expire(PROFILE_INVALIDATIONS_KEY_PREFIX + toshi_id, self.ttl)
+        pipe.delete(*[PROFILE_KEY_PREFIX + toshi_id for toshi_id in toshi_ids])
+        for toshi_id, username in zip(toshi_ids, usernames or [None] * len(toshi_ids)):
+            # the username is included so other processes can update their
+            # negative caches when users are registered or renamed
+            pipe.publish(PROFILE_INVALIDATION_CHANNEL,
+                         "{} {}".format(toshi_id, username.lower()) if username else toshi_id)
+        try:
+            await pipe.execute()
+        except Exception:
+            log.exception("error invalidating shared profile cache")
+
+    def _start(self):
+        if self._running:
+            return
+        self._running = True
+        asyncio.get_event_loop().create_task(self._run())
+
+    async def _run(self):
+        try:
+            self._channel, = await get_redis_connection().subscribe(PROFILE_INVALIDATION_CHANNEL)
+            while await self._channel.wait_message():
+                message = await self._channel.get(encoding='utf-8')
+                toshi_id, _, username = message.partition(' ')
+                self.local_cache.invalidate(toshi_id)
+                for key in [toshi_id, username]:
+                    if key:
+                        if self.negative_cache is not None:
+                            self.negative_cache.discard(key)
+                        if self.registered_users is not None:
+                            self.registered_users.add(key)
+        except Exception:
+            log.exception("error listening for profile invalidations")
+        # the local caches can't be trusted without invalidations
+        self.local_cache.clear()
+        if self.negative_cache is not None:
+            self.negative_cache.clear()
+        if self.registered_users is not None:
+            self.registered_users.invalidate()
+        self._channel = None
+        self._running = False
+
+class ProfileCacheMixin:
+    """Gives handlers access to the application wide profile caches"""
+
+    @property
+    def profile_cache(self):
+        cache = getattr(self.application, 'profile_cache', None)
+        if cache is None:
+            cache = self.application.profile_cache = ProfileCache.from_config()
+            self.application.shared_profile_cache = SharedProfileCache.from_config(
+                cache, self.negative_profile_cache, self.registered_users)
+        return cache
+
+    @property
+    def shared_profile_cache(self):
+        # make sure the caches are initialised
+        self.profile_cache
+        return getattr(self.application, 'shared_profile_cache', None)
+
+    @property
+    def negative_profile_cache(self):
+        cache = getattr(self.application, 'negative_profile_cache', None)
+        if cache is None:
+            cache = self.application.negative_profile_cache = NegativeCache.from_config()
+        return cache
+
+    @property
+    def registered_users(self):
+        # None if the filter is disabled
+        if not hasattr(self.application, 'registered_users'):
+            self.application.registered_users = RegisteredUsersFilter.from_config()
+        return self.application.registered_users
+
+    def is_known_missing(self, key):
+        """Returns True if the given toshi_id or lowercased username is known
+        not to belong to any user"""
+
+        if key in self.negative_profile_cache:
+            return True
+        registered_users = self.registered_users
+        return registered_users is not None and not registered_users.might_exist(key)
+
+    @property
+    def profile_lookups(self):
+        lookups = getattr(self.application, 'profile_lookups', None)
+        if lookups is None:
+            lookups = self.application.profile_lookups = SingleFlight()
+        return lookups
+
+    async def get_cached_profile(self, key):
+        profile = self.profile_cache.get(key)
+        if profile is None and self.shared_profile_cache is not None:
+            profile = await self.shared_profile_cache.get(key)
+            if profile is not None:
+                self.profile_cache.set(profile)
+        return profile
+
+    async def load_profile(self, key, sql, *args):
+        """Runs the given profile query and caches the result. Concurrent
+        loads with the same key share a single query"""
+        return await self.profile_lookups.run(key, self._load_profile, key, sql, args)
+
+    async def _load_profile(self, key, sql, args):
+        generation = self.profile_cache.generation
+        invalidation_count = None
+        if self.shared_profile_cache is not None and key.startswith('0x'):
+            invalidation_count = await self.shared_profile_cache.invalidation_count(key)
+        # this is shared by multiple requests, so it can't use the
+        # connection of the request that started it
+        async with get_database_pool().acquire() as con:
+            row = await con.fetchrow(sql, *args)
+            if row is not None and self.shared_profile_cache is not None and not key.startswith('0x'):
+                # the toshi_id of username lookups is only known now, so the
+                # profile is only cached if it's still at the version that
+                # was read after reading its invalidation count
+                invalidation_count = await self.shared_profile_cache.invalidation_count(row['toshi_id'])
+                if await con.fetchval("SELECT version FROM users WHERE toshi_id = $1",
+                                      row['toshi_id']) != row['version']:
+                    invalidation_count = None
+        if row is None:
+            return None
+        profile = UserRecord(row)
+        if generation == self.profile_cache.generation:
+            self.profile_cache.set(profile)
+            if invalidation_count is not None:
+                await self.shared_profile_cache.set(profile, invalidation_count)
+        return profile
+
+    async def invalidate_profile(self, toshi_id, username=None):
+        """Evicts the user's profile from the caches. The username should be
+        given when users are created or change their username so they are
+        removed from the negative caches"""
+
+        await self.invalidate_profiles([toshi_id], [username])
+
+    async def invalidate_profiles(self, toshi_ids, usernames=None):
+        """Evicts many profiles at once, only making a single call to the
+        shared cache"""
+
+        if not toshi_ids:
+            return
+        for toshi_id, username in zip(toshi_ids, usernames or [None] * len(toshi_ids)):
+            self.profile_cache.invalidate(toshi_id)
+            for key in [toshi_id, username.lower() if username else None]:
+                if key:
+                    self.negative_profile_cache.discard(key)
+                    if self.registered_users is not None:
+                        self.registered_users.add(key)
+        if self.shared_profile_cache is not None:
+            await self.shared_profile_cache.invalidate_many(toshi_ids, usernames)
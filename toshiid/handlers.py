@@ -4,11 +4,11 @@ import asyncpg
 import regex
 import io
 import blockies
-import random
-import itertools
 import string
 import datetime
 import hashlib
+import json
+import struct
 
 from toshi.database import DatabaseMixin
 from toshi.boto import BotoMixin
@@ -16,14 +16,18 @@ from toshi.errors import JSONHTTPError
 from toshi.config import config
 from toshi.log import log
 from decimal import Decimal
+from collections import OrderedDict
 from toshi.handlers import (BaseHandler,
                             RequestVerificationMixin,
                             SimpleFileHandler)
 from toshi.analytics import AnalyticsMixin, encode_id as analytics_encode_id
-from tornado.web import HTTPError
+from tornado.web import HTTPError, stream_request_body
+from tornado.escape import json_encode
 from toshi.utils import validate_address, validate_decimal_string, validate_int_string, parse_int
 from PIL import Image, ExifTags
 from PIL.JpegImagePlugin import get_sampling
+from toshiid.cache import ProfileCacheMixin
+from toshiid.images import ImageServiceMixin
 
 assert ExifTags.TAGS[0x0112] == "Orientation"
 EXIF_ORIENTATION = 0x0112
@@ -33,14 +37,74 @@ PUNCTUATION = string.punctuation.replace('_', '')
 
 MIN_AUTOID_LENGTH = 5
 
-AVATAR_URL_HASH_LENGTH = 6
+MAX_BATCH_LOOKUP_SIZE = 1000
+MAX_BULK_UPDATE_SIZE = 1000
 
-def generate_username(autoid_length):
-    """Generate usernames postfixed with a random ID which is a concatenation
-    of digits of length `autoid_length`"""
+AVATAR_URL_HASH_LENGTH = 6
 
-    chars = '0123456789'
-    return 'user' + ''.join([random.choice(chars) for x in range(autoid_length)])
+# avatars are scaled down to fit within a square of the first size, and
+# stored at each of the smaller sizes for clients showing them smaller
+AVATAR_SIZES = (512, 256, 128, 64)
+AVATAR_SIZE = AVATAR_SIZES[0]
+
+# hard limit on the size of uploaded avatars
+MAX_AVATAR_SIZE = 10 * 1024 * 1024
+# the dimensions of uploaded avatars must be found within this many bytes
+MAX_AVATAR_HEADER_SIZE = 512 * 1024
+MAX_AVATAR_PIXELS = 50000000
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+JPEG_SIGNATURE = b'\xff\xd8'
+# start of frame markers, which contain the image's dimensions
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+AVATAR_EXTENSIONS = {
+    'PNG': 'png',
+    'JPEG': 'jpg',
+    'WEBP': 'webp'
+}
+
+# webp versions of avatars and identicons are only produced if pillow was
+# built with libwebp
+Image.init()
+WEBP_SUPPORTED = 'WEBP' in Image.SAVE
+WEBP_QUALITY = 80
+
+# identicons only depend on their address, so their last modified date
+# only depends on the version. bump the version if the rendering ever
+# changes so clients don't keep using cached identicons
+IDENTICON_VERSION = 1
+IDENTICON_EPOCH = datetime.datetime(2017, 1, 1)
+
+# multiplier and offset of the affine permutation used to spread sequential
+# autoids over each block of ids. the multiplier must be coprime with 10 so
+# the permutation is a bijection for every id length
+AUTOID_MULTIPLIER = 7368787
+AUTOID_OFFSET = 2750159
+
+def autoid_username(seq):
+    """Maps a value from the `users_autoid_seq` sequence to a unique username.
+
+    The first 10^MIN_AUTOID_LENGTH values map to usernames with
+    MIN_AUTOID_LENGTH digits, the following 10^(MIN_AUTOID_LENGTH + 1)
+    to usernames with one more digit, and so on. Within each block the
+    values are permuted so consecutive sign ups don't get consecutive
+    usernames."""
+
+    length = MIN_AUTOID_LENGTH
+    while seq >= 10 ** length:
+        seq -= 10 ** length
+        length += 1
+    autoid = (seq * AUTOID_MULTIPLIER + AUTOID_OFFSET) % (10 ** length)
+    return 'user{:0{}d}'.format(autoid, length)
+
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+def registration_request_hash(payload):
+    """Returns a digest of the registration payload, used to recognise
+    retries of the same registration"""
+
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
 
 def validate_username(username):
     return regex.match('^[a-zA-Z][a-zA-Z0-9_]{2,59}$', username)
@@ -58,7 +122,53 @@ def dapp_row_for_json(request, row):
             rval['avatar'])
     return rval
 
-def user_row_for_json(request, row):
+# the fields of the user json object, mapped to the columns needed to render them
+USER_FIELDS = OrderedDict([
+    ('username', ('username',)),
+    ('token_id', ('toshi_id',)),
+    ('toshi_id', ('toshi_id',)),
+    ('payment_address', ('payment_address',)),
+    ('avatar', ('avatar', 'toshi_id')),
+    ('name', ('name',)),
+    ('about', ('about',)),
+    ('location', ('location',)),
+    ('is_app', ('is_app',)),
+    ('public', ('is_public',)),
+    ('reputation_score', ('reputation_score',)),
+    ('average_rating', ('average_rating',)),
+    ('review_count', ('review_count',)),
+    # only included for apps
+    ('featured', ('featured', 'is_app')),
+    ('categories', ('category_ids', 'category_tags', 'category_names', 'is_app')),
+    # backwards compat
+    ('custom', ('avatar', 'toshi_id', 'name', 'about', 'location')),
+])
+
+def parse_user_fields(values):
+    """Parses a list of comma separated `fields` arguments, returning the
+    requested fields in the order they're rendered, or None if no fields were
+    given. Raises a ValueError if any of the fields are unknown"""
+
+    fields = set(field.strip() for value in values for field in value.split(',') if field.strip())
+    if not fields:
+        return None
+    unknown = fields.difference(USER_FIELDS)
+    if unknown:
+        raise ValueError("Unknown fields: {}".format(", ".join(sorted(unknown))))
+    return tuple(field for field in USER_FIELDS if field in fields)
+
+def user_columns(fields, *extra_columns):
+    """Returns the sql projection of the users table needed to render the
+    given fields, plus any extra columns"""
+
+    if fields is None:
+        return "users.*"
+    columns = set(extra_columns)
+    for field in fields:
+        columns.update(USER_FIELDS[field])
+    return ", ".join("users.{}".format(column) for column in sorted(columns))
+
+def user_row_for_json(request, row, fields=None):
     rval = {
         'username': row['username'],
         'token_id': row['toshi_id'],
@@ -80,7 +190,7 @@ def user_row_for_json(request, row):
             rval['avatar'])
     if row['is_app']:
         rval['featured'] = row['featured'] or False
-        if 'category_names' in row and 'category_ids' in row:
+        if row.get('category_names') is not None and row.get('category_ids') is not None:
             rval['categories'] = [{'id': cat[0], 'tag': cat[1], 'name': cat[2]}
                                   for cat in zip(row['category_ids'], row['category_tags'], row['category_names'])
                                   if cat[0] is not None and cat[1] is not None and cat[2] is not None]
@@ -96,8 +206,193 @@ def user_row_for_json(request, row):
         rval['custom']['about'] = rval['about']
     if rval['location'] is not None:
         rval['custom']['location'] = rval['location']
+    if fields is not None:
+        rval = {key: value for key, value in rval.items() if key in fields}
     return rval
 
+# the (c accelerated when available) string encoder used by `json.dumps`
+encode_json_string = json.encoder.encode_basestring_ascii
+
+JSON_CONSTANTS = {None: 'null', True: 'true', False: 'false'}
+
+def _json_string(value):
+    return 'null' if value is None else encode_json_string(value)
+
+def _json_int(value):
+    return 'null' if value is None else str(int(value))
+
+class UserJSONSerializer:
+    """Renders user rows straight to json, producing the same objects as
+    `user_row_for_json` without building an intermediate dict for every row.
+    The url prefix for relative avatar urls is computed once per request.
+
+    If `fields` is given only those fields are rendered, and rows only need
+    the columns listed for them in `USER_FIELDS`."""
+
+    def __init__(self, request, fields=None):
+        self.url_prefix = "{}://{}".format(request.protocol, request.host)
+        self.fields = fields
+
+    def _avatar(self, row):
+        avatar = row['avatar'] or "/identicon/{}.png".format(row['toshi_id'])
+        if avatar.startswith("/"):
+            avatar = self.url_prefix + avatar
+        return encode_json_string(avatar)
+
+    def _categories(self, row):
+        category_ids = row.get('category_ids')
+        category_names = row.get('category_names')
+        if category_ids is None or category_names is None:
+            return '[]'
+        return '[{}]'.format(','.join([
+            '{{"id":{},"tag":{},"name":{}}}'.format(
+                cat[0], encode_json_string(cat[1]), encode_json_string(cat[2]))
+            for cat in zip(category_ids, row['category_tags'], category_names)
+            if cat[0] is not None and cat[1] is not None and cat[2] is not None]))
+
+    def _custom(self, row):
+        custom = ['{"avatar":', self._avatar(row)]
+        for key in ['name', 'about', 'location']:
+            if row[key] is not None:
+                custom.extend([',"', key, '":', encode_json_string(row[key])])
+        custom.append('}')
+        return ''.join(custom)
+
+    FIELD_SERIALIZERS = {
+        'username': lambda self, row: _json_string(row['username']),
+        'token_id': lambda self, row: _json_string(row['toshi_id']),
+        'toshi_id': lambda self, row: _json_string(row['toshi_id']),
+        'payment_address': lambda self, row: _json_string(row['payment_address']),
+        'avatar': _avatar,
+        'name': lambda self, row: _json_string(row['name']),
+        'about': lambda self, row: _json_string(row['about']),
+        'location': lambda self, row: _json_string(row['location']),
+        'is_app': lambda self, row: JSON_CONSTANTS[row['is_app']],
+        'public': lambda self, row: JSON_CONSTANTS[row['is_public']],
+        'reputation_score': lambda self, row: 'null' if row['reputation_score'] is None else repr(float(row['reputation_score'])),
+        'average_rating': lambda self, row: '0' if row['average_rating'] is None else repr(float(row['average_rating'])),
+        'review_count': lambda self, row: _json_int(row['review_count']),
+        'featured': lambda self, row: 'true' if row['featured'] else 'false',
+        'categories': _categories,
+        'custom': _custom
+    }
+
+    def serialize(self, row):
+
+        if self.fields is not None:
+            return '{{{}}}'.format(','.join([
+                '"{}":{}'.format(field, self.FIELD_SERIALIZERS[field](self, row))
+                for field in self.fields
+                if (field != 'featured' and field != 'categories') or row['is_app']]))
+
+        toshi_id = row['toshi_id']
+        avatar = row['avatar'] or "/identicon/{}.png".format(toshi_id)
+        if avatar.startswith("/"):
+            avatar = self.url_prefix + avatar
+        avatar = encode_json_string(avatar)
+        toshi_id = _json_string(toshi_id)
+        name = row['name']
+        about = row['about']
+        location = row['location']
+        reputation_score = row['reputation_score']
+        average_rating = row['average_rating']
+
+        custom = ['{"avatar":', avatar]
+        if name is not None:
+            name = encode_json_string(name)
+            custom.extend([',"name":', name])
+        else:
+            name = 'null'
+        if about is not None:
+            about = encode_json_string(about)
+            custom.extend([',"about":', about])
+        else:
+            about = 'null'
+        if location is not None:
+            location = encode_json_string(location)
+            custom.extend([',"location":', location])
+        else:
+            location = 'null'
+        custom.append('}')
+
+        parts = [
+            '{"username":', _json_string(row['username']),
+            ',"token_id":', toshi_id,
+            ',"toshi_id":', toshi_id,
+            ',"payment_address":', _json_string(row['payment_address']),
+            ',"avatar":', avatar,
+            ',"name":', name,
+            ',"about":', about,
+            ',"location":', location,
+            ',"is_app":', JSON_CONSTANTS[row['is_app']],
+            ',"public":', JSON_CONSTANTS[row['is_public']],
+            ',"reputation_score":', 'null' if reputation_score is None else repr(float(reputation_score)),
+            ',"average_rating":', '0' if average_rating is None else repr(float(average_rating)),
+            ',"review_count":', _json_int(row['review_count'])
+        ]
+        if row['is_app']:
+            parts.extend([',"featured":', 'true' if row['featured'] else 'false',
+                          ',"categories":', self._categories(row)])
+        parts.append(',"custom":')
+        parts.extend(custom)
+        parts.append('}')
+        return ''.join(parts)
+
+    def serialize_many(self, rows):
+        return '[{}]'.format(','.join([self.serialize(row) for row in rows]))
+
+class UserJSONMixin:
+
+    def get_user_fields(self):
+        """Returns the fields requested using the `fields` query argument,
+        or None if the full user objects should be returned"""
+
+        try:
+            return parse_user_fields(self.get_query_arguments('fields'))
+        except ValueError as e:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': str(e)}]})
+
+    def write_user_json(self, row, fields=None):
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        # escape closing tags the same way `tornado.escape.json_encode` does
+        self.write(UserJSONSerializer(self.request, fields).serialize(row).replace("</", "<\\/"))
+
+    def write_users_json(self, rows, fields=None, **values):
+        """Writes a json object containing the given values followed by the
+        rendered user rows as `results`"""
+
+        results = UserJSONSerializer(self.request, fields).serialize_many(rows).replace("</", "<\\/")
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write('{{{}"results":{}}}'.format(
+            ''.join(['{}:{},'.format(encode_json_string(key), json_encode(value)) for key, value in values.items()]),
+            results))
+
+def user_etag(row, fields=None):
+    """Returns a strong etag for the user's profile, or None if the row
+    doesn't include the user's version. Sparse fieldsets are a different
+    representation so they get their own etag"""
+
+    version = row.get('version')
+    if version is None:
+        return None
+    if fields is not None:
+        return '"{}-{}-{}"'.format(row['toshi_id'], version, '.'.join(fields))
+    return '"{}-{}"'.format(row['toshi_id'], version)
+
+def parse_moderation_patch(patch):
+    """Returns the (featured, blocked, public) values of a moderation patch,
+    with None for values that aren't being changed"""
+
+    values = []
+    for key in ['featured', 'blocked', 'public']:
+        value = parse_boolean(patch[key]) if key in patch else None
+        if key in patch and value is None:
+            raise ValueError("Invalid {}".format(key))
+        values.append(value)
+    if all(value is None for value in values):
+        raise ValueError("Bad Arguments")
+    return tuple(values)
+
 def parse_boolean(b):
     if isinstance(b, bool):
         return b
@@ -113,22 +408,146 @@ def parse_boolean(b):
         return bool(b)
     return None
 
+def sniff_image(header):
+    """Returns the format and (width, height) of the image that starts with
+    the given bytes without decoding it, or None if more data is needed to
+    find the image's dimensions. Raises a ValueError if the data isn't a
+    png or jpeg image"""
+
+    header = memoryview(header)
+    if len(header) < len(PNG_SIGNATURE):
+        if PNG_SIGNATURE.startswith(header) or JPEG_SIGNATURE.startswith(header[:len(JPEG_SIGNATURE)]):
+            return None
+        raise ValueError("Unknown image format")
+
+    if header[:len(PNG_SIGNATURE)] == PNG_SIGNATURE:
+        # the first chunk must be the IHDR chunk, which starts with the dimensions
+        if len(header) < 24:
+            return None
+        if header[12:16] != b'IHDR':
+            raise ValueError("Invalid png")
+        width, height = struct.unpack_from('>II', header, 16)
+        return 'PNG', (width, height)
+
+    if header[:len(JPEG_SIGNATURE)] == JPEG_SIGNATURE:
+        pos = len(JPEG_SIGNATURE)
+        while True:
+            if len(header) < pos + 4:
+                return None
+            if header[pos] != 0xFF:
+                raise ValueError("Invalid jpeg")
+            marker = header[pos + 1]
+            if marker == 0xFF:
+                # padding
+                pos += 1
+            elif marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                # markers without a payload
+                pos += 2
+            elif marker in JPEG_SOF_MARKERS:
+                if len(header) < pos + 9:
+                    return None
+                height, width = struct.unpack_from('>HH', header, pos + 5)
+                return 'JPEG', (width, height)
+            elif marker == 0xDA or marker == 0xD9:
+                raise ValueError("Invalid jpeg")
+            else:
+                pos += 2 + struct.unpack_from('>H', header, pos + 2)[0]
+
+    raise ValueError("Unknown image format")
+
+def validate_avatar_header(header, mime_type, complete=False):
+    """Checks the start of an uploaded avatar before it's decoded. Returns
+    False if more data is needed, unless `complete` is set because the
+    given data is the whole upload"""
+
+    try:
+        result = sniff_image(header)
+    except ValueError:
+        raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid image data'}]})
+    if result is None:
+        if complete or len(header) >= MAX_AVATAR_HEADER_SIZE:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid image data'}]})
+        return False
+
+    format, (width, height) = result
+    if (mime_type, format) not in [('image/jpeg', 'JPEG'), ('image/png', 'PNG')]:
+        raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Unsupported image format'}]})
+    if width == 0 or height == 0 or width * height > MAX_AVATAR_PIXELS:
+        raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid image dimensions'}]})
+    return True
+
+def accepts_webp(accept):
+    """Checks if the given Accept header explicitly lists image/webp.
+    Wildcards aren't enough, since clients that don't decode webp send
+    them too"""
+
+    if not accept:
+        return False
+    for media_range in accept.split(','):
+        params = media_range.split(';')
+        if params[0].strip().lower() != 'image/webp':
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+def encode_webp(img, lossless=False):
+    """Encodes the image as webp. Lossless encoding is used for images
+    that came from pngs, since they're usually graphics rather than
+    photos"""
+
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.mode or 'transparency' in img.info else 'RGB')
+    stream = io.BytesIO()
+    if lossless:
+        img.save(stream, format="WEBP", lossless=True)
+    else:
+        img.save(stream, format="WEBP", quality=WEBP_QUALITY)
+    return stream.getbuffer().tobytes()
+
 def process_image(data, mime_type):
+    """Normalises an uploaded avatar, returning a dict of (format, size)
+    for each of the AVATAR_SIZES, in the uploaded format and as webp, to
+    the avatar scaled to fit within that size, the md5 hash of the full
+    size avatar and the uploaded format. This runs in the image service's
+    worker processes, so invalid images are reported with a ValueError
+    rather than a JSONHTTPError"""
+
     stream = io.BytesIO(data)
     try:
         img = Image.open(stream)
     except OSError:
-        raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid image data'}]})
+        raise ValueError('Invalid image data')
+
+    # opening the image only reads its header, so this is checked before
+    # anything is decoded
+    if img.size[0] * img.size[1] > MAX_AVATAR_PIXELS:
+        raise ValueError('Invalid image dimensions')
 
     if mime_type == 'image/jpeg' and img.format == 'JPEG':
         format = "JPEG"
-        subsampling = 'keep'
+        # the renditions are new images, so they can't use 'keep'
+        subsampling = get_sampling(img)
+        # have the decoder scale the image down by up to 8 times while
+        # decoding, rather than decoding the full image just to shrink it.
+        # the draft is never smaller than the size the image is thumbnailed
+        # to, so the thumbnail is the same. rotating doesn't change which
+        # side is longest, so this works with the image as it's stored
+        width, height = img.size
+        longest = max(width, height)
+        if longest > AVATAR_SIZE:
+            img.draft(img.mode, (-(-width * AVATAR_SIZE // longest), -(-height * AVATAR_SIZE // longest)))
         # check exif information for orientation
         if hasattr(img, '_getexif'):
             x = img._getexif()
             if x and EXIF_ORIENTATION in x and x[EXIF_ORIENTATION] > 1 and x[EXIF_ORIENTATION] < 9:
                 orientation = x[EXIF_ORIENTATION]
-                subsampling = get_sampling(img)
                 if orientation == 2:
                     # Vertical Mirror
                     img = img.transpose(Image.FLIP_LEFT_RIGHT)
@@ -155,32 +574,173 @@ def process_image(data, mime_type):
         format = "PNG"
         save_kwargs = {'icc_profile': img.info.get("icc_profile")}
     else:
-        raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Unsupported image format'}]})
+        raise ValueError('Unsupported image format')
+
+    renditions = OrderedDict()
+    for size in AVATAR_SIZES:
+        # each rendition is scaled down from the previous one
+        if img.size[0] > size or img.size[1] > size:
+            img.thumbnail((size, size))
+        stream = io.BytesIO()
+        img.save(stream, format=format, optimize=True, **save_kwargs)
+        renditions[(format, size)] = stream.getbuffer().tobytes()
+        if WEBP_SUPPORTED:
+            renditions[('WEBP', size)] = encode_webp(img, lossless=format == 'PNG')
+
+    hasher = hashlib.md5()
+    hasher.update(renditions[(format, AVATAR_SIZE)])
+    cache_hash = hasher.hexdigest()
+
+    return renditions, cache_hash, format
 
-    if img.size[0] > 512 or img.size[1] > 512:
-        img.thumbnail((512, 512))
+def resize_avatar(data, size, format=None):
+    """Scales a stored avatar down to fit within the given size, converting
+    it to the given format if it's not the stored one"""
 
+    img = Image.open(io.BytesIO(data))
+    img.thumbnail((size, size))
+    if format == 'WEBP':
+        return encode_webp(img, lossless=img.format == 'PNG')
+    format = img.format
+    save_kwargs = {'subsampling': get_sampling(img), 'quality': 85} if format == 'JPEG' else {}
     stream = io.BytesIO()
     img.save(stream, format=format, optimize=True, **save_kwargs)
+    return stream.getbuffer().tobytes()
 
-    data = stream.getbuffer().tobytes()
-    hasher = hashlib.md5()
-    hasher.update(data)
-    cache_hash = hasher.hexdigest()
+def avatar_key(toshi_id, cache_hash, format, size=AVATAR_SIZE):
+    """Returns the S3 key of the given rendition of an avatar. The full
+    size avatar has no size suffix"""
 
-    return data, cache_hash, format
+    return "public/avatar/{}_{}{}.{}".format(
+        toshi_id, cache_hash[:AVATAR_URL_HASH_LENGTH],
+        '' if size == AVATAR_SIZE else '_{}'.format(size),
+        AVATAR_EXTENSIONS[format])
 
 def create_identitcon(address, format='PNG'):
     if format == 'JPG':
         format = 'JPEG'
+    if format.upper() == 'WEBP':
+        # blockies would encode it lossily, which blurs the blocks
+        data = blockies.create(address, size=8, scale=12, format='PNG')
+        return encode_webp(Image.open(io.BytesIO(data)), lossless=True)
     return blockies.create(address, size=8, scale=12, format=format.upper())
 
-class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
+class ImageNegotiationMixin:
+
+    def negotiate_image_format(self, format):
+        """Returns the format to respond with for a request for an image in
+        the given format, which is webp if the client accepts it"""
+
+        # the response for the same url depends on the Accept header
+        self.set_header('Vary', 'Accept')
+        if WEBP_SUPPORTED and accepts_webp(self.request.headers.get('Accept')):
+            return 'WEBP'
+        return format
+
+class UserETagMixin:
+
+    def check_user_etag(self, row, fields=None):
+        """Sets the Etag header for the given user, returning True if it
+        matches the request's If-None-Match header"""
+
+        etag = user_etag(row, fields)
+        if etag is None:
+            return False
+        self.set_header('Etag', etag)
+        return self.check_etag_header()
+
+class UserMixin(ProfileCacheMixin, ImageServiceMixin, BotoMixin, RequestVerificationMixin, AnalyticsMixin):
+
+    async def is_username_taken(self, username):
+        """Checks if the username is in use, only querying the database when
+        the registered users filter is disabled or can't rule it out"""
+
+        registered_users = self.registered_users
+        if registered_users is not None and not registered_users.might_exist(username.lower()):
+            return False
+        async with self.db:
+            row = await self.db.fetchrow("SELECT 1 FROM users WHERE lower(username) = lower($1)", username)
+        return row is not None
 
     def is_superuser(self, toshi_id):
         return 'superusers' in config and \
             toshi_id in config['superusers']
 
+    async def resolve_categories(self, categories):
+        """Maps a list of category ids and tags to category ids, raising
+        a 400 error if any of them don't exist"""
+
+        if not isinstance(categories, list) or not all(
+                isinstance(c, (int, str)) and not isinstance(c, bool) for c in categories):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid Categories'}]})
+
+        rows = await self.db.fetch(
+            "SELECT category_id, tag FROM categories WHERE category_id = ANY($1) OR tag = ANY($2)",
+            [c for c in categories if isinstance(c, int)],
+            [c for c in categories if isinstance(c, str)])
+        resolved = {}
+        for row in rows:
+            resolved[row['category_id']] = row['category_id']
+            resolved[row['tag']] = row['category_id']
+        invalid = [c for c in categories if c not in resolved]
+        if invalid:
+            raise JSONHTTPError(400, body={'errors': {
+                'id': 'bad_arguments',
+                'message': "Invalid Categor{}: {}".format(
+                    'ies' if len(invalid) > 1 else 'y',
+                    ", ".join([str(c) for c in invalid]))}})
+        return resolved
+
+    async def replace_app_categories(self, app_categories):
+        """Sets the categories of all the apps in the given dict of toshi_id
+        to category ids with a single statement, removing any categories
+        not in the new lists"""
+
+        toshi_ids = list(app_categories.keys())
+        pairs = [(toshi_id, category_id) for toshi_id, category_ids in app_categories.items()
+                 for category_id in set(category_ids)]
+        await self.db.execute(
+            "WITH target AS ("
+            "SELECT * FROM UNNEST($2::VARCHAR[], $3::INTEGER[]) AS t (toshi_id, category_id)"
+            "), removed AS ("
+            "DELETE FROM app_categories WHERE toshi_id = ANY($1) AND NOT EXISTS ("
+            "SELECT 1 FROM target "
+            "WHERE target.toshi_id = app_categories.toshi_id AND target.category_id = app_categories.category_id)"
+            ") "
+            "INSERT INTO app_categories (category_id, toshi_id) "
+            "SELECT category_id, toshi_id FROM target "
+            "ON CONFLICT DO NOTHING",
+            toshi_ids, [pair[0] for pair in pairs], [pair[1] for pair in pairs])
+
+    def get_expected_version(self, toshi_id, payload=None):
+        """Returns the version of the user the update was based on, given by
+        the `expected_version` field or the `If-Match` header, or None if
+        the update isn't conditional"""
+
+        if payload is not None and 'expected_version' in payload:
+            version = payload.pop('expected_version')
+            if isinstance(version, bool) or not isinstance(version, int):
+                raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid expected_version'}]})
+            return version
+
+        if_match = self.request.headers.get('If-Match')
+        if if_match is None or if_match.strip() == '*':
+            return None
+        # etags created by `user_etag`, ignoring the fields of sparse fieldsets.
+        # If-Match uses the strong comparison, so weak etags never match
+        match = regex.match(r'^"(0x[a-fA-F0-9]{40})-([0-9]+)(?:-[a-z_.]+)?"$', if_match.strip())
+        if match is None or match.group(1).lower() != toshi_id:
+            raise JSONHTTPError(412, body={'errors': [{'id': 'version_conflict', 'message': 'The user has been modified'}]})
+        return int(match.group(2))
+
+    async def raise_update_failed(self, toshi_id):
+        """Raises the error for a conditional update that didn't match the user"""
+
+        version = await self.db.fetchval("SELECT version FROM users WHERE toshi_id = $1", toshi_id)
+        if version is None:
+            raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
+        raise JSONHTTPError(412, body={'errors': [{'id': 'version_conflict', 'message': 'The user has been modified'}]})
+
     async def update_user(self, toshi_id):
 
         try:
@@ -188,14 +748,22 @@ class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
         except:
             raise JSONHTTPError(400, body={'errors': [{'id': 'bad_data', 'message': 'Error decoding data. Expected JSON content'}]})
 
+        expected_version = self.get_expected_version(toshi_id, payload)
+
         async with self.db:
 
-            # make sure a user with the given toshi_id exists
-            user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
-            categories = await self.db.fetch("SELECT category_id FROM app_categories WHERE toshi_id = $1 ORDER BY category_id", toshi_id)
-            categories = [row['category_id'] for row in categories]
-            if user is None:
-                raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
+            if expected_version is None:
+                # make sure a user with the given toshi_id exists
+                user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
+                if user is None:
+                    raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
+            else:
+                # the update only succeeds if the user is at the expected version,
+                # so all the given values are written without reading the user first
+                user = None
+
+            def changed(key, column=None):
+                return user is None or payload[key] != user[column or key]
 
             # backwards compat
             if 'custom' in payload:
@@ -212,111 +780,107 @@ class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
             if not any(x in payload for x in ['username', 'about', 'name', 'avatar', 'payment_address', 'is_app', 'location', 'public', 'categories']):
                 raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
 
-            if 'username' in payload and user['username'] != payload['username']:
+            # validate the whole payload before making any changes
+            updates = OrderedDict()
+            updated_categories = None
+            public_follows_app = False
+
+            if 'username' in payload and changed('username'):
                 username = payload['username']
                 if not validate_username(username):
                     raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_username', 'message': 'Invalid Username'}]})
+                # uniqueness is checked by the update
+                updates['username'] = username
 
-                # check if this is simply the same username with a different case
-                if user['username'].lower() != username.lower():
-                    # make sure the username isn't used by a different user
-                    row = await self.db.fetchrow("SELECT * FROM users WHERE lower(username) = lower($1)", username)
-                    if row is not None:
-                        raise JSONHTTPError(400, body={'errors': [{'id': 'username_taken', 'message': 'Username Taken'}]})
-
-                await self.db.execute("UPDATE users SET username = $1 WHERE toshi_id = $2", username, toshi_id)
-
-            if 'payment_address' in payload and payload['payment_address'] != user['payment_address']:
+            if 'payment_address' in payload and changed('payment_address'):
                 payment_address = payload['payment_address']
                 if not validate_address(payment_address):
                     raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_payment_address', 'message': 'Invalid Payment Address'}]})
-                await self.db.execute("UPDATE users SET payment_address = $1 WHERE toshi_id = $2", payment_address, toshi_id)
+                updates['payment_address'] = payment_address
 
-            if 'is_app' in payload and payload['is_app'] != user['is_app']:
+            if 'is_app' in payload and changed('is_app'):
                 is_app = parse_boolean(payload['is_app'])
                 if not isinstance(is_app, bool):
                     raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
-                if config['general'].getboolean('apps_public_by_default') and 'public' not in payload:
-                    payload['public'] = is_app
-                await self.db.execute("UPDATE users SET is_app = $1 WHERE toshi_id = $2", is_app, toshi_id)
-
-            if 'categories' in payload and payload['categories'] != categories:
-                updated_categories = await self.db.fetch(
-                    "SELECT category_id, tag FROM categories WHERE category_id = ANY($1) OR tag = ANY($2)",
-                    [c for c in payload['categories'] if isinstance(c, int)],
-                    [c for c in payload['categories'] if isinstance(c, str)])
-                if len(updated_categories) != len(payload['categories']):
-                    for cat in updated_categories:
-                        if cat['category_id'] in payload['categories']:
-                            payload['categories'].remove(cat['category_id'])
-                        if cat['tag'] in payload['categories']:
-                            payload['categories'].remove(cat['tag'])
-                    raise JSONHTTPError(400, body={'errors': {
-                        'id': 'bad_arguments',
-                        'message': "Invalid Categor{}: {}".format(
-                            'ies' if len(payload['categories']) > 1 else 'y',
-                            ", ".join([str(c) for c in payload['categories']]))}})
-                updated_categories = [c['category_id'] for c in updated_categories]
-                removed = set(categories).difference(set(updated_categories))
-                added = set(updated_categories).difference(set(categories))
-                for category_id in removed:
-                    await self.db.execute("DELETE FROM app_categories WHERE category_id = $1 AND toshi_id = $2", category_id, toshi_id)
-                for category_id in added:
-                    try:
-                        await self.db.execute("INSERT INTO app_categories VALUES ($1, $2) ON CONFLICT DO NOTHING",
-                                              category_id, toshi_id)
-                    except asyncpg.exceptions.ForeignKeyViolationError:
-                        raise JSONHTTPError(400, body={'errors': {'id': 'bad_arguments', 'message': "Invalid Category ID: {}".format(category_id)}})
-
-            if 'public' in payload and payload['public'] != user['is_public']:
+                # apps only become public by default when is_app is changed,
+                # which is checked by the update as the user may not be read
+                public_follows_app = config['general'].getboolean('apps_public_by_default') and 'public' not in payload
+                updates['is_app'] = is_app
+
+            if 'categories' in payload and (user is None or payload['categories'] != list(user['category_ids'] or [])):
+                resolved = await self.resolve_categories(payload['categories'])
+                updated_categories = [resolved[c] for c in payload['categories']]
+                if user is not None and set(updated_categories) == set(user['category_ids'] or []):
+                    updated_categories = None
+
+            if 'public' in payload and changed('public', 'is_public'):
                 is_public = parse_boolean(payload['public'])
                 if not isinstance(is_public, bool):
                     raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
-                await self.db.execute("UPDATE users SET is_public = $1, went_public = $2 WHERE toshi_id = $3",
-                                      is_public, datetime.datetime.utcnow() if is_public else None, toshi_id)
-
-            if 'name' in payload and payload['name'] != user['name']:
-                name = payload['name']
-                if not isinstance(name, str):
-                    raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid Name'}]})
-                await self.db.execute("UPDATE users SET name = $1 WHERE toshi_id = $2", name, toshi_id)
-
-            if 'avatar' in payload and payload['avatar'] != user['avatar']:
-                avatar = payload['avatar']
-                if not isinstance(avatar, str):
-                    raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid Avatar'}]})
-                await self.db.execute("UPDATE users SET avatar = $1 WHERE toshi_id = $2", avatar, toshi_id)
-
-            if 'about' in payload and payload['about'] != user['about']:
-                about = payload['about']
-                if not isinstance(about, str):
-                    raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid About'}]})
-                await self.db.execute("UPDATE users SET about = $1 WHERE toshi_id = $2", about, toshi_id)
-
-            if 'location' in payload and payload['location'] != user['location']:
-                location = payload['location']
-                if not isinstance(location, str):
-                    raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid Location'}]})
-                await self.db.execute("UPDATE users SET location = $1 WHERE toshi_id = $2", location, toshi_id)
-
-            if user['active'] is False:
-                # mark users as active if their data has been accessed
-                await self.db.execute("UPDATE users SET active = true WHERE toshi_id = $1", toshi_id)
+                updates['is_public'] = is_public
+
+            for key, message in [('name', 'Invalid Name'), ('avatar', 'Invalid Avatar'),
+                                 ('about', 'Invalid About'), ('location', 'Invalid Location')]:
+                if key in payload and changed(key):
+                    if not isinstance(payload[key], str):
+                        raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': message}]})
+                    updates[key] = payload[key]
 
-            user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
+            if user is None or user['active'] is False:
+                # mark users as active if their data has been accessed
+                updates['active'] = True
+
+            if updates:
+                args = [toshi_id]
+                assignments = []
+                for column, value in updates.items():
+                    args.append(value)
+                    assignments.append("{} = ${}".format(column, len(args)))
+                    if column == 'is_app' and public_follows_app:
+                        is_public = "CASE WHEN is_app IS DISTINCT FROM ${0} THEN ${0} ELSE is_public END".format(len(args))
+                        assignments.append("is_public = {}".format(is_public))
+                    elif column == 'is_public':
+                        is_public = "${}".format(len(args))
+                    else:
+                        continue
+                    # only changes when the user's public flag changes
+                    assignments.append(
+                        "went_public = CASE WHEN is_public IS NOT DISTINCT FROM {0} THEN went_public "
+                        "WHEN {0} THEN (now() AT TIME ZONE 'utc') END".format(is_public))
+                sql = "UPDATE users SET {} WHERE toshi_id = $1".format(", ".join(assignments))
+                if expected_version is not None:
+                    args.append(expected_version)
+                    sql += " AND version = ${}".format(len(args))
+                try:
+                    user = await self.db.fetchrow(sql + " RETURNING *", *args)
+                except asyncpg.exceptions.UniqueViolationError:
+                    raise JSONHTTPError(400, body={'errors': [{'id': 'username_taken', 'message': 'Username Taken'}]})
+                if user is None:
+                    await self.raise_update_failed(toshi_id)
+
+            if updated_categories is not None:
+                await self.replace_app_categories({toshi_id: updated_categories})
+                # the category triggers have updated the user's row
+                user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
             await self.db.commit()
 
+        await self.invalidate_profile(toshi_id, user['username'])
+        self.set_header('Etag', user_etag(user))
         self.write(user_row_for_json(self.request, user))
         self.track(toshi_id, "Edited profile")
 
     async def update_user_avatar(self, toshi_id):
 
+        expected_version = self.get_expected_version(toshi_id)
+
         # make sure a user with the given address exists
         async with self.db:
-            user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
+            user = await self.db.fetchrow("SELECT version FROM users WHERE toshi_id = $1", toshi_id)
 
         if user is None:
             raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
+        if expected_version is not None and user['version'] != expected_version:
+            raise JSONHTTPError(412, body={'errors': [{'id': 'version_conflict', 'message': 'The user has been modified'}]})
 
         files = self.request.files.values()
         if len(files) != 1:
@@ -328,34 +892,79 @@ class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
         data = file[0]['body']
         mime_type = file[0]['content_type']
 
-        data, cache_hash, format = await self.run_in_executor(process_image, data, mime_type)
+        if len(data) > MAX_AVATAR_SIZE:
+            raise JSONHTTPError(413, body={'errors': [{'id': 'bad_arguments', 'message': 'Image too large'}]})
+        validate_avatar_header(data, mime_type, complete=True)
+
+        await self.store_user_avatar(toshi_id, data, mime_type, expected_version)
+
+    async def store_user_avatar(self, toshi_id, data, mime_type, expected_version=None):
+
+        try:
+            renditions, cache_hash, format = await self.run_image_job(process_image, data, mime_type)
+        except ValueError as e:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': str(e)}]})
 
-        boto_key = "public/avatar/{}_{}.{}".format(toshi_id, cache_hash[:AVATAR_URL_HASH_LENGTH], 'jpg' if format == 'JPEG' else 'png')
         async with self.boto:
-            await self.boto.put_object(key=boto_key, body=data)
-            avatar_url = self.boto.url_for_object(boto_key)
+            await asyncio.gather(*[self.boto.put_object(key=avatar_key(toshi_id, cache_hash, rendition_format, size), body=data)
+                                   for (rendition_format, size), data in renditions.items()])
+            avatar_url = self.boto.url_for_object(avatar_key(toshi_id, cache_hash, format))
 
         async with self.db:
-            await self.db.execute("UPDATE users SET avatar = $1 WHERE toshi_id = $2", avatar_url, toshi_id)
-            user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
+            user = await self.db.fetchrow("UPDATE users SET avatar = $1 WHERE toshi_id = $2 AND ($3::BIGINT IS NULL OR version = $3) "
+                                          "RETURNING *", avatar_url, toshi_id, expected_version)
+            if user is None:
+                await self.raise_update_failed(toshi_id)
+            # the avatar endpoint only redirects to renditions that exist
+            await self.db.execute("INSERT INTO avatar_renditions (toshi_id, hash, formats) VALUES ($1, $2, $3) "
+                                  "ON CONFLICT (toshi_id, hash) DO UPDATE SET formats = EXCLUDED.formats",
+                                  toshi_id, cache_hash[:AVATAR_URL_HASH_LENGTH],
+                                  sorted(set(rendition_format for rendition_format, _ in renditions.keys())))
             await self.db.commit()
 
+        await self.invalidate_profile(toshi_id)
+        self.set_header('Etag', user_etag(user))
         self.write(user_row_for_json(self.request, user))
         self.track(toshi_id, "Updated avatar")
 
 
 class UserCreationHandler(UserMixin, DatabaseMixin, BaseHandler):
 
+    async def replay_registration(self, toshi_id, idempotency_key, request_hash):
+        """Writes the stored response if the address has been registered by
+        the same request, raising an error if it was registered by a
+        different one. Returns False if the address isn't registered"""
+
+        row = await self.db.fetchrow("SELECT users.toshi_id, r.idempotency_key, r.request_hash, r.response "
+                                     "FROM users LEFT JOIN user_registrations r ON r.toshi_id = users.toshi_id "
+                                     "WHERE users.toshi_id = $1", toshi_id)
+        if row is None:
+            return False
+        if row['response'] is not None and row['idempotency_key'] == idempotency_key:
+            if row['request_hash'] == request_hash:
+                # a retry of the registration that created the user
+                self.set_header("Content-Type", "application/json; charset=UTF-8")
+                self.set_header("Idempotent-Replayed", "true")
+                self.write(row['response'])
+                return True
+            if idempotency_key is not None:
+                raise JSONHTTPError(400, body={'errors': [{'id': 'idempotency_key_reused', 'message': 'The Idempotency-Key was used for a different registration'}]})
+        raise JSONHTTPError(400, body={'errors': [{'id': 'already_registered', 'message': 'The provided toshi id address is already registered'}]})
+
     async def post(self):
 
         toshi_id = self.verify_request()
         payload = self.json
 
+        request_hash = registration_request_hash(payload)
+        idempotency_key = self.request.headers.get('Idempotency-Key')
+        if idempotency_key is not None and not 0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid Idempotency-Key'}]})
+
         # check if the address has already registered a username
         async with self.db:
-            row = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
-        if row is not None:
-            raise JSONHTTPError(400, body={'errors': [{'id': 'already_registered', 'message': 'The provided toshi id address is already registered'}]})
+            if await self.replay_registration(toshi_id, idempotency_key, request_hash):
+                return
 
         if 'username' in payload:
 
@@ -365,20 +974,17 @@ class UserCreationHandler(UserMixin, DatabaseMixin, BaseHandler):
                 raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_username', 'message': 'Invalid Username'}]})
 
             # check username doesn't already exist
-            async with self.db:
-                row = await self.db.fetchrow("SELECT * FROM users WHERE lower(username) = lower($1)", username)
-            if row is not None:
+            if await self.is_username_taken(username):
+                # it may have been taken by a concurrent retry of this request
+                async with self.db:
+                    if await self.replay_registration(toshi_id, idempotency_key, request_hash):
+                        return
                 raise JSONHTTPError(400, body={'errors': [{'id': 'username_taken', 'message': 'Username Taken'}]})
 
         else:
 
-            # generate temporary username
-            for i in itertools.count():
-                username = generate_username(MIN_AUTOID_LENGTH + i)
-                async with self.db:
-                    row = await self.db.fetchrow("SELECT * FROM users WHERE lower(username) = lower($1)", username)
-                if row is None:
-                    break
+            # a temporary username is allocated when the user is inserted
+            username = None
 
         if 'payment_address' in payload:
             payment_address = payload['payment_address']
@@ -432,24 +1038,48 @@ class UserCreationHandler(UserMixin, DatabaseMixin, BaseHandler):
         else:
             location = None
 
-        identicon_address = payment_address or toshi_id
-        identicon_data = await self.run_in_executor(create_identitcon, identicon_address)
-        key = "public/identicon/{}.png".format(identicon_address)
-        async with self.boto:
-            await self.boto.put_object(key=key, body=identicon_data)
-            if avatar is None:
-                avatar = self.boto.url_for_object(key)
+        if avatar is None:
+            # the identicon is rendered on request by the identicon endpoint
+            avatar = "/identicon/{}.png".format(payment_address)
 
         async with self.db:
-            await self.db.execute("INSERT INTO users "
-                                  "(username, toshi_id, payment_address, name, avatar, is_app, about, location, is_public) "
-                                  "VALUES "
-                                  "($1, $2, $3, $4, $5, $6, $7, $8, $9)",
-                                  username, toshi_id, payment_address, name, avatar, is_app, about, location, is_public)
-            user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
+            while True:
+                if 'username' in payload:
+                    insert_username = username
+                else:
+                    insert_username = autoid_username(await self.db.fetchval("SELECT nextval('users_autoid_seq')"))
+                user = await self.db.fetchrow("INSERT INTO users "
+                                              "(username, toshi_id, payment_address, name, avatar, is_app, about, location, is_public) "
+                                              "VALUES "
+                                              "($1, $2, $3, $4, $5, $6, $7, $8, $9) "
+                                              "ON CONFLICT DO NOTHING "
+                                              "RETURNING *",
+                                              insert_username, toshi_id, payment_address, name, avatar, is_app, about, location, is_public)
+                if user is not None:
+                    break
+                # the user or username was created by a concurrent request
+                # since it was checked. the insert waited for that request
+                # to commit, so if it was a retry of this one its response
+                # can be replayed
+                if await self.replay_registration(toshi_id, idempotency_key, request_hash):
+                    return
+                if 'username' in payload:
+                    raise JSONHTTPError(400, body={'errors': [{'id': 'username_taken', 'message': 'Username Taken'}]})
+                # otherwise someone picked the allocated username themselves, so try the next one
+            response = json_encode(user_row_for_json(self.request, user))
+            await self.db.execute("INSERT INTO user_registrations (toshi_id, idempotency_key, request_hash, response) "
+                                  "VALUES ($1, $2, $3, $4) "
+                                  "ON CONFLICT (toshi_id) DO UPDATE "
+                                  "SET idempotency_key = EXCLUDED.idempotency_key, request_hash = EXCLUDED.request_hash, "
+                                  "response = EXCLUDED.response, created = EXCLUDED.created",
+                                  toshi_id, idempotency_key, request_hash, response)
             await self.db.commit()
+        username = user['username']
 
-        self.write(user_row_for_json(self.request, user))
+        # make sure the new user isn't still cached as missing
+        await self.invalidate_profile(toshi_id, username)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(response)
         self.people_set(toshi_id, {"distinct_id": analytics_encode_id(toshi_id)})
         self.track(toshi_id, "Created account")
 
@@ -474,50 +1104,140 @@ class UserCreationHandler(UserMixin, DatabaseMixin, BaseHandler):
         else:
             return self.update_user(toshi_id)
 
-class UserHandler(UserMixin, DatabaseMixin, BaseHandler):
+@stream_request_body
+class AvatarUploadHandler(UserMixin, DatabaseMixin, BaseHandler):
+    """Updates the signer's avatar from a raw png or jpeg request body.
+
+    The body is streamed rather than buffered by tornado, so uploads over
+    the size limit and data that doesn't start with a supported image
+    header are rejected before the rest of the body is read into memory."""
+
+    def prepare(self):
+        self._chunks = []
+        # the start of the upload, kept until its header has been validated
+        self._header = bytearray()
+        self._size = 0
+        self._header_valid = False
+        self._error = None
+
+        self.mime_type = self.request.headers.get('Content-Type', '').split(';')[0].strip()
+        if self.mime_type not in ['image/jpeg', 'image/png']:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_data', 'message': 'Expected image/jpeg or image/png'}]})
+        content_length = self.request.headers.get('Content-Length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > MAX_AVATAR_SIZE:
+            raise JSONHTTPError(413, body={'errors': [{'id': 'bad_arguments', 'message': 'Image too large'}]})
+        self.request.connection.set_max_body_size(MAX_AVATAR_SIZE)
+
+    def data_received(self, chunk):
+        if self._error is not None:
+            # drop the rest of a rejected upload
+            return
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        if not self._header_valid:
+            if self._header:
+                self._header += chunk
+                header = self._header
+            else:
+                # the header is usually within the first chunk
+                header = chunk
+            try:
+                self._header_valid = validate_avatar_header(header, self.mime_type)
+            except JSONHTTPError as e:
+                self._error = e
+                self._chunks = []
+                self._header = None
+                return
+            if self._header_valid:
+                self._header = None
+            elif header is chunk:
+                self._header += chunk
+
+    async def put(self):
+
+        if self._error is not None:
+            raise self._error
+
+        data = self._chunks[0] if len(self._chunks) == 1 else b''.join(self._chunks)
+        self._chunks = None
+        if not self._header_valid:
+            validate_avatar_header(data, self.mime_type, complete=True)
+
+        # request verification uses the buffered body
+        self.request.body = data
+        toshi_id = self.verify_request()
+        expected_version = self.get_expected_version(toshi_id)
+
+        async with self.db:
+            user = await self.db.fetchrow("SELECT version FROM users WHERE toshi_id = $1", toshi_id)
+        if user is None:
+            raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
+        if expected_version is not None and user['version'] != expected_version:
+            raise JSONHTTPError(412, body={'errors': [{'id': 'version_conflict', 'message': 'The user has been modified'}]})
+
+        await self.store_user_avatar(toshi_id, data, self.mime_type, expected_version)
+
+class UserHandler(UserMixin, UserETagMixin, UserJSONMixin, DatabaseMixin, BaseHandler):
 
     def __init__(self, *args, apps_only=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.apps_only = apps_only
 
-    async def get(self, username):
+    def is_visible(self, profile):
+        # the apps filter is applied here rather than in the query so
+        # apps and users share the same cache entries
+        return not self.apps_only or (profile['is_app'] is True and profile['blocked'] is False)
 
-        sql = ("SELECT users.*, array_agg(app_categories.category_id) AS category_ids, "
-               "array_agg(categories.tag) AS category_tags, "
-               "array_agg(category_names.name) AS category_names "
-               "FROM users LEFT JOIN app_categories "
-               "ON users.toshi_id = app_categories.toshi_id "
-               "LEFT JOIN category_names ON app_categories.category_id = category_names.category_id "
-               "AND category_names.language = $1 "
-               "LEFT JOIN categories ON app_categories.category_id = categories.category_id "
-               "WHERE ")
-        args = ['en']
+    async def get(self, username):
 
         # check if ethereum address is given
         if regex.match('^0x[a-fA-F0-9]{40}$', username):
-            sql += "users.toshi_id = $2"
-            args.append(username)
+            where = "users.toshi_id = $1"
+            key = username
 
         # otherwise verify that username is valid
         elif not regex.match('^[a-zA-Z][a-zA-Z0-9_]{2,59}$', username):
             raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_username', 'message': 'Invalid Username'}]})
         else:
-            sql += "lower(users.username) = lower($2)"
-            args.append(username)
+            where = "lower(users.username) = lower($1)"
+            key = username.lower()
 
-        if self.apps_only:
-            sql += " AND users.is_app = $3 AND users.blocked = $4"
-            args.extend([True, False])
+        fields = self.get_user_fields()
+        profile = await self.get_cached_profile(username)
 
-        sql += " GROUP BY users.toshi_id"
+        if profile is None and self.is_known_missing(key):
+            raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
 
-        async with self.db:
-            row = await self.db.fetchrow(sql, *args)
+        if profile is None and 'If-None-Match' in self.request.headers:
+            # check the user's current version without loading the full profile
+            async with self.db:
+                row = await self.db.fetchrow("SELECT toshi_id, version, is_app, blocked FROM users WHERE {}".format(where),
+                                             username)
+            if row is not None and self.is_visible(row) and self.check_user_etag(row, fields):
+                self.set_status(304)
+                return
+
+        if profile is None:
+            if fields is not None and not self.profile_cache.enabled:
+                # nothing is cached, so only load the requested fields
+                async with self.db:
+                    profile = await self.db.fetchrow("SELECT {} FROM users WHERE {}".format(
+                        user_columns(fields, 'toshi_id', 'version', 'is_app', 'blocked'), where), username)
+            else:
+                profile = await self.load_profile(key, "SELECT * FROM users WHERE {}".format(where), username)
 
-        if row is None:
+        if profile is None:
+            self.negative_profile_cache.add(key)
+            raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
+
+        if not self.is_visible(profile):
             raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
 
-        self.write(user_row_for_json(self.request, row))
+        if self.check_user_etag(profile, fields):
+            self.set_status(304)
+            return
+
+        self.write_user_json(profile, fields)
 
     async def put(self, username):
 
@@ -555,7 +1275,19 @@ class UserHandler(UserMixin, DatabaseMixin, BaseHandler):
             return await self.update_user(address_to_update)
 
 
-class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
+class UsernameAvailabilityHandler(UserMixin, DatabaseMixin, BaseHandler):
+
+    async def get(self, username):
+
+        if not validate_username(username):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_username', 'message': 'Invalid Username'}]})
+
+        self.write({
+            'username': username,
+            'available': not await self.is_username_taken(username)
+        })
+
+class SearchUserHandler(UserJSONMixin, AnalyticsMixin, DatabaseMixin, BaseHandler):
 
     def __init__(self, *args, force_featured=None, force_apps=None, **kwargs):
         super().__init__(*args, **kwargs)
@@ -577,6 +1309,7 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
         except ValueError:
             raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
 
+        fields = self.get_user_fields()
         query = self.get_query_argument('query', None)
         public = parse_boolean(self.get_query_argument('public', None))
         payment_address = self.get_query_argument('payment_address', None)
@@ -631,54 +1364,45 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
             check_connected = False
 
         if query is None:
-            sql = ("SELECT users.*, array_agg(app_categories.category_id) AS category_ids, "
-                   "array_agg(categories.tag) AS category_tags, "
-                   "array_agg(category_names.name) AS category_names "
-                   "FROM users LEFT JOIN app_categories "
-                   "ON users.toshi_id = app_categories.toshi_id "
-                   "LEFT JOIN category_names ON app_categories.category_id = category_names.category_id "
-                   "AND category_names.language = $1 "
-                   "LEFT JOIN categories ON app_categories.category_id = categories.category_id ")
-            sql_args = ['en']
-            if check_connected:
-                sql += "INNER JOIN websocket_sessions ON users.toshi_id = websocket_sessions.toshi_id "
+            sql_args = []
+            where_q = []
             if payment_address:
-                sql += "WHERE active = true AND payment_address = ${} ".format(len(sql_args) + 1)
+                where_q.append("payment_address = ${}".format(len(sql_args) + 1))
                 sql_args.append(payment_address)
                 if apps is not None:
-                    sql += "AND is_app = ${} AND blocked = false ".format(len(sql_args) + 1)
+                    where_q.append("is_app = ${} AND blocked = false".format(len(sql_args) + 1))
                     sql_args.append(apps)
                     if featured is not None:
-                        sql += "AND featured = ${} ".format(len(sql_args) + 1)
+                        where_q.append("featured = ${}".format(len(sql_args) + 1))
                         sql_args.append(featured)
-                sql += "GROUP BY users.toshi_id "
-                if apps is not None and len(categories) > 0:
-                    sql += "HAVING array_agg(app_categories.category_id) @> ${} ".format(len(sql_args) + 1)
-                    sql_args.append(categories)
-                if recent:
-                    sql += "ORDER BY payment_address, created DESC, name, username "
-                else:
-                    sql += "ORDER BY payment_address, name, username "
             else:
                 if apps is not None:
-                    sql += "WHERE is_app = ${} AND blocked = false ".format(len(sql_args) + 1)
+                    where_q.append("is_app = ${} AND blocked = false".format(len(sql_args) + 1))
                     sql_args.append(apps)
                     if featured is not None:
-                        sql += "AND featured = ${} ".format(len(sql_args) + 1)
+                        where_q.append("featured = ${}".format(len(sql_args) + 1))
                         sql_args.append(featured)
                     if public is not None:
-                        sql += "AND is_public = ${} ".format(len(sql_args) + 1)
+                        where_q.append("is_public = ${}".format(len(sql_args) + 1))
                         sql_args.append(public)
                 elif public is not None:
-                    sql += "WHERE is_public = ${} ".format(len(sql_args) + 1)
+                    where_q.append("is_public = ${}".format(len(sql_args) + 1))
                     sql_args.append(public)
                     if apps is None or apps is False:
-                        sql += "AND is_app = FALSE "
-                sql += "AND active = true "
-                sql += "GROUP BY users.toshi_id "
-                if apps is not None and len(categories) > 0:
-                    sql += "HAVING array_agg(app_categories.category_id) @> ${} ".format(len(sql_args) + 1)
-                    sql_args.append(categories)
+                        where_q.append("is_app = FALSE")
+            if apps is not None and len(categories) > 0:
+                where_q.append("category_ids @> ${}".format(len(sql_args) + 1))
+                sql_args.append(categories)
+            if check_connected:
+                where_q.append("EXISTS (SELECT 1 FROM websocket_sessions WHERE websocket_sessions.toshi_id = users.toshi_id)")
+            where_q.append("active = true")
+            sql = "SELECT {} FROM users WHERE {} ".format(user_columns(fields), " AND ".join(where_q))
+            if payment_address:
+                if recent:
+                    sql += "ORDER BY payment_address, created DESC, name, username "
+                else:
+                    sql += "ORDER BY payment_address, name, username "
+            else:
                 sql += "ORDER BY "
                 if top:
                     if recent:
@@ -702,7 +1426,7 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
             query = ''.join([" " if c in PUNCTUATION else c for c in query])
             # split words and add in partial matching flags
             query = '|'.join(['{}:*'.format(word) for word in query.split(' ') if word])
-            sql_args = ['en', offset, limit, query]
+            sql_args = [offset, limit, query]
             where_q = []
             if payment_address:
                 where_q.append("payment_address = ${}".format(len(sql_args) + 1))
@@ -716,9 +1440,8 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
                 where_q.append("blocked = ${}".format(len(sql_args) + 1))
                 sql_args.append(False)
                 if len(categories) > 0:
-                    for category in categories:
-                        where_q.append("app_categories.category_id = ${}".format(len(sql_args) + 1))
-                        sql_args.append(category)
+                    where_q.append("category_ids @> ${}".format(len(sql_args) + 1))
+                    sql_args.append(categories)
                 if public is not None:
                     where_q.append("is_public = ${}".format(len(sql_args) + 1))
                     sql_args.append(public)
@@ -729,28 +1452,13 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
                     sql_args.append(False)
                 where_q.append("is_public = ${}".format(len(sql_args) + 1))
                 sql_args.append(public)
+            if check_connected:
+                where_q.append("EXISTS (SELECT 1 FROM websocket_sessions WHERE websocket_sessions.toshi_id = users.toshi_id)")
             where_q.append("active = true")
             where_q = " AND {}".format(" AND ".join(where_q)) if where_q else ""
-            sql = ("SELECT * FROM "
-                   "(SELECT users.*, array_agg(app_categories.category_id) AS category_ids, "
-                   "array_agg(categories.tag) AS category_tags, "
-                   "array_agg(category_names.name) AS category_names "
-                   "FROM users {}"
-                   "LEFT JOIN app_categories ON users.toshi_id = app_categories.toshi_id "
-                   "LEFT JOIN category_names ON app_categories.category_id = category_names.category_id "
-                   "AND category_names.language = $1 "
-                   "LEFT JOIN categories ON app_categories.category_id = categories.category_id "
-                   ", TO_TSQUERY($4) AS q "
-                   "WHERE (tsv @@ q){} "
-                   "GROUP BY users.toshi_id ").format(
-                       "INNER JOIN websocket_sessions ON users.toshi_id = websocket_sessions.toshi_id "
-                       if check_connected else "",
-                       where_q)
-            if apps is not None and len(categories) > 0:
-                sql += "HAVING array_agg(app_categories.category_id) @> ${} ".format(len(sql_args) + 1)
-                sql_args.append(categories)
-            sql += ") AS t1 "
-            sql += "ORDER BY TS_RANK_CD(t1.tsv, TO_TSQUERY($4)) DESC, "
+            sql = ("SELECT {} FROM users, TO_TSQUERY($3) AS q "
+                   "WHERE (tsv @@ q){} ").format(user_columns(fields), where_q)
+            sql += "ORDER BY TS_RANK_CD(tsv, q) DESC, "
             if top:
                 if recent:
                     if public:
@@ -766,11 +1474,10 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
                     sql += "created DESC, name, COALESCE(reputation_score, 2.01) DESC NULLS LAST, review_count DESC, username "
             else:
                 sql += "name, COALESCE(reputation_score, 2.01) DESC NULLS LAST, review_count DESC, username "
-            sql += "OFFSET $2 LIMIT $3 "
+            sql += "OFFSET $1 LIMIT $2 "
 
         async with self.db:
             rows = await self.db.fetch(sql, *sql_args)
-        results = [user_row_for_json(self.request, row) for row in rows]
         querystring = 'query={}'.format(query if query else '')
         if apps is not None:
             querystring += '&apps={}'.format('true' if apps else 'false')
@@ -784,13 +1491,10 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
             querystring += '&top={}'.format('true' if top else 'false')
         for category in categories:
             querystring += '&category={}'.format(category)
+        if fields is not None:
+            querystring += '&fields={}'.format(','.join(fields))
 
-        self.write({
-            'query': querystring,
-            'offset': offset,
-            'limit': limit,
-            'results': results
-        })
+        self.write_users_json(rows, fields, query=querystring, offset=offset, limit=limit)
 
         self.track(None, "Searched", {
             "query": query,
@@ -805,27 +1509,72 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
 
     async def list_users(self, toshi_ids):
 
-        sql = "SELECT u.* FROM users u JOIN (VALUES "
-        values = []
-        for i, toshi_id in enumerate(toshi_ids):
+        fields = self.get_user_fields()
+        for toshi_id in toshi_ids:
             if not validate_address(toshi_id):
                 raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
-            values.append("('{}', {}) ".format(toshi_id, i))
-            # in case this request is made with a lot of ids
-            # make sure we yield to other processes rather
-            # than taking up all resources on this
-            if i > 0 and i % 100 == 0:
-                await asyncio.sleep(0.001)
-        sql += ", ".join(values)
-        sql += ") AS v (toshi_id, ordering) ON u.toshi_id = v.toshi_id "
-        sql += "ORDER BY v.ordering"
 
         async with self.db:
-            rows = await self.db.fetch(sql)
+            rows = await self.db.fetch(
+                "SELECT {} FROM UNNEST($1::VARCHAR[]) WITH ORDINALITY AS v (toshi_id, ordering) "
+                "JOIN users ON users.toshi_id = v.toshi_id "
+                "ORDER BY v.ordering".format(user_columns(fields)),
+                toshi_ids)
 
-        self.write({
-            'results': [user_row_for_json(self.request, row) for row in rows]
-        })
+        self.write_users_json(rows, fields)
+
+    async def post(self):
+        """Looks up a batch of users given a list of usernames, toshi ids and
+        payment addresses. Each id resolves to at most one user, preferring
+        toshi ids over payment addresses, and results are returned in the
+        order of the ids that resolved them"""
+
+        payload = self.json
+        ids = payload.get('ids') if isinstance(payload, dict) else payload
+        if not isinstance(ids, list) or not all(isinstance(key, str) for key in ids):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Expected a list of ids'}]})
+
+        # dedupe while keeping the input order
+        ids = list(OrderedDict.fromkeys(key.lower() for key in ids))
+        if len(ids) > MAX_BATCH_LOOKUP_SIZE:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Too many ids, the maximum is {}'.format(MAX_BATCH_LOOKUP_SIZE)}]})
+        for key in ids:
+            if not validate_address(key) and not regex.match('^[a-z][a-z0-9_]{2,59}$', key):
+                raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid id: {}'.format(key)}]})
+
+        fields = self.get_user_fields()
+        extra_columns = ['toshi_id']
+        if self.force_apps:
+            extra_columns.extend(['is_app', 'blocked'])
+        if self.force_featured:
+            extra_columns.append('featured')
+
+        # the ids are passed as a single array so the statement is the same
+        # for every batch, the first branch of the lateral join that finds
+        # a user is used for each id
+        async with self.db:
+            rows = await self.db.fetch(
+                "SELECT {} FROM UNNEST($1::VARCHAR[]) WITH ORDINALITY AS v (key, ordering) "
+                "CROSS JOIN LATERAL ("
+                "(SELECT * FROM users WHERE toshi_id = v.key) "
+                "UNION ALL "
+                "(SELECT * FROM users WHERE lower(payment_address) = v.key ORDER BY created LIMIT 1) "
+                "UNION ALL "
+                "(SELECT * FROM users WHERE lower(username) = v.key) "
+                "LIMIT 1"
+                ") AS users "
+                "ORDER BY v.ordering".format(user_columns(fields, *extra_columns)),
+                ids)
+
+        results = OrderedDict()
+        for row in rows:
+            if self.force_apps and (row['is_app'] is not True or row['blocked'] is not False):
+                continue
+            if self.force_featured and row['featured'] is not True:
+                continue
+            results.setdefault(row['toshi_id'], row)
+
+        self.write_users_json(list(results.values()), fields)
 
 class SearchDappHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
 
@@ -839,11 +1588,19 @@ class SearchDappHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
         })
 
 
-class IdenticonHandler(DatabaseMixin, SimpleFileHandler):
+class ImageServiceStatsHandler(ImageServiceMixin, BaseHandler):
+
+    def get(self):
+        stats = self.image_service.stats()
+        stats['identicon_cache'] = self.identicon_cache.stats()
+        self.write(stats)
+
+class IdenticonHandler(ImageNegotiationMixin, ImageServiceMixin, SimpleFileHandler):
 
     FORMAT_MAP = {
         'PNG': 'image/png',
-        'JPEG': 'image/jpeg'
+        'JPEG': 'image/jpeg',
+        'WEBP': 'image/webp'
     }
 
     def head(self, address, format):
@@ -854,34 +1611,23 @@ class IdenticonHandler(DatabaseMixin, SimpleFileHandler):
         format = format.upper()
         if format == 'JPG':
             format = 'JPEG'
-        if format not in self.FORMAT_MAP.keys():
+        if format not in ['PNG', 'JPEG']:
             raise HTTPError(404)
+        format = self.negotiate_image_format(format)
 
-        identicon_pkey = "{}_identicon_{}".format(address, format)
-        async with self.db:
-            # add suffix to id for cached identicons
-            row = await self.db.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1", identicon_pkey)
+        # the etag only depends on the address and format, so conditional
+        # requests are answered without rendering anything
+        etag = "{}_{}_{}".format(address, format.lower(), IDENTICON_VERSION)
+        self.set_header('Etag', '"{}"'.format(etag))
+        if self.check_etag_header():
+            self.set_status(304)
+            return
 
-        if row is None:
-            data = blockies.create(address, size=8, scale=12, format=format.upper())
-            hasher = hashlib.md5()
-            hasher.update(data)
-            cache_hash = hasher.hexdigest()
-            async with self.db:
-                await self.db.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4) "
-                                      "ON CONFLICT (toshi_id, hash) DO UPDATE "
-                                      "SET img = EXCLUDED.img, format = EXCLUDED.format, last_modified = (now() AT TIME ZONE 'utc')",
-                                      identicon_pkey, data, cache_hash, format)
-                await self.db.commit()
-            last_modified = datetime.datetime.utcnow()
-        else:
-            data = row['img']
-            cache_hash = row['hash']
-            last_modified = row['last_modified']
-
-        await self.handle_file_response(data, self.FORMAT_MAP[format], cache_hash, last_modified)
+        data = await self.identicon_cache.get(address, format, self.run_image_job, create_identitcon, address, format)
+        last_modified = IDENTICON_EPOCH + datetime.timedelta(days=IDENTICON_VERSION - 1)
+        await self.handle_file_response(data, self.FORMAT_MAP[format], etag, last_modified)
 
-class AvatarHandler(DatabaseMixin, SimpleFileHandler):
+class AvatarHandler(ImageNegotiationMixin, ImageServiceMixin, BotoMixin, DatabaseMixin, SimpleFileHandler):
 
     def head(self, address, hash, format):
         return self.get(address, hash, format, include_body=False)
@@ -894,6 +1640,14 @@ class AvatarHandler(DatabaseMixin, SimpleFileHandler):
         if format == 'JPG':
             format = 'JPEG'
 
+        size = self.get_argument('size', None)
+        if size is not None:
+            if not size.isdigit() or int(size) not in AVATAR_SIZES:
+                raise HTTPError(404)
+            size = int(size)
+
+        output_format = self.negotiate_image_format(format)
+
         async with self.db:
             if hash is None:
                 row = await self.db.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1 AND format = $2 ORDER BY last_modified DESC",
@@ -904,11 +1658,35 @@ class AvatarHandler(DatabaseMixin, SimpleFileHandler):
                     .format(AVATAR_URL_HASH_LENGTH),
                     address, format, hash)
 
+        if row is None and hash is not None and (size is not None or output_format != format):
+            async with self.db:
+                formats = await self.db.fetchval("SELECT formats FROM avatar_renditions WHERE toshi_id = $1 AND hash = $2",
+                                                 address.lower(), hash.lower())
+            if formats is None:
+                # avatars uploaded to S3 before the renditions were added
+                # only exist at full size in the uploaded format
+                key = avatar_key(address.lower(), hash.lower(), format)
+            else:
+                key = avatar_key(address.lower(), hash.lower(), output_format if output_format in formats else format,
+                                 size or AVATAR_SIZE)
+            async with self.boto:
+                return self.redirect(self.boto.url_for_object(key))
+
         if row is None or row['format'] != format:
             raise HTTPError(404)
 
-        await self.handle_file_response(row['img'], "image/{}".format(format.lower()),
-                                        row['hash'], row['last_modified'])
+        if (size is None or size == AVATAR_SIZE) and output_format == format:
+            await self.handle_file_response(row['img'], "image/{}".format(format.lower()),
+                                            row['hash'], row['last_modified'])
+        else:
+            # avatars stored in the database predate the renditions, so they're converted on request
+            size = size or AVATAR_SIZE
+            data = await self.run_image_job(resize_avatar, row['img'], size, output_format)
+            etag = "{}_{}".format(row['hash'], size)
+            if output_format != format:
+                etag += "_{}".format(output_format.lower())
+            await self.handle_file_response(data, "image/{}".format(output_format.lower()),
+                                            etag, row['last_modified'])
 
 
 class ReportHandler(RequestVerificationMixin, AnalyticsMixin, DatabaseMixin, BaseHandler):
@@ -960,7 +1738,127 @@ class CategoryHandler(DatabaseMixin, BaseHandler):
             ]
         })
 
-class ReputationUpdateHandler(RequestVerificationMixin, AnalyticsMixin, DatabaseMixin, BaseHandler):
+class AppCategoriesHandler(UserMixin, DatabaseMixin, BaseHandler):
+
+    async def put(self):
+        """Replaces the categories of many apps at once. Superuser only"""
+
+        request_address = self.verify_request()
+        if not self.is_superuser(request_address):
+            raise JSONHTTPError(401, body={'errors': [{'id': 'permission_denied', 'message': 'Permission Denied'}]})
+
+        payload = self.json
+        if isinstance(payload, dict):
+            payload = payload.get('apps')
+        if not isinstance(payload, list) or not all(
+                isinstance(app, dict) and isinstance(app.get('toshi_id'), str) and validate_address(app['toshi_id']) and
+                isinstance(app.get('categories'), list) and
+                all(isinstance(c, (int, str)) and not isinstance(c, bool) for c in app['categories'])
+                for app in payload):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Expected a list of toshi_ids and categories'}]})
+        if len(payload) > MAX_BULK_UPDATE_SIZE:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Too many apps, the maximum is {}'.format(MAX_BULK_UPDATE_SIZE)}]})
+
+        # later entries for the same app replace earlier ones
+        app_categories = OrderedDict((app['toshi_id'].lower(), app['categories']) for app in payload)
+
+        async with self.db:
+            resolved = await self.resolve_categories(list(set(c for categories in app_categories.values() for c in categories)))
+            rows = await self.db.fetch("SELECT toshi_id FROM users WHERE toshi_id = ANY($1)", list(app_categories.keys()))
+            missing = set(app_categories.keys()).difference(row['toshi_id'] for row in rows)
+            if missing:
+                raise JSONHTTPError(400, body={'errors': [{'id': 'not_found', 'message': 'Unknown toshi_ids: {}'.format(", ".join(sorted(missing)))}]})
+            await self.replace_app_categories(OrderedDict(
+                (toshi_id, [resolved[c] for c in categories]) for toshi_id, categories in app_categories.items()))
+            await self.db.commit()
+
+        await self.invalidate_profiles(list(app_categories.keys()))
+        self.set_status(204)
+
+class ModerationHandler(UserMixin, DatabaseMixin, BaseHandler):
+
+    async def post(self):
+        """Applies a list of featured/blocked/public patches in a single
+        transaction. Superuser only. Invalid patches are reported in the
+        results rather than failing the whole request"""
+
+        request_address = self.verify_request()
+        if not self.is_superuser(request_address):
+            raise JSONHTTPError(401, body={'errors': [{'id': 'permission_denied', 'message': 'Permission Denied'}]})
+
+        payload = self.json
+        if isinstance(payload, dict):
+            payload = payload.get('users')
+        if not isinstance(payload, list):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Expected a list of patches'}]})
+        if len(payload) > MAX_BULK_UPDATE_SIZE:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Too many patches, the maximum is {}'.format(MAX_BULK_UPDATE_SIZE)}]})
+
+        # one result per patch, in the order they were given
+        results = []
+        # toshi_id -> (featured, blocked, is_public)
+        patches = OrderedDict()
+        invalid = set()
+        for patch in payload:
+            toshi_id = patch.get('toshi_id') if isinstance(patch, dict) else None
+            if not isinstance(toshi_id, str) or not validate_address(toshi_id):
+                results.append({'toshi_id': toshi_id, 'status': 'error', 'message': 'Invalid Toshi ID'})
+                continue
+            toshi_id = toshi_id.lower()
+            try:
+                values = parse_moderation_patch(patch)
+            except ValueError as e:
+                invalid.add(toshi_id)
+                results.append({'toshi_id': toshi_id, 'status': 'error', 'message': str(e)})
+                continue
+            # later patches for the same user override earlier ones
+            previous = patches.get(toshi_id, (None, None, None))
+            patches[toshi_id] = tuple(value if value is not None else prev for value, prev in zip(values, previous))
+            # replaced with the updated values if the user exists
+            results.append({'toshi_id': toshi_id, 'status': 'not_found'})
+
+        # nothing is changed for users with any invalid patches
+        for toshi_id in invalid:
+            patches.pop(toshi_id, None)
+        for result in results:
+            if result['status'] == 'not_found' and result['toshi_id'] in invalid:
+                result.update(status='error', message='Another patch for the user is invalid')
+
+        if patches:
+            toshi_ids = list(patches.keys())
+            async with self.db:
+                rows = await self.db.fetch(
+                    "UPDATE users SET "
+                    "featured = COALESCE(p.featured, users.featured), "
+                    "blocked = COALESCE(p.blocked, users.blocked), "
+                    "is_public = COALESCE(p.is_public, users.is_public), "
+                    "went_public = CASE "
+                    "WHEN p.is_public IS NULL OR p.is_public IS NOT DISTINCT FROM users.is_public THEN users.went_public "
+                    "WHEN p.is_public THEN (now() AT TIME ZONE 'utc') "
+                    "ELSE NULL END "
+                    "FROM UNNEST($1::VARCHAR[], $2::BOOLEAN[], $3::BOOLEAN[], $4::BOOLEAN[]) AS p (toshi_id, featured, blocked, is_public) "
+                    "WHERE users.toshi_id = p.toshi_id "
+                    "RETURNING users.toshi_id, users.featured, users.blocked, users.is_public",
+                    toshi_ids,
+                    [patches[toshi_id][0] for toshi_id in toshi_ids],
+                    [patches[toshi_id][1] for toshi_id in toshi_ids],
+                    [patches[toshi_id][2] for toshi_id in toshi_ids])
+                await self.db.commit()
+
+            updated = {row['toshi_id']: {
+                'toshi_id': row['toshi_id'],
+                'status': 'updated',
+                'featured': row['featured'],
+                'blocked': row['blocked'],
+                'public': row['is_public']
+            } for row in rows}
+            results = [updated.get(result['toshi_id'], result) if result['status'] == 'not_found' else result
+                       for result in results]
+            await self.invalidate_profiles(list(updated.keys()))
+
+        self.write({'results': results})
+
+class ReputationUpdateHandler(RequestVerificationMixin, AnalyticsMixin, ProfileCacheMixin, DatabaseMixin, BaseHandler):
 
     async def post(self):
 
@@ -1004,4 +1902,5 @@ class ReputationUpdateHandler(RequestVerificationMixin, AnalyticsMixin, Database
                                   score, count, rating, toshi_id)
             await self.db.commit()
 
+        await self.invalidate_profile(toshi_id)
         self.set_status(204)
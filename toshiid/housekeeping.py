@@ -48,6 +48,12 @@ class HousekeepingApplication:
         if rval != "DELETE 0":
             log.info("Housekeeping cleaned up {} stale sessions".format(rval[7:]))
 
+        async with get_database_pool().acquire() as con:
+            rval = await con.execute("DELETE FROM user_registrations "
+                                     "WHERE created < (now() AT TIME ZONE 'utc' - interval '24 hours')")
+        if rval != "DELETE 0":
+            log.info("Housekeeping cleaned up {} stored registration responses".format(rval[7:]))
+
         self.schedule_housekeeping()
 
 if __name__ == '__main__':
@@ -0,0 +1,201 @@
+import asyncio
+import time
+
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from toshi.config import config
+from toshi.errors import JSONHTTPError
+from toshi.log import log
+from toshiid.cache import SingleFlight
+
+DEFAULT_IMAGE_WORKERS = 2
+# jobs waiting for a free worker before new jobs are rejected
+DEFAULT_IMAGE_QUEUE_SIZE = 16
+# number of recent jobs the latency gauges are calculated from
+LATENCY_SAMPLES = 100
+# rendered identicons are well under 1kb each
+DEFAULT_IDENTICON_CACHE_SIZE = 10000
+
+class ImageServiceBusy(Exception):
+    pass
+
+def _timed(fn, args):
+    start = time.monotonic()
+    result = fn(*args)
+    return result, time.monotonic() - start
+
+class ImageService:
+    """Runs image decoding and encoding jobs in a pool of worker processes,
+    so they don't hold the GIL of the web process. At most `workers` jobs
+    run at once and at most `max_queue_size` wait for a worker; further
+    jobs are rejected with ImageServiceBusy rather than queued without
+    bound.
+
+    Jobs must be module level functions, since they're pickled to be sent
+    to the workers."""
+
+    def __init__(self, workers=DEFAULT_IMAGE_WORKERS, max_queue_size=DEFAULT_IMAGE_QUEUE_SIZE):
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self._executor = None
+        # jobs that have been submitted and haven't finished
+        self._pending = 0
+        self._wait_times = deque(maxlen=LATENCY_SAMPLES)
+        self._run_times = deque(maxlen=LATENCY_SAMPLES)
+
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @staticmethod
+    def from_config():
+        if 'images' not in config:
+            return ImageService()
+        return ImageService(
+            workers=config['images'].getint('workers', DEFAULT_IMAGE_WORKERS),
+            max_queue_size=config['images'].getint('queue_size', DEFAULT_IMAGE_QUEUE_SIZE))
+
+    @property
+    def running(self):
+        return min(self._pending, self.workers)
+
+    @property
+    def queue_depth(self):
+        return max(self._pending - self.workers, 0)
+
+    def stats(self):
+        """Returns the current values of the service's gauges and counters.
+        Latencies are in seconds, averaged over the recent jobs"""
+
+        return {
+            'workers': self.workers,
+            'running': self.running,
+            'queue_depth': self.queue_depth,
+            'max_queue_size': self.max_queue_size,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'wait_time': sum(self._wait_times) / len(self._wait_times) if self._wait_times else 0,
+            'run_time': sum(self._run_times) / len(self._run_times) if self._run_times else 0,
+            'max_run_time': max(self._run_times) if self._run_times else 0
+        }
+
+    async def run(self, fn, *args):
+        if self._pending >= self.workers + self.max_queue_size:
+            self.rejected += 1
+            raise ImageServiceBusy()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        executor = self._executor
+
+        self._pending += 1
+        start = time.monotonic()
+        try:
+            result, run_time = await asyncio.get_event_loop().run_in_executor(executor, _timed, fn, args)
+        except BrokenProcessPool:
+            # a worker died (e.g. it ran out of memory decoding a huge
+            # image), which breaks the whole pool, so the next job starts
+            # a new one
+            self.failed += 1
+            if self._executor is executor:
+                log.error("image worker process died, restarting the pool")
+                executor.shutdown(wait=False)
+                self._executor = None
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self._pending -= 1
+        self.completed += 1
+        self._run_times.append(run_time)
+        self._wait_times.append(max(time.monotonic() - start - run_time, 0))
+        return result
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+class IdenticonCache:
+    """Bounded LRU cache of rendered identicons, keyed by address and
+    format. Identicons only depend on their address, so entries never
+    expire, and concurrent misses for the same identicon share a single
+    render."""
+
+    def __init__(self, max_size=DEFAULT_IDENTICON_CACHE_SIZE):
+        self.max_size = max_size
+        # (address, format) -> image data
+        self._entries = OrderedDict()
+        self._renders = SingleFlight()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def from_config():
+        if 'images' not in config:
+            return IdenticonCache()
+        return IdenticonCache(
+            max_size=config['images'].getint('identicon_cache_size', DEFAULT_IDENTICON_CACHE_SIZE))
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, address, format, render, *args):
+        """Returns the identicon for the given address and format, calling
+        the `render(*args)` coroutine to create it if it's not cached"""
+
+        key = (address, format)
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+        self.misses += 1
+        data = await self._renders.run(key, render, *args)
+        if self.max_size > 0:
+            self._entries[key] = data
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return data
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+class ImageServiceMixin:
+    """Gives handlers access to the application wide image service"""
+
+    @property
+    def image_service(self):
+        service = getattr(self.application, 'image_service', None)
+        if service is None:
+            service = self.application.image_service = ImageService.from_config()
+        return service
+
+    @property
+    def identicon_cache(self):
+        cache = getattr(self.application, 'identicon_cache', None)
+        if cache is None:
+            cache = self.application.identicon_cache = IdenticonCache.from_config()
+        return cache
+
+    async def run_image_job(self, fn, *args):
+        """Runs the given image job, responding with a 503 if the image
+        service is saturated"""
+
+        try:
+            return await self.image_service.run(fn, *args)
+        except ImageServiceBusy:
+            log.warning("rejecting image job, {} jobs queued".format(self.image_service.queue_depth))
+            raise JSONHTTPError(503, body={'errors': [{'id': 'service_busy', 'message': 'Too many images are being processed, try again later'}]})
@@ -0,0 +1,249 @@
+"""Bulk imports users, e.g. accounts migrated from another service.
+
+usage: python -m toshiid.importer [--format=ndjson|csv] [--batch-size=N] [--active] <file>
+
+Each record has a `toshi_id` and optionally `username`, `payment_address`,
+`name`, `about`, `location`, `avatar`, `is_app`, `public` and `categories`
+(a list of category ids or tags, comma separated in csv files). Users
+without a username get an autogenerated one, and users without an avatar
+get the url of their identicon, which is rendered on demand by the
+identicon endpoint rather than uploaded.
+
+Imported users are inactive unless `--active` is given. Records for
+toshi ids that already exist, or with a username that's already taken,
+are skipped. Autogenerated usernames that are taken are replaced.
+"""
+
+import argparse
+import asyncio
+import csv
+import io
+import json
+import logging
+import sys
+
+from toshi.log import configure_logger
+from toshi.database import prepare_database, get_database_pool
+from toshi.utils import validate_address
+from toshiid.handlers import autoid_username, validate_username, parse_boolean
+
+DEFAULT_BATCH_SIZE = 10000
+
+log = logging.getLogger("toshiid.importer")
+
+def parse_import_record(record, categories):
+    """Validates a single import record, returning the user's column values
+    and category ids. `categories` maps category ids and tags to ids.
+    Raises a ValueError if the record is invalid"""
+
+    if not isinstance(record, dict):
+        raise ValueError("Expected an object")
+
+    # treat empty csv values as missing
+    record = {key: value for key, value in record.items() if value is not None and value != ''}
+
+    toshi_id = record.get('toshi_id')
+    if not isinstance(toshi_id, str) or not validate_address(toshi_id):
+        raise ValueError("Invalid toshi_id")
+    toshi_id = toshi_id.lower()
+
+    username = record.get('username')
+    if username is not None and (not isinstance(username, str) or not validate_username(username)):
+        raise ValueError("Invalid username")
+
+    payment_address = record.get('payment_address', toshi_id)
+    if not isinstance(payment_address, str) or not validate_address(payment_address):
+        raise ValueError("Invalid payment_address")
+    payment_address = payment_address.lower()
+
+    values = {}
+    for key in ['name', 'about', 'location', 'avatar']:
+        value = record.get(key)
+        if value is not None and not isinstance(value, str):
+            raise ValueError("Invalid {}".format(key))
+        values[key] = value
+    if values['avatar'] is None:
+        values['avatar'] = "/identicon/{}.png".format(payment_address)
+
+    for key in ['is_app', 'public']:
+        if key in record:
+            value = parse_boolean(record[key])
+            if value is None:
+                raise ValueError("Invalid {}".format(key))
+        else:
+            value = False
+        values[key] = value
+
+    category_ids = record.get('categories', [])
+    if isinstance(category_ids, str):
+        category_ids = [int(c) if c.strip().isdigit() else c.strip() for c in category_ids.split(',') if c.strip()]
+    if not isinstance(category_ids, list) or not all(isinstance(c, (int, str)) and not isinstance(c, bool)
+                                                     for c in category_ids):
+        raise ValueError("Invalid categories")
+    invalid = [c for c in category_ids if c not in categories]
+    if invalid:
+        raise ValueError("Invalid categories: {}".format(", ".join(str(c) for c in invalid)))
+    if category_ids and not values['is_app']:
+        raise ValueError("Only apps can have categories")
+
+    return {
+        'toshi_id': toshi_id,
+        'username': username,
+        'payment_address': payment_address,
+        'name': values['name'],
+        'about': values['about'],
+        'location': values['location'],
+        'avatar': values['avatar'],
+        'is_app': values['is_app'],
+        'is_public': values['public'],
+        'category_ids': sorted(set(categories[c] for c in category_ids))
+    }
+
+def read_records(stream, format):
+    """Yields (line number, record) for every record in the stream. Records
+    that can't be decoded are yielded as None"""
+
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_num, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield line_num, json.loads(line)
+            except ValueError:
+                yield line_num, None
+
+class Importer:
+
+    def __init__(self, stream, format='ndjson', batch_size=DEFAULT_BATCH_SIZE, active=False):
+        self.records = read_records(stream, format)
+        self.batch_size = batch_size
+        self.active = active
+        self.categories = {}
+
+        self.imported = 0
+        self.skipped = 0
+        self.username_taken = 0
+        self.invalid = 0
+
+    def read_batch(self):
+        """Reads and validates the next batch of records. This runs in an
+        executor so the next batch is parsed while the previous one is
+        being inserted"""
+
+        batch = []
+        for line_num, record in self.records:
+            try:
+                if record is None:
+                    raise ValueError("Invalid json")
+                batch.append(parse_import_record(record, self.categories))
+            except ValueError as e:
+                self.invalid += 1
+                log.warning("Skipping invalid record on line {}: {}".format(line_num, e))
+                continue
+            if len(batch) >= self.batch_size:
+                break
+        return batch
+
+    async def run(self):
+        async with get_database_pool().acquire() as con:
+            for row in await con.fetch("SELECT category_id, tag FROM categories"):
+                self.categories[row['category_id']] = row['category_id']
+                self.categories[row['tag']] = row['category_id']
+
+            loop = asyncio.get_event_loop()
+            pending = None
+            while True:
+                batch = await loop.run_in_executor(None, self.read_batch)
+                if pending is not None:
+                    await pending
+                if not batch:
+                    break
+                pending = loop.create_task(self.insert_batch(con, batch))
+
+        log.info("Imported {} users, skipped {} existing users, {} users with taken usernames and {} invalid records".format(
+            self.imported, self.skipped, self.username_taken, self.invalid))
+
+    async def insert_batch(self, con, batch):
+        async with con.transaction():
+            for user in batch:
+                user['autoid'] = user['username'] is None
+            inserted = set()
+            pending = batch
+            while pending:
+                missing = sum(1 for user in pending if user['username'] is None)
+                if missing:
+                    autoids = iter(await con.fetch("SELECT nextval('users_autoid_seq') FROM generate_series(1, $1)", missing))
+                    for user in pending:
+                        if user['username'] is None:
+                            user['username'] = autoid_username(next(autoids)[0])
+
+                columns = ['toshi_id', 'username', 'payment_address', 'name', 'about', 'location', 'avatar', 'is_app', 'is_public']
+                rows = await con.fetch(
+                    "INSERT INTO users ({}, active) "
+                    "SELECT *, $10::BOOLEAN FROM UNNEST($1::VARCHAR[], $2::VARCHAR[], $3::VARCHAR[], $4::VARCHAR[], $5::VARCHAR[], "
+                    "$6::VARCHAR[], $7::VARCHAR[], $8::BOOLEAN[], $9::BOOLEAN[]) "
+                    "ON CONFLICT DO NOTHING "
+                    "RETURNING toshi_id".format(', '.join(columns)),
+                    *([user[column] for user in pending] for column in columns), self.active)
+                inserted.update(row['toshi_id'] for row in rows)
+
+                # rows conflict on either the toshi_id or the username, the
+                # ones whose toshi_id doesn't exist failed on the username
+                failed = [user for user in pending if user['toshi_id'] not in inserted]
+                if not failed:
+                    break
+                existing = set(row['toshi_id'] for row in await con.fetch(
+                    "SELECT toshi_id FROM users WHERE toshi_id = ANY($1)", [user['toshi_id'] for user in failed]))
+                pending = []
+                for user in failed:
+                    if user['toshi_id'] in existing:
+                        self.skipped += 1
+                    elif user['autoid']:
+                        # try again with the next autogenerated username
+                        user['username'] = None
+                        pending.append(user)
+                    else:
+                        self.username_taken += 1
+                        log.warning("Skipping {}: username {} is taken".format(user['toshi_id'], user['username']))
+
+            pairs = [(category_id, user['toshi_id']) for user in batch if user['toshi_id'] in inserted
+                     for category_id in user['category_ids']]
+            if pairs:
+                await con.execute(
+                    "INSERT INTO app_categories (category_id, toshi_id) "
+                    "SELECT * FROM UNNEST($1::INTEGER[], $2::VARCHAR[]) "
+                    "ON CONFLICT DO NOTHING",
+                    [pair[0] for pair in pairs], [pair[1] for pair in pairs])
+
+        self.imported += len(inserted)
+        log.info("Imported {} users".format(self.imported))
+
+async def main(args):
+    await prepare_database()
+    if args.file == '-':
+        stream = sys.stdin
+    else:
+        stream = io.open(args.file, newline='', encoding='utf-8')
+    format = args.format or ('csv' if args.file.endswith('.csv') else 'ndjson')
+    try:
+        await Importer(stream, format=format, batch_size=args.batch_size, active=args.active).run()
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+if __name__ == '__main__':
+    configure_logger(log)
+    parser = argparse.ArgumentParser(description="Bulk imports users from a ndjson or csv file")
+    parser.add_argument('file', help="file to import, or - to read from stdin")
+    parser.add_argument('--format', choices=['ndjson', 'csv'],
+                        help="format of the file, defaults to csv for .csv files and ndjson otherwise")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--active', action='store_true', help="mark the imported users as active")
+    # other arguments (e.g. --config) are handled by toshi.config
+    args, _ = parser.parse_known_args()
+    asyncio.get_event_loop().run_until_complete(main(args))
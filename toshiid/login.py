@@ -6,7 +6,8 @@ from toshi.errors import JSONHTTPError
 from datetime import datetime, timedelta
 from toshi.ethereum.utils import data_encoder
 from toshi.handlers import BaseHandler, RequestVerificationMixin
-from toshiid.handlers import user_row_for_json
+from toshiid.handlers import user_row_for_json, UserETagMixin
+from toshiid.cache import ProfileCacheMixin
 from toshi.redis import RedisMixin, get_redis_connection
 from toshi.log import log
 
@@ -199,17 +200,27 @@ class LoginHandler(RequestVerificationMixin, RedisMixin, DatabaseMixin, BaseHand
         self.set_status(204)
         self.finish()
 
-class WhoDisHandler(DatabaseMixin, RedisMixin, BaseHandler):
+class WhoDisHandler(UserETagMixin, ProfileCacheMixin, DatabaseMixin, RedisMixin, BaseHandler):
 
     async def get(self, token):
         key = "{}{}".format(AUTH_TOKEN_REDIS_PREFIX, token)
         toshi_id = await self.redis.get(key, encoding='utf-8')
         if toshi_id is not None:
             await self.redis.delete(key)
+            if self.is_known_missing(toshi_id):
+                raise JSONHTTPError(404)
             async with self.db:
+                if 'If-None-Match' in self.request.headers:
+                    user = await self.db.fetchrow("SELECT toshi_id, version FROM users WHERE toshi_id = $1",
+                                                  toshi_id)
+                    if user and self.check_user_etag(user):
+                        self.set_status(304)
+                        return
                 user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1",
                                               toshi_id)
             if user:
+                self.check_user_etag(user)
                 self.write(user_row_for_json(self.request, user))
                 return
+            self.negative_profile_cache.add(toshi_id)
         raise JSONHTTPError(404)
@@ -1,11 +1,13 @@
 import asyncio
 import unittest
+import unittest.mock as mock
 import mimetypes
 import blockies
 import piexif
 import regex
 import os
 import urllib.parse
+import zlib
 from io import BytesIO
 
 from uuid import uuid4
@@ -15,7 +17,8 @@ from tornado.platform.asyncio import to_asyncio_future
 from tornado.ioloop import IOLoop
 
 from toshiid.app import urls
-from toshiid.handlers import AVATAR_URL_HASH_LENGTH
+from toshiid.handlers import (AVATAR_URL_HASH_LENGTH, AVATAR_SIZES, MAX_AVATAR_PIXELS, WEBP_SUPPORTED,
+                              accepts_webp, sniff_image, process_image)
 from toshi.test.moto_server import requires_moto, BotoTestMixin
 from toshi.analytics import encode_id
 from toshi.test.database import requires_database
@@ -23,6 +26,7 @@ from toshi.test.base import AsyncHandlerTest
 from toshi.ethereum.utils import data_decoder
 
 from PIL import Image
+from PIL.JpegImagePlugin import JpegImageFile
 
 TEST_PRIVATE_KEY = data_decoder("0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35")
 TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
@@ -167,7 +171,8 @@ class UserAvatarHandlerTest(BotoTestMixin, AsyncHandlerTest):
         async with self.boto:
             objs = await self.boto.list_objects()
         self.assertIn('Contents', objs)
-        self.assertEqual(len(objs['Contents']), 2)
+        # both avatars are stored at every size, and as webp
+        self.assertEqual(len(objs['Contents']), 2 * len(AVATAR_SIZES) * (2 if WEBP_SUPPORTED else 1))
 
     @gen_test
     @requires_database
@@ -251,6 +256,83 @@ class UserAvatarHandlerTest(BotoTestMixin, AsyncHandlerTest):
             objs = await self.boto.list_objects()
         self.assertNotIn('Contents', objs)
 
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_streamed_avatar_upload(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        png = blockies.create(TEST_PAYMENT_ADDRESS, size=8, scale=12, format='PNG')
+        resp = await self.fetch_signed("/avatar", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=png, headers={'Content-Type': 'image/png'})
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+        self.assertIsNotNone(
+            regex.match("\/[^\/]+\/public\/avatar\/{}_[a-f0-9]{{{}}}\.png".format(TEST_ADDRESS, AVATAR_URL_HASH_LENGTH),
+                        urllib.parse.urlparse(body['avatar']).path), body['avatar'])
+
+        resp = await self.fetch(body['avatar'], method="GET")
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.body, png)
+
+        # the smaller renditions are served through the avatar endpoint
+        avatar_hash = regex.search("_([a-f0-9]+)\.png$", body['avatar']).group(1)
+        resp = await self.fetch("http://localhost:{}/avatar/{}_{}.png?size=64".format(
+            self.get_http_port(), TEST_ADDRESS, avatar_hash), method="GET")
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(Image.open(BytesIO(resp.body)).size, (64, 64))
+
+        resp = await self.fetch("http://localhost:{}/avatar/{}_{}.png?size=65".format(
+            self.get_http_port(), TEST_ADDRESS, avatar_hash), method="GET")
+        self.assertEqual(resp.code, 404)
+
+        # avatars uploaded before the renditions existed fall back to the full size
+        resp = await self.fetch("http://localhost:{}/avatar/{}_abcdef.png?size=64".format(
+            self.get_http_port(), TEST_ADDRESS), method="GET", follow_redirects=False,
+            headers={'Accept': 'image/webp,image/*,*/*;q=0.8'})
+        self.assertEqual(resp.code, 302)
+        self.assertTrue(resp.headers['Location'].endswith("{}_abcdef.png".format(TEST_ADDRESS)))
+
+        if WEBP_SUPPORTED:
+            # clients accepting webp are sent to the webp version
+            resp = await self.fetch("http://localhost:{}/avatar/{}_{}.png?size=64".format(
+                self.get_http_port(), TEST_ADDRESS, avatar_hash), method="GET", follow_redirects=False,
+                headers={'Accept': 'image/webp,image/*,*/*;q=0.8'})
+            self.assertEqual(resp.code, 302)
+            self.assertTrue(resp.headers['Location'].endswith("{}_{}_64.webp".format(TEST_ADDRESS, avatar_hash)))
+            self.assertIn('Accept', resp.headers['Vary'])
+            resp = await self.fetch(resp.headers['Location'], method="GET")
+            self.assertEqual(resp.code, 200)
+            self.assertEqual(Image.open(BytesIO(resp.body)).format, 'WEBP')
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_streamed_avatar_upload_rejects_bad_data(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        png = blockies.create(TEST_PAYMENT_ADDRESS, size=8, scale=12, format='PNG')
+        # a png header claiming to be far too big to decode
+        huge = png[:16] + (100000).to_bytes(4, 'big') + (100000).to_bytes(4, 'big') + png[24:]
+
+        for body, content_type, code in [
+                (png, 'text/plain', 400),
+                (png, 'image/jpeg', 400),
+                (bytes([0] * 1024), 'image/png', 400),
+                (png[:20], 'image/png', 400),
+                (huge, 'image/png', 400)]:
+            resp = await self.fetch_signed("/avatar", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                           body=body, headers={'Content-Type': content_type})
+            self.assertResponseCodeEqual(resp, code)
+
+        async with self.boto:
+            objs = await self.boto.list_objects()
+        self.assertNotIn('Contents', objs)
+
     @unittest.skip("test uses too much memory to run on circleci")
     @gen_test(timeout=300)
     @requires_database
@@ -294,3 +376,78 @@ class UserAvatarHandlerTest(BotoTestMixin, AsyncHandlerTest):
         loop.add_future(f2, f2done)
 
         await asyncio.wait([to_asyncio_future(f) for f in [f1, f2]], timeout=5)
+
+class SniffImageTest(unittest.TestCase):
+
+    def test_sniff_image(self):
+
+        for format in ['PNG', 'JPEG']:
+            stream = BytesIO()
+            Image.new('RGB', (300, 200)).save(stream, format=format)
+            data = stream.getvalue()
+            self.assertEqual(sniff_image(data), (format, (300, 200)))
+            # not enough data to find the dimensions
+            self.assertIsNone(sniff_image(data[:4]))
+            self.assertIsNone(sniff_image(data[:20]))
+
+    def test_sniff_invalid_image(self):
+
+        for data in [bytes([0] * 100), b'GIF89a' + bytes(100), b'\xff\xd8\xff\xda\x00\x02' + bytes(100)]:
+            with self.assertRaises(ValueError):
+                sniff_image(data)
+
+class AcceptsWebPTest(unittest.TestCase):
+
+    def test_accepts_webp(self):
+
+        for accept, expected in [
+                (None, False),
+                ('*/*', False),
+                ('image/*', False),
+                ('image/png,image/*;q=0.8', False),
+                ('image/webp,image/apng,image/*,*/*;q=0.8', True),
+                ('image/png, image/WebP; q=0.5', True),
+                ('image/webp;q=0', False)]:
+            self.assertEqual(accepts_webp(accept), expected, accept)
+
+class ProcessImageTest(unittest.TestCase):
+
+    def test_orientations(self):
+
+        img = Image.effect_mandelbrot((2000, 1000), (-2, -1.5, 1, 1.5), 100).convert('RGB')
+        draft = JpegImageFile.draft
+        for orientation in range(1, 9):
+            stream = BytesIO()
+            img.save(stream, format="JPEG", exif=piexif.dump({"0th": {piexif.ImageIFD.Orientation: orientation}}))
+
+            drafted = []
+
+            def record_draft(img, mode, size):
+                result = draft(img, mode, size)
+                drafted.append(img.size)
+                return result
+
+            with mock.patch.object(JpegImageFile, 'draft', record_draft):
+                renditions, cache_hash, format = process_image(stream.getvalue(), 'image/jpeg')
+            # the jpeg is decoded at half the size. thumbnail() drafts again
+            # when the image hasn't been transposed, which is a no-op by then
+            self.assertEqual(drafted[0], (1000, 500), orientation)
+            self.assertEqual(format, 'JPEG')
+            self.assertEqual(set(size for _, size in renditions.keys()), set(AVATAR_SIZES))
+            self.assertEqual(set(format for format, _ in renditions.keys()), {'JPEG', 'WEBP'} if WEBP_SUPPORTED else {'JPEG'})
+            # the jpeg is decoded at a reduced scale, but still ends up at the full avatar size
+            for (rendition_format, size), data in renditions.items():
+                expected = (size // 2, size) if orientation > 4 else (size, size // 2)
+                rendition = Image.open(BytesIO(data))
+                self.assertEqual(rendition.format, rendition_format)
+                self.assertEqual(rendition.size, expected, (orientation, size))
+
+    def test_pixel_limit(self):
+
+        # a png header claiming more pixels than allowed
+        png = blockies.create(TEST_PAYMENT_ADDRESS, size=8, scale=12, format='PNG')
+        side = int(MAX_AVATAR_PIXELS ** 0.5) + 1
+        ihdr = b'IHDR' + side.to_bytes(4, 'big') + side.to_bytes(4, 'big') + png[24:29]
+        huge = png[:12] + ihdr + zlib.crc32(ihdr).to_bytes(4, 'big') + png[33:]
+        with self.assertRaisesRegex(ValueError, 'Invalid image dimensions'):
+            process_image(huge, 'image/png')
@@ -7,6 +7,7 @@ from toshiid.app import urls
 from toshi.test.database import requires_database
 from toshi.test.base import AsyncHandlerTest
 from toshi.ethereum.utils import data_decoder
+from toshi.config import config
 
 TEST_PRIVATE_KEY = data_decoder("0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35")
 TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
@@ -119,6 +120,13 @@ class AppCategoriesTest(AsyncHandlerTest):
         })
         self.assertResponseCodeEqual(resp, 400)
 
+        for bad in [[{"tag": "cat1"}], [["cat1"]], [True], "cat1", 1]:
+            resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+                "categories": bad
+            })
+            self.assertResponseCodeEqual(resp, 400)
+            self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'bad_arguments')
+
         resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
         self.assertResponseCodeEqual(resp, 200)
         body = json_decode(resp.body)
@@ -165,6 +173,78 @@ class AppCategoriesTest(AsyncHandlerTest):
         self.assertIn("categories", body)
         self.assertEqual(len(body['categories']), 0)
 
+    @gen_test
+    @requires_database
+    async def test_category_changes_update_user_version(self):
+
+        await self.setup_categories()
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name, is_app, is_public) VALUES ($1, $2, $3, true, true)",
+                              "toshibot", TEST_ADDRESS, "ToshiBot")
+            initial_version = await con.fetchval("SELECT version FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+
+            await con.execute("INSERT INTO app_categories VALUES ($1, $2)", 1, TEST_ADDRESS)
+            added_version = await con.fetchval("SELECT version FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+
+            await con.execute("DELETE FROM categories WHERE category_id = 1")
+            removed_version = await con.fetchval("SELECT version FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+
+        self.assertGreater(added_version, initial_version)
+        self.assertGreater(removed_version, added_version)
+
+        # statements changing many categories update each user once
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO app_categories SELECT category_id, $1 FROM categories "
+                              "WHERE category_id IN (2, 3, 4)", TEST_ADDRESS)
+            row = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+            self.assertEqual(row['category_ids'], [2, 3, 4])
+            self.assertEqual(row['version'], removed_version + 1)
+
+            await con.execute("UPDATE category_names SET name = upper(name)")
+            row = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+            self.assertEqual(row['category_names'], ['CATEGORY2', 'CATEGORY3', 'CATEGORY4'])
+            self.assertEqual(row['version'], removed_version + 2)
+
+            # renames that don't change the tag don't touch the apps
+            await con.execute("UPDATE categories SET tag = tag")
+            self.assertEqual(await con.fetchval("SELECT version FROM users WHERE toshi_id = $1", TEST_ADDRESS),
+                             removed_version + 2)
+
+    @gen_test
+    @requires_database
+    async def test_category_changes_update_apps(self):
+
+        categories = await self.setup_categories()
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name, is_app, is_public) VALUES ($1, $2, $3, true, true)",
+                              "toshibot", TEST_ADDRESS, "ToshiBot")
+            await con.executemany("INSERT INTO app_categories VALUES ($1, $2)",
+                                  [(2, TEST_ADDRESS),
+                                   (1, TEST_ADDRESS)])
+            row = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+
+        self.assertEqual(row['category_ids'], [1, 2])
+        self.assertEqual(row['category_tags'], [categories[0][1], categories[1][1]])
+        self.assertEqual(row['category_names'], [categories[0][2], categories[1][2]])
+
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE categories SET tag = $1 WHERE category_id = 1", "renamedcat")
+            await con.execute("UPDATE category_names SET name = $1 WHERE category_id = 1", "Renamed Category")
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(body['categories'][0]['tag'], "renamedcat")
+        self.assertEqual(body['categories'][0]['name'], "Renamed Category")
+
+        async with self.pool.acquire() as con:
+            await con.execute("DELETE FROM app_categories WHERE category_id = 2")
+            row = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+
+        self.assertEqual(row['category_ids'], [1])
+
     @gen_test
     @requires_database
     async def test_user_search_returns_categories(self):
@@ -260,3 +340,59 @@ class AppCategoriesTest(AsyncHandlerTest):
         body = json_decode(resp.body)
         self.assertIn("results", body)
         self.assertEqual(len(body["results"]), 2)
+
+    @gen_test
+    @requires_database
+    async def test_bulk_reassign_app_categories(self):
+
+        await self.setup_categories()
+        other_address = "0x0000000000000000000000000000000000000001"
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, is_app, is_public) VALUES ($1, $2, true, true)",
+                              'SuperBot', TEST_ADDRESS)
+            await con.execute("INSERT INTO users (username, toshi_id, is_app, is_public) VALUES ($1, $2, true, true)",
+                              'ToshiBot', TEST_ADDRESS_2)
+            await con.execute("INSERT INTO users (username, toshi_id, is_app, is_public) VALUES ($1, $2, true, true)",
+                              'OtherBot', other_address)
+            await con.executemany("INSERT INTO app_categories VALUES ($1, $2)",
+                                  [(3, TEST_ADDRESS_2), (4, TEST_ADDRESS_2), (5, other_address)])
+
+        body = {"apps": [
+            {"toshi_id": TEST_ADDRESS, "categories": [1, "cat2"]},
+            {"toshi_id": TEST_ADDRESS_2, "categories": ["cat4", 5]}
+        ]}
+
+        # only superusers can reassign categories
+        resp = await self.fetch_signed("/apps/categories", signing_key=TEST_PRIVATE_KEY, method="PUT", body=body)
+        self.assertResponseCodeEqual(resp, 401)
+
+        config['superusers'] = {TEST_ADDRESS: 1}
+
+        for bad in [{"apps": [{"toshi_id": TEST_ADDRESS, "categories": ["cat9"]}]},
+                    {"apps": [{"toshi_id": "0x0000000000000000000000000000000000000002", "categories": [1]}]},
+                    {"apps": [{"toshi_id": TEST_ADDRESS, "categories": "cat1"}]},
+                    {"apps": {TEST_ADDRESS: [1]}}]:
+            resp = await self.fetch_signed("/apps/categories", signing_key=TEST_PRIVATE_KEY, method="PUT", body=bad)
+            self.assertResponseCodeEqual(resp, 400)
+
+        resp = await self.fetch_signed("/apps/categories", signing_key=TEST_PRIVATE_KEY, method="PUT", body=body)
+        self.assertResponseCodeEqual(resp, 204)
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT toshi_id, category_ids FROM users ORDER BY username")
+        self.assertEqual([(row['toshi_id'], row['category_ids']) for row in rows], [
+            (other_address, [5]),
+            (TEST_ADDRESS, [1, 2]),
+            (TEST_ADDRESS_2, [4, 5])
+        ])
+
+        # empty lists remove all the categories
+        resp = await self.fetch_signed("/apps/categories", signing_key=TEST_PRIVATE_KEY, method="PUT", body={"apps": [
+            {"toshi_id": TEST_ADDRESS_2, "categories": []}
+        ]})
+        self.assertResponseCodeEqual(resp, 204)
+
+        resp = await self.fetch("/apps/{}".format(TEST_ADDRESS_2))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['categories'], [])
@@ -1,6 +1,12 @@
+import blockies
+import unittest.mock as mock
+
+from io import BytesIO
+from PIL import Image
 from tornado.testing import gen_test
 
 from toshiid.app import urls
+from toshiid.handlers import WEBP_SUPPORTED
 from toshi.test.database import requires_database
 from toshi.test.base import AsyncHandlerTest
 
@@ -28,12 +34,18 @@ class UserAvatarHandlerTest(AsyncHandlerTest):
 
         resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS), method="GET")
         self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.body, blockies.create(TEST_ADDRESS, size=8, scale=12, format='PNG'))
 
+        # identicons are cached in memory rather than stored
         async with self.pool.acquire() as con:
-            row = await con.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1",
-                                     "{}_identicon_{}".format(TEST_ADDRESS, "PNG"))
+            count = await con.fetchval("SELECT COUNT(*) FROM avatars")
+        self.assertEqual(count, 0)
+        self.assertEqual(len(self._app.identicon_cache), 1)
 
-        self.assertIsNotNone(row)
+        resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(self._app.identicon_cache.hits, 1)
+        self.assertEqual(self._app.identicon_cache.misses, 1)
 
         # check caching
         self.assertIn('Etag', resp.headers)
@@ -46,3 +58,43 @@ class UserAvatarHandlerTest(AsyncHandlerTest):
             'If-Modified-Since': last_modified
         })
         self.assertResponseCodeEqual(resp, 304)
+        # without looking at the cache
+        self.assertEqual(self._app.identicon_cache.hits, 1)
+
+        # the etag doesn't depend on the process that rendered the identicon
+        self._app.identicon_cache = None
+        resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.headers['Etag'], last_etag)
+
+        # bumping the version invalidates identicons cached by clients that
+        # only send If-Modified-Since
+        with mock.patch('toshiid.handlers.IDENTICON_VERSION', 2):
+            resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS), method="GET", headers={
+                'If-Modified-Since': last_modified
+            })
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertNotEqual(resp.headers['Etag'], last_etag)
+        self.assertNotEqual(resp.headers['Last-Modified'], last_modified)
+
+    @gen_test
+    @requires_database
+    async def test_identicon_webp(self):
+
+        resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'image/png')
+        self.assertIn('Accept', resp.headers['Vary'])
+        png_etag = resp.headers['Etag']
+
+        resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS), method="GET", headers={
+            'Accept': 'image/webp,image/*,*/*;q=0.8'
+        })
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertIn('Accept', resp.headers['Vary'])
+        if WEBP_SUPPORTED:
+            self.assertEqual(resp.headers['Content-Type'], 'image/webp')
+            self.assertEqual(Image.open(BytesIO(resp.body)).format, 'WEBP')
+            self.assertNotEqual(resp.headers['Etag'], png_etag)
+        else:
+            self.assertEqual(resp.headers['Content-Type'], 'image/png')
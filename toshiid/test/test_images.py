@@ -0,0 +1,147 @@
+import asyncio
+import os
+import time
+
+from concurrent.futures.process import BrokenProcessPool
+
+from tornado.escape import json_decode
+from tornado.testing import gen_test, AsyncTestCase
+
+from toshiid.app import urls
+from toshiid.handlers import create_identitcon, process_image
+from toshiid.images import IdenticonCache, ImageService, ImageServiceBusy
+from toshi.test.moto_server import requires_moto, BotoTestMixin
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+
+from toshiid.test.test_user import TEST_PRIVATE_KEY, TEST_ADDRESS, TEST_PAYMENT_ADDRESS
+
+class IdenticonCacheTest(AsyncTestCase):
+
+    @gen_test
+    async def test_lru(self):
+
+        renders = []
+
+        async def render(address, format):
+            renders.append(address)
+            await asyncio.sleep(0.01)
+            return create_identitcon(address, format)
+
+        cache = IdenticonCache(max_size=1)
+        # concurrent misses share a render
+        results = await asyncio.gather(*[cache.get(TEST_ADDRESS, 'PNG', render, TEST_ADDRESS, 'PNG') for i in range(3)])
+        self.assertEqual(results, [create_identitcon(TEST_ADDRESS)] * 3)
+        self.assertEqual(renders, [TEST_ADDRESS])
+
+        await cache.get(TEST_ADDRESS, 'PNG', render, TEST_ADDRESS, 'PNG')
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(len(renders), 1)
+
+        await cache.get(TEST_PAYMENT_ADDRESS, 'PNG', render, TEST_PAYMENT_ADDRESS, 'PNG')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.evictions, 1)
+        await cache.get(TEST_ADDRESS, 'PNG', render, TEST_ADDRESS, 'PNG')
+        self.assertEqual(len(renders), 3)
+
+class ImageServiceTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.service = ImageService(workers=1, max_queue_size=1)
+
+    def tearDown(self):
+        self.service.shutdown()
+        super().tearDown()
+
+    @gen_test
+    async def test_run(self):
+
+        data = await self.service.run(create_identitcon, TEST_ADDRESS)
+        self.assertEqual(data, create_identitcon(TEST_ADDRESS))
+
+        stats = self.service.stats()
+        self.assertEqual(stats['completed'], 1)
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertGreater(stats['run_time'], 0)
+
+    @gen_test
+    async def test_errors_are_returned(self):
+
+        with self.assertRaises(ValueError):
+            await self.service.run(process_image, b'not an image', 'image/png')
+        self.assertEqual(self.service.failed, 1)
+
+    @gen_test(timeout=30)
+    async def test_recovers_from_dead_workers(self):
+
+        with self.assertRaises(BrokenProcessPool):
+            await self.service.run(os._exit, 1)
+        self.assertEqual(self.service.failed, 1)
+
+        data = await self.service.run(create_identitcon, TEST_ADDRESS)
+        self.assertEqual(data, create_identitcon(TEST_ADDRESS))
+
+    @gen_test(timeout=30)
+    async def test_rejects_when_saturated(self):
+
+        # one job running and one waiting fills the service
+        jobs = [asyncio.ensure_future(self.service.run(time.sleep, 0.5)) for i in range(2)]
+        await asyncio.sleep(0)
+        self.assertEqual(self.service.running, 1)
+        self.assertEqual(self.service.queue_depth, 1)
+
+        with self.assertRaises(ImageServiceBusy):
+            await self.service.run(time.sleep, 0)
+        self.assertEqual(self.service.rejected, 1)
+
+        await asyncio.gather(*jobs)
+        self.assertEqual(self.service.completed, 2)
+        self.assertEqual(self.service.queue_depth, 0)
+
+        # jobs are accepted again once the queue drains
+        await self.service.run(time.sleep, 0)
+
+class ImageServiceHandlerTest(BotoTestMixin, AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    def get_url(self, path):
+        path = "/v1{}".format(path)
+        return super().get_url(path)
+
+    def tearDown(self):
+        if getattr(self._app, 'image_service', None) is not None:
+            self._app.image_service.shutdown()
+        super().tearDown()
+
+    @gen_test(timeout=30)
+    @requires_database
+    @requires_moto
+    async def test_avatar_upload_rejected_when_saturated(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        self._app.image_service = ImageService(workers=1, max_queue_size=0)
+        job = asyncio.ensure_future(self._app.image_service.run(time.sleep, 1))
+        await asyncio.sleep(0)
+
+        png = create_identitcon(TEST_PAYMENT_ADDRESS)
+        resp = await self.fetch_signed("/avatar", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=png, headers={'Content-Type': 'image/png'})
+        self.assertResponseCodeEqual(resp, 503)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'service_busy')
+
+        resp = await self.fetch("/status/images")
+        self.assertResponseCodeEqual(resp, 200)
+        stats = json_decode(resp.body)
+        self.assertEqual(stats['running'], 1)
+        self.assertEqual(stats['rejected'], 1)
+
+        await job
+        resp = await self.fetch_signed("/avatar", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=png, headers={'Content-Type': 'image/png'})
+        self.assertResponseCodeEqual(resp, 200)
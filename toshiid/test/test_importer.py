@@ -0,0 +1,148 @@
+import io
+import json
+import unittest
+
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.handlers import autoid_username
+from toshiid.importer import Importer, parse_import_record
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+
+from toshiid.test.test_user import TEST_ADDRESS, TEST_ADDRESS_2, TEST_PAYMENT_ADDRESS
+
+CATEGORIES = {1: 1, 'games': 1, 2: 2, 'social': 2}
+
+class ParseImportRecordTest(unittest.TestCase):
+
+    def test_defaults(self):
+
+        user = parse_import_record({'toshi_id': TEST_ADDRESS}, CATEGORIES)
+        self.assertEqual(user['toshi_id'], TEST_ADDRESS)
+        self.assertIsNone(user['username'])
+        self.assertEqual(user['payment_address'], TEST_ADDRESS)
+        self.assertEqual(user['avatar'], "/identicon/{}.png".format(TEST_ADDRESS))
+        self.assertFalse(user['is_app'])
+        self.assertFalse(user['is_public'])
+        self.assertEqual(user['category_ids'], [])
+
+    def test_csv_values(self):
+
+        user = parse_import_record({'toshi_id': TEST_ADDRESS, 'username': 'BobSmith', 'payment_address': TEST_PAYMENT_ADDRESS,
+                                    'name': 'Bob', 'about': '', 'is_app': 'true', 'public': 'false',
+                                    'categories': 'games, 2'}, CATEGORIES)
+        self.assertEqual(user['username'], 'BobSmith')
+        self.assertEqual(user['avatar'], "/identicon/{}.png".format(TEST_PAYMENT_ADDRESS))
+        self.assertIsNone(user['about'])
+        self.assertTrue(user['is_app'])
+        self.assertFalse(user['is_public'])
+        self.assertEqual(user['category_ids'], [1, 2])
+
+    def test_invalid_records(self):
+
+        for record in [
+                [],
+                {},
+                {'toshi_id': 'bob'},
+                {'toshi_id': TEST_ADDRESS, 'username': 'b'},
+                {'toshi_id': TEST_ADDRESS, 'payment_address': '0x1234'},
+                {'toshi_id': TEST_ADDRESS, 'name': 1},
+                {'toshi_id': TEST_ADDRESS, 'is_app': 'maybe'},
+                {'toshi_id': TEST_ADDRESS, 'is_app': True, 'categories': ['music']},
+                {'toshi_id': TEST_ADDRESS, 'is_app': True, 'categories': [[1]]},
+                {'toshi_id': TEST_ADDRESS, 'categories': [1]}]:
+            with self.assertRaises(ValueError, msg=record):
+                parse_import_record(record, CATEGORIES)
+
+class ImporterTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    async def test_import_ndjson(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO categories (category_id, tag) VALUES (1, 'games')")
+            await con.execute("INSERT INTO users (toshi_id, username) VALUES ($1, $2)",
+                              '0x0000000000000000000000000000000000000003', 'JaneDoe')
+
+        lines = [
+            json.dumps({'toshi_id': TEST_ADDRESS, 'username': 'BobSmith', 'name': 'Bob'}),
+            json.dumps({'toshi_id': TEST_ADDRESS_2, 'is_app': True, 'categories': ['games']}),
+            "not json",
+            json.dumps({'toshi_id': 'bob'}),
+            # username already taken
+            json.dumps({'toshi_id': '0x0000000000000000000000000000000000000004', 'username': 'janedoe'}),
+            json.dumps({'toshi_id': '0x0000000000000000000000000000000000000005'})
+        ]
+        importer = Importer(io.StringIO("\n".join(lines)), batch_size=2)
+        await importer.run()
+
+        self.assertEqual(importer.imported, 3)
+        self.assertEqual(importer.skipped, 0)
+        self.assertEqual(importer.username_taken, 1)
+        self.assertEqual(importer.invalid, 2)
+
+        async with self.pool.acquire() as con:
+            bob = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+            app = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS_2)
+            count = await con.fetchval("SELECT COUNT(*) FROM users")
+
+        self.assertEqual(count, 4)
+        self.assertEqual(bob['username'], 'BobSmith')
+        self.assertEqual(bob['name'], 'Bob')
+        self.assertFalse(bob['active'])
+        self.assertEqual(bob['avatar'], "/identicon/{}.png".format(TEST_ADDRESS))
+        self.assertIsNotNone(bob['tsv'])
+        self.assertTrue(app['is_app'])
+        self.assertTrue(app['username'].startswith('user'))
+        self.assertEqual(app['category_ids'], [1])
+
+    @gen_test
+    @requires_database
+    async def test_import_csv(self):
+
+        data = "toshi_id,username,name,public\n{},BobSmith,Bob,true\n{},,,\n".format(TEST_ADDRESS, TEST_ADDRESS_2)
+        importer = Importer(io.StringIO(data), format='csv', active=True)
+        await importer.run()
+
+        self.assertEqual(importer.imported, 2)
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT * FROM users ORDER BY toshi_id")
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['username'], 'BobSmith')
+        self.assertTrue(rows[0]['is_public'])
+        self.assertTrue(rows[0]['active'])
+        self.assertIsNone(rows[1]['name'])
+
+    @gen_test
+    @requires_database
+    async def test_import_autoid_collision(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("SELECT setval('users_autoid_seq', 1, false)")
+            # someone registered the next autogenerated username themselves
+            await con.execute("INSERT INTO users (toshi_id, username) VALUES ($1, $2)",
+                              '0x0000000000000000000000000000000000000003', autoid_username(1).upper())
+
+        lines = [
+            json.dumps({'toshi_id': TEST_ADDRESS}),
+            # already exists
+            json.dumps({'toshi_id': '0x0000000000000000000000000000000000000003'})
+        ]
+        importer = Importer(io.StringIO("\n".join(lines)))
+        await importer.run()
+
+        self.assertEqual(importer.imported, 1)
+        self.assertEqual(importer.skipped, 1)
+        self.assertEqual(importer.username_taken, 0)
+
+        async with self.pool.acquire() as con:
+            username = await con.fetchval("SELECT username FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+        # autoid 2 went to the existing user's record, which was skipped
+        self.assertEqual(username, autoid_username(3))
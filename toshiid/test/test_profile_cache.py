@@ -0,0 +1,438 @@
+import asyncio
+import json
+import time
+import unittest
+
+from tornado.escape import json_decode
+from tornado.testing import gen_test, AsyncTestCase
+
+from toshiid.app import urls
+from toshiid.bloom import BloomFilter
+from toshiid.cache import (ProfileCache, SharedProfileCache, SingleFlight, UserRecord, NegativeCache,
+                           RegisteredUsersFilter, PROFILE_KEY_PREFIX, PROFILE_INVALIDATION_CHANNEL)
+from toshi.test.database import requires_database
+from toshi.test.redis import requires_redis
+from toshi.test.moto_server import requires_moto, BotoTestMixin
+from toshi.redis import get_redis_connection
+from toshi.test.base import AsyncHandlerTest
+from toshi.config import config
+
+from toshiid.test.test_user import TEST_PRIVATE_KEY, TEST_ADDRESS, TEST_ADDRESS_2
+
+def make_row(toshi_id, username):
+    return {'toshi_id': toshi_id, 'username': username}
+
+class ProfileCacheTest(unittest.TestCase):
+
+    def test_disabled_by_default(self):
+
+        cache = ProfileCache()
+        cache.set(make_row(TEST_ADDRESS, 'BobSmith'))
+        self.assertIsNone(cache.get(TEST_ADDRESS))
+        self.assertEqual(len(cache), 0)
+
+    def test_lookup_by_toshi_id_and_username(self):
+
+        cache = ProfileCache(max_size=10)
+        row = make_row(TEST_ADDRESS, 'BobSmith')
+        cache.set(row)
+
+        self.assertIs(cache.get(TEST_ADDRESS), row)
+        self.assertIs(cache.get('bobsmith'), row)
+        self.assertIs(cache.get('BOBSMITH'), row)
+        self.assertIsNone(cache.get('janedoe'))
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(cache.misses, 1)
+
+    def test_lru_eviction(self):
+
+        cache = ProfileCache(max_size=2)
+        cache.set(make_row(TEST_ADDRESS, 'BobSmith'))
+        cache.set(make_row(TEST_ADDRESS_2, 'JaneDoe'))
+        # touch the first entry so the second is the least recently used
+        self.assertIsNotNone(cache.get(TEST_ADDRESS))
+        cache.set(make_row('0x0000000000000000000000000000000000000001', 'JohnDoe'))
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNotNone(cache.get(TEST_ADDRESS))
+        self.assertIsNone(cache.get(TEST_ADDRESS_2))
+        self.assertIsNone(cache.get('janedoe'))
+
+    def test_ttl_expiry(self):
+
+        cache = ProfileCache(max_size=10, ttl=0.01)
+        cache.set(make_row(TEST_ADDRESS, 'BobSmith'))
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(TEST_ADDRESS))
+        self.assertEqual(cache.expirations, 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_removes_username(self):
+
+        cache = ProfileCache(max_size=10)
+        cache.set(make_row(TEST_ADDRESS, 'BobSmith'))
+        cache.invalidate(TEST_ADDRESS)
+        self.assertIsNone(cache.get(TEST_ADDRESS))
+        self.assertIsNone(cache.get('bobsmith'))
+
+    def test_username_change(self):
+
+        cache = ProfileCache(max_size=10)
+        cache.set(make_row(TEST_ADDRESS, 'BobSmith'))
+        cache.set(make_row(TEST_ADDRESS, 'Bobby'))
+        self.assertIsNone(cache.get('bobsmith'))
+        self.assertIsNotNone(cache.get('bobby'))
+
+class NegativeCacheTest(unittest.TestCase):
+
+    def test_disabled_by_default(self):
+
+        cache = NegativeCache()
+        cache.add(TEST_ADDRESS)
+        self.assertNotIn(TEST_ADDRESS, cache)
+
+    def test_expiry_and_eviction(self):
+
+        cache = NegativeCache(ttl=0.01, max_size=2)
+        cache.add(TEST_ADDRESS)
+        cache.add('bobsmith')
+        cache.add('janedoe')
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn(TEST_ADDRESS, cache)
+        self.assertIn('bobsmith', cache)
+        cache.discard('bobsmith')
+        self.assertNotIn('bobsmith', cache)
+        time.sleep(0.02)
+        self.assertNotIn('janedoe', cache)
+        self.assertEqual(len(cache), 0)
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+
+        bloom = BloomFilter(1000, error_rate=0.01)
+        keys = ['user{}'.format(i) for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertEqual(len(bloom), 1000)
+        self.assertTrue(all(key in bloom for key in keys))
+
+        false_positives = sum(1 for i in range(10000) if 'other{}'.format(i) in bloom)
+        self.assertLess(false_positives, 300)
+
+class SingleFlightTest(AsyncTestCase):
+
+    @gen_test
+    async def test_concurrent_calls_are_coalesced(self):
+
+        flights = SingleFlight()
+        calls = []
+
+        async def load(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value
+
+        results = await asyncio.gather(*[flights.run('bobsmith', load, i) for i in range(10)])
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [0] * 10)
+        self.assertEqual(flights.coalesced, 9)
+        self.assertEqual(len(flights), 0)
+
+        # once finished, a new call runs again
+        self.assertEqual(await flights.run('bobsmith', load, 10), 10)
+        self.assertEqual(len(calls), 2)
+
+    @gen_test
+    async def test_errors_are_shared(self):
+
+        flights = SingleFlight()
+
+        async def load():
+            await asyncio.sleep(0.01)
+            raise ValueError()
+
+        results = await asyncio.gather(*[flights.run('bobsmith', load) for i in range(2)],
+                                       return_exceptions=True)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(len(flights), 0)
+
+class ProfileCacheHandlerTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    def get_url(self, path):
+        path = "/v1{}".format(path)
+        return super().get_url(path)
+
+    def setUp(self):
+        super().setUp()
+        self._app.profile_cache = ProfileCache(max_size=10, ttl=60)
+
+    @gen_test
+    @requires_database
+    async def test_get_user_is_cached(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name) VALUES ($1, $2, $3)", 'BobSmith', TEST_ADDRESS, 'Bob')
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['name'], 'Bob')
+
+        # change the name behind the service's back
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE users SET name = $1 WHERE toshi_id = $2", 'Robert', TEST_ADDRESS)
+
+        for key in [TEST_ADDRESS, 'bobsmith']:
+            resp = await self.fetch("/user/{}".format(key))
+            self.assertResponseCodeEqual(resp, 200)
+            self.assertEqual(json_decode(resp.body)['name'], 'Bob')
+
+        self.assertEqual(self._app.profile_cache.misses, 1)
+        self.assertEqual(self._app.profile_cache.hits, 2)
+
+    @gen_test
+    @requires_database
+    async def test_update_user_invalidates_cache(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name) VALUES ($1, $2, $3)", 'BobSmith', TEST_ADDRESS, 'Bob')
+
+        resp = await self.fetch("/user/bobsmith")
+        self.assertResponseCodeEqual(resp, 200)
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Robert",
+            "username": "Bobby"
+        })
+        self.assertResponseCodeEqual(resp, 200)
+
+        resp = await self.fetch("/user/bobsmith")
+        self.assertResponseCodeEqual(resp, 404)
+
+        resp = await self.fetch("/user/bobby")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['name'], 'Robert')
+
+    @gen_test
+    @requires_database
+    async def test_reputation_update_invalidates_cache(self):
+
+        config['reputation'] = {'id': TEST_ADDRESS}
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'JaneDoe', TEST_ADDRESS_2)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS_2))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertIsNone(json_decode(resp.body)['reputation_score'])
+
+        resp = await self.fetch_signed("/reputation", signing_key=TEST_PRIVATE_KEY, method="POST",
+                                       body={'toshi_id': TEST_ADDRESS_2, "reputation_score": 4.4, "review_count": 10, "average_rating": 4.9})
+        self.assertResponseCodeEqual(resp, 204)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS_2))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['reputation_score'], 4.4)
+
+    @gen_test
+    @requires_database
+    async def test_apps_only_uses_cached_user(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+
+        # non app users are not returned from the apps endpoint
+        resp = await self.fetch("/apps/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 404)
+
+class SharedProfileCacheTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    def get_url(self, path):
+        path = "/v1{}".format(path)
+        return super().get_url(path)
+
+    async def wait_for(self, check, timeout=5):
+        for _ in range(int(timeout / 0.05)):
+            if check():
+                return
+            await asyncio.sleep(0.05)
+        self.fail("timed out waiting for condition")
+
+    @gen_test(timeout=10)
+    @requires_redis
+    async def test_remote_invalidation(self):
+
+        local_cache = ProfileCache(max_size=10)
+        shared_cache = SharedProfileCache(local_cache)
+
+        profile = UserRecord({'toshi_id': TEST_ADDRESS, 'username': 'BobSmith', 'name': 'Bob'})
+        local_cache.set(profile)
+        await shared_cache.set(profile)
+
+        self.assertEqual(await shared_cache.get('bobsmith'), profile)
+        self.assertEqual(await shared_cache.get(TEST_ADDRESS), profile)
+        await self.wait_for(lambda: shared_cache._channel is not None)
+
+        # simulate an invalidation from a different process
+        await get_redis_connection().publish(PROFILE_INVALIDATION_CHANNEL, TEST_ADDRESS)
+        await self.wait_for(lambda: local_cache.get(TEST_ADDRESS) is None)
+
+        await shared_cache.invalidate(TEST_ADDRESS)
+        self.assertIsNone(await shared_cache.get(TEST_ADDRESS))
+        self.assertIsNone(await shared_cache.get('bobsmith'))
+
+    @gen_test(timeout=10)
+    @requires_redis
+    async def test_profiles_loaded_during_invalidation_are_not_cached(self):
+
+        shared_cache = SharedProfileCache(ProfileCache())
+        profile = UserRecord({'toshi_id': TEST_ADDRESS, 'username': 'BobSmith', 'name': 'Bob'})
+
+        # the profile is read, then updated and invalidated before it's cached
+        count = await shared_cache.invalidation_count(TEST_ADDRESS)
+        await shared_cache.invalidate(TEST_ADDRESS)
+        await shared_cache.set(profile, count)
+        self.assertIsNone(await shared_cache.get(TEST_ADDRESS))
+        self.assertIsNone(await shared_cache.get('bobsmith'))
+
+        # invalidating other profiles doesn't stop it from being cached
+        count = await shared_cache.invalidation_count(TEST_ADDRESS)
+        await shared_cache.invalidate(TEST_ADDRESS_2)
+        await shared_cache.set(profile, count)
+        self.assertEqual(await shared_cache.get(TEST_ADDRESS), profile)
+        self.assertEqual(await shared_cache.get('bobsmith'), profile)
+
+    @gen_test(timeout=10)
+    @requires_redis
+    async def test_stale_username_mapping(self):
+
+        shared_cache = SharedProfileCache(ProfileCache())
+
+        await shared_cache.set(UserRecord({'toshi_id': TEST_ADDRESS, 'username': 'BobSmith'}))
+        await shared_cache.set(UserRecord({'toshi_id': TEST_ADDRESS, 'username': 'Bobby'}))
+
+        self.assertIsNone(await shared_cache.get('bobsmith'))
+        self.assertIsNotNone(await shared_cache.get('bobby'))
+
+    @gen_test(timeout=10)
+    @requires_database
+    @requires_redis
+    async def test_handlers_use_shared_cache(self):
+
+        self._app.profile_cache = ProfileCache(max_size=10)
+        self._app.shared_profile_cache = SharedProfileCache(self._app.profile_cache)
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name) VALUES ($1, $2, $3)", 'BobSmith', TEST_ADDRESS, 'Bob')
+
+        resp = await self.fetch("/user/bobsmith")
+        self.assertResponseCodeEqual(resp, 200)
+
+        profile = await get_redis_connection().get(PROFILE_KEY_PREFIX + TEST_ADDRESS, encoding='utf-8')
+        self.assertIsNotNone(profile)
+        self.assertEqual(json.loads(profile)['name'], 'Bob')
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Robert"
+        })
+        self.assertResponseCodeEqual(resp, 200)
+
+        profile = await get_redis_connection().get(PROFILE_KEY_PREFIX + TEST_ADDRESS, encoding='utf-8')
+        self.assertIsNone(profile)
+
+        resp = await self.fetch("/user/bobsmith")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['name'], 'Robert')
+
+class NegativeCacheHandlerTest(BotoTestMixin, AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    def get_url(self, path):
+        path = "/v1{}".format(path)
+        return super().get_url(path)
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_missing_users_are_cached(self):
+
+        self._app.negative_profile_cache = NegativeCache(ttl=60)
+
+        for key in [TEST_ADDRESS, 'bobsmith']:
+            resp = await self.fetch("/user/{}".format(key))
+            self.assertResponseCodeEqual(resp, 404)
+
+        # users added behind the service's back are not seen until the entry expires
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'JaneDoe', TEST_ADDRESS_2)
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 404)
+        self.assertEqual(self._app.negative_profile_cache.hits, 1)
+
+        # registering clears the entries for both the toshi_id and username
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="POST", body={
+            "username": "BobSmith"
+        })
+        self.assertResponseCodeEqual(resp, 200)
+
+        for key in [TEST_ADDRESS, 'bobsmith']:
+            resp = await self.fetch("/user/{}".format(key))
+            self.assertResponseCodeEqual(resp, 200)
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_registered_users_filter(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'JaneDoe', TEST_ADDRESS_2)
+
+        registered_users = self._app.registered_users = RegisteredUsersFilter()
+        # stop the background refresh from starting
+        registered_users._running = True
+        await registered_users.rebuild()
+
+        for key in [TEST_ADDRESS_2, 'janedoe']:
+            resp = await self.fetch("/user/{}".format(key))
+            self.assertResponseCodeEqual(resp, 200)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 404)
+        self.assertEqual(registered_users.hits, 1)
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="POST", body={
+            "username": "BobSmith"
+        })
+        self.assertResponseCodeEqual(resp, 200)
+
+        for key in [TEST_ADDRESS, 'bobsmith']:
+            resp = await self.fetch("/user/{}".format(key))
+            self.assertResponseCodeEqual(resp, 200)
+
+        # renames are added to the filter too
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "username": "Bobby"
+        })
+        self.assertResponseCodeEqual(resp, 200)
+        resp = await self.fetch("/user/bobby")
+        self.assertResponseCodeEqual(resp, 200)
+
+        # a stale filter isn't used
+        registered_users.invalidate()
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'JohnDoe', '0x0000000000000000000000000000000000000001')
+        resp = await self.fetch("/user/johndoe")
+        self.assertResponseCodeEqual(resp, 200)
@@ -10,7 +10,7 @@ from toshi.ethereum.utils import data_encoder, private_key_to_address
 
 from urllib.parse import quote_plus, quote as quote_arg
 
-from toshiid.test.test_user import TEST_PRIVATE_KEY, TEST_ADDRESS, TEST_PAYMENT_ADDRESS
+from toshiid.test.test_user import TEST_PRIVATE_KEY, TEST_ADDRESS, TEST_ADDRESS_2, TEST_PAYMENT_ADDRESS
 
 class SearchUserHandlerTest(AsyncHandlerTest):
 
@@ -236,6 +236,26 @@ class SearchUserHandlerTest(AsyncHandlerTest):
         self.assertEqual(results[0]['name'], "Bob Smith")
         self.assertTrue(results[1]['username'].startswith("bob"))
 
+    @gen_test
+    @requires_database
+    async def test_search_vector_only_rebuilt_on_name_change(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (toshi_id, username, name) VALUES ($1, $2, $3)",
+                              TEST_ADDRESS, "bobsmith", "Bob Smith")
+            # plant a stale search vector so we can tell if it gets rebuilt
+            await con.execute("UPDATE users SET tsv = to_tsvector('simple', 'stale') WHERE toshi_id = $1", TEST_ADDRESS)
+
+            await con.execute("UPDATE users SET reputation_score = 4.5, review_count = 2, average_rating = 4.5 WHERE toshi_id = $1",
+                              TEST_ADDRESS)
+            tsv = await con.fetchval("SELECT tsv::TEXT FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+            self.assertEqual(tsv, "'stale'")
+
+            await con.execute("UPDATE users SET name = 'Robert Smith' WHERE toshi_id = $1", TEST_ADDRESS)
+            tsv = await con.fetchval("SELECT tsv::TEXT FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+            self.assertIn("robert", tsv)
+            self.assertNotIn("stale", tsv)
+
     @gen_test
     @requires_database
     async def test_payment_address_search(self):
@@ -498,3 +518,94 @@ class SearchUserHandlerTest(AsyncHandlerTest):
         inject = "0')) AS a (id) ON u.toshi_id = a.id; DELETE FROM users; SELECT u.* FROM users u JOIN ( VALUES ('0x0000000000000000000000000000000000000000"
         resp = await self.fetch("/search/user?toshi_id={}".format(quote_arg(inject)))
         self.assertEqual(resp.code, 400)
+
+    @gen_test
+    @requires_database
+    async def test_sparse_fieldsets(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name, is_app, is_public) VALUES ($1, $2, $3, $4, $5)",
+                              'BobSmith', TEST_ADDRESS, 'Bob', False, True)
+
+        resp = await self.fetch("/search/user?toshi_id={}&fields=username,name,avatar".format(TEST_ADDRESS))
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['results']), 1)
+        self.assertEqual(set(body['results'][0].keys()), {'username', 'name', 'avatar'})
+        self.assertEqual(body['results'][0]['name'], 'Bob')
+        self.assertTrue(body['results'][0]['avatar'].endswith('/identicon/{}.png'.format(TEST_ADDRESS)))
+
+        resp = await self.fetch("/search/user?query=bob&fields=username&fields=categories")
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['results']), 1)
+        # categories are only included for apps
+        self.assertEqual(body['results'][0], {'username': 'BobSmith'})
+        self.assertIn('fields=username,categories', body['query'])
+
+        resp = await self.fetch("/search/user?public=true&fields=toshi_id")
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(body['results'], [{'toshi_id': TEST_ADDRESS}])
+
+        resp = await self.fetch("/search/user?query=bob&fields=username,password")
+        self.assertEqual(resp.code, 400)
+
+    @gen_test
+    @requires_database
+    async def test_batch_lookup(self):
+
+        async with self.pool.acquire() as con:
+            # payment addresses are often stored checksummed
+            await con.execute("INSERT INTO users (username, toshi_id, payment_address) VALUES ($1, $2, $3)",
+                              'BobSmith', TEST_ADDRESS, TEST_PAYMENT_ADDRESS.upper().replace('0X', '0x'))
+            await con.execute("INSERT INTO users (username, toshi_id, is_app) VALUES ($1, $2, true)",
+                              'TestBot', TEST_ADDRESS_2)
+
+        ids = ['testbot', 'bobsmith', TEST_PAYMENT_ADDRESS, 'nobody', TEST_ADDRESS_2,
+               '0x0000000000000000000000000000000000000000']
+        resp = await self.fetch("/search/user?fields=toshi_id,username", method="POST", body=json_encode(ids),
+                                headers={'Content-Type': 'application/json'})
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(body['results'], [
+            {'toshi_id': TEST_ADDRESS_2, 'username': 'TestBot'},
+            {'toshi_id': TEST_ADDRESS, 'username': 'BobSmith'}
+        ])
+
+        resp = await self.fetch("/search/user", method="POST", body=json_encode({'ids': [TEST_PAYMENT_ADDRESS]}),
+                                headers={'Content-Type': 'application/json'})
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['results']), 1)
+        self.assertEqual(body['results'][0]['toshi_id'], TEST_ADDRESS)
+
+        resp = await self.fetch("/apps", method="POST", body=json_encode(['bobsmith', 'testbot']),
+                                headers={'Content-Type': 'application/json'})
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual([r['toshi_id'] for r in body['results']], [TEST_ADDRESS_2])
+
+        # only featured apps are returned by the featured apps endpoint
+        resp = await self.fetch("/apps/featured", method="POST", body=json_encode(['testbot']),
+                                headers={'Content-Type': 'application/json'})
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(json_decode(resp.body)['results'], [])
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE users SET featured = true WHERE toshi_id = $1", TEST_ADDRESS_2)
+        resp = await self.fetch("/apps/featured", method="POST", body=json_encode(['testbot']),
+                                headers={'Content-Type': 'application/json'})
+        self.assertEqual(resp.code, 200)
+        self.assertEqual([r['toshi_id'] for r in json_decode(resp.body)['results']], [TEST_ADDRESS_2])
+
+        for bad in [{'ids': 'bobsmith'}, ['bob smith'], [1], ["0')); DELETE FROM users; --"],
+                    ['user{}'.format(i) for i in range(1001)]]:
+            resp = await self.fetch("/search/user", method="POST", body=json_encode(bad),
+                                    headers={'Content-Type': 'application/json'})
+            self.assertEqual(resp.code, 400)
+
+        # duplicates don't count towards the limit
+        resp = await self.fetch("/search/user", method="POST", body=json_encode(['bobsmith'] * 1001),
+                                headers={'Content-Type': 'application/json'})
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(len(json_decode(resp.body)['results']), 1)
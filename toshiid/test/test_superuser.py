@@ -1,3 +1,4 @@
+from tornado.escape import json_decode
 from tornado.testing import gen_test
 
 from toshiid.app import urls
@@ -217,3 +218,91 @@ class SuperuserUpdateTest(AsyncHandlerTest):
         self.assertIsNotNone(row)
         self.assertEqual(row['name'], name)
         self.assertEqual(row['username'], username)
+
+    @gen_test
+    @requires_database
+    async def test_bulk_moderation(self):
+
+        other_address = "0x0000000000000000000000000000000000000001"
+        missing_address = "0x0000000000000000000000000000000000000002"
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, is_app) VALUES ($1, $2, true)", 'ToshiBot', TEST_ADDRESS_2)
+            await con.execute("INSERT INTO users (username, toshi_id, is_app, featured) VALUES ($1, $2, true, true)", 'OtherBot', other_address)
+
+        body = {"users": [
+            {"toshi_id": TEST_ADDRESS_2, "featured": True, "public": True},
+            {"toshi_id": other_address, "featured": "maybe", "blocked": True},
+            {"toshi_id": missing_address, "blocked": True},
+            {"toshi_id": "bob", "blocked": True}
+        ]}
+
+        resp = await self.fetch_signed("/moderation", signing_key=TEST_PRIVATE_KEY, method="POST", body=body)
+        self.assertResponseCodeEqual(resp, 401)
+
+        config['superusers'] = {TEST_ADDRESS: 1}
+
+        resp = await self.fetch_signed("/moderation", signing_key=TEST_PRIVATE_KEY, method="POST", body=body)
+        self.assertResponseCodeEqual(resp, 200)
+        results = json_decode(resp.body)['results']
+        self.assertEqual([(r['toshi_id'], r['status']) for r in results], [
+            (TEST_ADDRESS_2, 'updated'),
+            (other_address, 'error'),
+            (missing_address, 'not_found'),
+            ('bob', 'error')
+        ])
+        self.assertEqual(results[0], {'toshi_id': TEST_ADDRESS_2, 'status': 'updated',
+                                      'featured': True, 'blocked': False, 'public': True})
+
+        async with self.pool.acquire() as con:
+            bot = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS_2)
+            other = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", other_address)
+        self.assertTrue(bot['featured'])
+        self.assertTrue(bot['is_public'])
+        self.assertIsNotNone(bot['went_public'])
+        # invalid patches aren't applied
+        self.assertFalse(other['blocked'])
+
+        resp = await self.fetch_signed("/moderation", signing_key=TEST_PRIVATE_KEY, method="POST", body={"users": [
+            {"toshi_id": TEST_ADDRESS_2, "public": False},
+            {"toshi_id": other_address, "featured": False, "blocked": True}
+        ]})
+        self.assertResponseCodeEqual(resp, 200)
+
+        async with self.pool.acquire() as con:
+            bot = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS_2)
+            other = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", other_address)
+        self.assertTrue(bot['featured'])
+        self.assertFalse(bot['is_public'])
+        self.assertIsNone(bot['went_public'])
+        self.assertFalse(other['featured'])
+        self.assertTrue(other['blocked'])
+
+        # there's a result for every patch, and users with any invalid patch
+        # aren't changed regardless of the order of their patches
+        for invalid_first in [True, False]:
+            patches = [{"toshi_id": other_address, "blocked": False}, {"toshi_id": other_address, "featured": "maybe"}]
+            if invalid_first:
+                patches.reverse()
+            resp = await self.fetch_signed("/moderation", signing_key=TEST_PRIVATE_KEY, method="POST", body={"users": [
+                "bob",
+                {"blocked": True},
+                {"toshi_id": TEST_ADDRESS_2, "featured": False},
+                {"toshi_id": TEST_ADDRESS_2, "blocked": True}
+            ] + patches})
+            self.assertResponseCodeEqual(resp, 200)
+            results = json_decode(resp.body)['results']
+            self.assertEqual([(r['toshi_id'], r['status']) for r in results], [
+                (None, 'error'),
+                (None, 'error'),
+                (TEST_ADDRESS_2, 'updated'),
+                (TEST_ADDRESS_2, 'updated'),
+                (other_address, 'error'),
+                (other_address, 'error')
+            ])
+            self.assertEqual(results[3], {'toshi_id': TEST_ADDRESS_2, 'status': 'updated',
+                                          'featured': False, 'blocked': True, 'public': False})
+
+            async with self.pool.acquire() as con:
+                other = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", other_address)
+            self.assertTrue(other['blocked'])
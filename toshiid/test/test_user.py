@@ -1,12 +1,14 @@
+import asyncio
+import os
 import time
-import regex
-import urllib.parse
 
 from tornado.escape import json_decode
 from tornado.testing import gen_test
+from tornado.platform.asyncio import to_asyncio_future
 
 from toshiid.app import urls
-from toshiid.handlers import generate_username
+from toshiid.handlers import autoid_username, MIN_AUTOID_LENGTH
+from toshiid.cache import RegisteredUsersFilter
 from toshi.analytics import encode_id
 from toshi.test.moto_server import requires_moto, BotoTestMixin
 from toshi.test.database import requires_database
@@ -32,11 +34,117 @@ class UserHandlerTest(BotoTestMixin, AsyncHandlerTest):
             path = "/v1{}".format(path)
         return super().get_url(path)
 
+    def test_autoid_username(self):
+        block = 10 ** MIN_AUTOID_LENGTH
+        usernames = set(autoid_username(i) for i in range(block))
+        # every value in the first block maps to a distinct username of the minimum length
+        self.assertEqual(len(usernames), block)
+        self.assertTrue(all(len(username) == 4 + MIN_AUTOID_LENGTH for username in usernames))
+        self.assertEqual(len(autoid_username(block)), 5 + MIN_AUTOID_LENGTH)
+
+    @gen_test
+    @requires_database
+    async def test_autoid_sequence_skips_generated_usernames(self):
+
+        async with self.pool.acquire() as con:
+            # usernames generated randomly before the sequence existed
+            await con.execute("INSERT INTO users (toshi_id, username) VALUES ($1, $2), ($3, $4)",
+                              TEST_ADDRESS, 'user12345', TEST_ADDRESS_2, 'User123456')
+            with open(os.path.join(os.path.dirname(__file__), '..', '..', 'sql', 'migrate_00000031.sql')) as f:
+                await con.execute(f.read())
+            seq = await con.fetchval("SELECT nextval('users_autoid_seq')")
+
+        # allocation starts with the first length without any generated usernames
+        self.assertEqual(seq, 10 ** MIN_AUTOID_LENGTH + 10 ** (MIN_AUTOID_LENGTH + 1))
+        self.assertEqual(len(autoid_username(seq)), 4 + MIN_AUTOID_LENGTH + 2)
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_create_user_autoid_collision(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("SELECT setval('users_autoid_seq', 1, false)")
+            # someone registered the next autogenerated username themselves
+            await con.execute("INSERT INTO users (toshi_id, username) VALUES ($1, $2)",
+                              TEST_ADDRESS_2, autoid_username(1).upper())
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="POST", body={})
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(body['username'], autoid_username(2))
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="POST", body={'name': 'Bob'})
+        self.assertResponseCodeEqual(resp, 400)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'already_registered')
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_create_user_replay(self):
+
+        body = {'username': 'BobSmith', 'name': 'Bob'}
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="POST", body=body)
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertNotIn('Idempotent-Replayed', resp.headers)
+        original = resp.body
+
+        # retrying the same registration returns the original response
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="POST", body=body)
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(resp.body, original)
+
+        # a different registration for the same address is still rejected
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="POST",
+                                       body={'username': 'BobSmith', 'name': 'Robert'})
+        self.assertResponseCodeEqual(resp, 400)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'already_registered')
+
     @gen_test
-    async def test_generate_username_length(self):
-        for n in [0, 5]:
-            id = generate_username(n).split('user')[1]
-            self.assertEqual(len(id), n)
+    @requires_database
+    @requires_moto
+    async def test_create_user_concurrent_retry(self):
+
+        # a retry sent while the original request is still running
+        body = {'username': 'BobSmith', 'name': 'Bob'}
+        responses = await asyncio.gather(*[
+            to_asyncio_future(self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="POST", body=body,
+                                                headers={'Idempotency-Key': 'abc123'}))
+            for i in range(2)])
+        for resp in responses:
+            self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(responses[0].body, responses[1].body)
+        self.assertEqual(sorted(resp.headers.get('Idempotent-Replayed', 'false') for resp in responses), ['false', 'true'])
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_create_user_idempotency_key(self):
+
+        body = {'name': 'Bob'}
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="POST", body=body,
+                                       headers={'Idempotency-Key': 'abc123'})
+        self.assertResponseCodeEqual(resp, 200)
+        original = resp.body
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="POST", body=body,
+                                       headers={'Idempotency-Key': 'abc123'})
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(resp.body, original)
+
+        # reusing the key for a different registration is an error
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="POST", body={'name': 'Robert'},
+                                       headers={'Idempotency-Key': 'abc123'})
+        self.assertResponseCodeEqual(resp, 400)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'idempotency_key_reused')
+
+        # a new key is a new registration
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="POST", body=body,
+                                       headers={'Idempotency-Key': 'def456'})
+        self.assertResponseCodeEqual(resp, 400)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'already_registered')
 
     @gen_test
     @requires_database
@@ -63,18 +171,14 @@ class UserHandlerTest(BotoTestMixin, AsyncHandlerTest):
 
         self.assertIsNotNone(row['username'])
 
-        self.assertIsNotNone(row['avatar'])
-        self.assertIsNotNone(
-            regex.match("\/[^\/]+\/public\/identicon\/{}\.png".format(TEST_PAYMENT_ADDRESS),
-                        urllib.parse.urlparse(row['avatar']).path), row['avatar'])
-
+        # the identicon is rendered on request rather than uploaded
+        self.assertEqual(row['avatar'], "/identicon/{}.png".format(TEST_PAYMENT_ADDRESS))
         async with self.boto:
             objs = await self.boto.list_objects()
-        self.assertIn('Contents', objs)
-        self.assertEqual(len(objs['Contents']), 1)
+        self.assertNotIn('Contents', objs)
 
-        resp = await self.fetch(row['avatar'], method="GET")
-        self.assertEqual(resp.code, 200, "Got unexpected {} for url: {}".format(resp.code, row['avatar']))
+        resp = await self.fetch(body['avatar'], method="GET")
+        self.assertEqual(resp.code, 200, "Got unexpected {} for url: {}".format(resp.code, body['avatar']))
 
         # ensure we got a tracking event
         self.assertEqual((await self.next_tracking_event())[0], encode_id(TEST_ADDRESS))
@@ -334,6 +438,111 @@ class UserHandlerTest(BotoTestMixin, AsyncHandlerTest):
 
         self.assertEqual(body['name'], 'Bob')
 
+    @gen_test
+    @requires_database
+    async def test_get_user_etag(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name, is_app) VALUES ($1, $2, $3, true)",
+                              'BobSmith', TEST_ADDRESS, 'Bob')
+
+        resp = await self.fetch("/user/bobsmith", method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertIn('Etag', resp.headers)
+        etag = resp.headers['Etag']
+
+        for path in ["/user/bobsmith", "/user/{}".format(TEST_ADDRESS), "/apps/{}".format(TEST_ADDRESS)]:
+            resp = await self.fetch(path, method="GET", headers={'If-None-Match': etag})
+            self.assertResponseCodeEqual(resp, 304)
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Robert"
+        })
+        self.assertResponseCodeEqual(resp, 200)
+
+        resp = await self.fetch("/user/bobsmith", method="GET", headers={'If-None-Match': etag})
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertNotEqual(resp.headers['Etag'], etag)
+        self.assertEqual(json_decode(resp.body)['name'], 'Robert')
+        etag = resp.headers['Etag']
+
+        # changes made directly in the database also change the etag
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE users SET about = $1 WHERE toshi_id = $2", 'about bob', TEST_ADDRESS)
+            updated = await con.fetchval("SELECT updated FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+            created = await con.fetchval("SELECT created FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+        self.assertGreater(updated, created)
+
+        resp = await self.fetch("/user/bobsmith", method="GET", headers={'If-None-Match': etag})
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertNotEqual(resp.headers['Etag'], etag)
+
+    @gen_test
+    @requires_database
+    async def test_get_user_fields(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name, is_app) VALUES ($1, $2, $3, true)",
+                              'BobSmith', TEST_ADDRESS, 'Bob')
+            await con.execute("INSERT INTO categories (category_id, tag) VALUES (1, 'games')")
+            await con.execute("INSERT INTO category_names (category_id, name) VALUES (1, 'Games')")
+            await con.execute("INSERT INTO app_categories VALUES (1, $1)", TEST_ADDRESS)
+
+        resp = await self.fetch("/user/bobsmith?fields=username,name", method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body), {'username': 'BobSmith', 'name': 'Bob'})
+        etag = resp.headers['Etag']
+
+        resp = await self.fetch("/user/bobsmith?fields=name,username", method="GET", headers={'If-None-Match': etag})
+        self.assertResponseCodeEqual(resp, 304)
+
+        # the full profile is a different representation
+        resp = await self.fetch("/user/bobsmith", method="GET", headers={'If-None-Match': etag})
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertNotEqual(resp.headers['Etag'], etag)
+        self.assertEqual(json_decode(resp.body)['categories'], [{'id': 1, 'tag': 'games', 'name': 'Games'}])
+
+        resp = await self.fetch("/apps/{}?fields=featured,categories".format(TEST_ADDRESS), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body), {'featured': False, 'categories': [{'id': 1, 'tag': 'games', 'name': 'Games'}]})
+
+        resp = await self.fetch("/user/bobsmith?fields=secret", method="GET")
+        self.assertResponseCodeEqual(resp, 400)
+
+    @gen_test
+    @requires_database
+    async def test_username_availability(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        for username, available in [('bobsmith', False), ('BOBSMITH', False), ('BobSmit', True)]:
+            resp = await self.fetch("/username/{}/available".format(username), method="GET")
+            self.assertResponseCodeEqual(resp, 200)
+            self.assertEqual(json_decode(resp.body), {'username': username, 'available': available})
+
+        resp = await self.fetch("/username/b/available", method="GET")
+        self.assertResponseCodeEqual(resp, 400)
+
+        # with the registered users filter the database is only queried for possible matches
+        registered_users = self._app.registered_users = RegisteredUsersFilter()
+        registered_users._running = True
+        await registered_users.rebuild()
+
+        resp = await self.fetch("/username/janedoe/available", method="GET")
+        self.assertTrue(json_decode(resp.body)['available'])
+        self.assertEqual(registered_users.hits, 1)
+
+        resp = await self.fetch("/username/bobsmith/available", method="GET")
+        self.assertFalse(json_decode(resp.body)['available'])
+
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE users SET username = $1 WHERE toshi_id = $2", 'Bobby', TEST_ADDRESS)
+
+        # the old username is still in the filter but is confirmed by the database
+        resp = await self.fetch("/username/bobsmith/available", method="GET")
+        self.assertTrue(json_decode(resp.body)['available'])
+
     @gen_test
     @requires_database
     async def test_get_invalid_user(self):
@@ -383,6 +592,116 @@ class UserHandlerTest(BotoTestMixin, AsyncHandlerTest):
             self.assertIsNotNone(row)
             self.assertEqual(row['name'], body['name'])
 
+    @gen_test
+    @requires_database
+    async def test_update_user_is_atomic(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, active) VALUES ($1, $2, false)", 'BobSmith', TEST_ADDRESS)
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'JaneDoe', TEST_ADDRESS_2)
+            version = await con.fetchval("SELECT version FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+
+        # an invalid value anywhere in the payload means nothing is changed
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Bob", "about": "about bob", "location": 1
+        })
+        self.assertResponseCodeEqual(resp, 400)
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Bob", "username": "janedoe"
+        })
+        self.assertResponseCodeEqual(resp, 400)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'username_taken')
+
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+        self.assertIsNone(row['name'])
+        self.assertEqual(row['version'], version)
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Bob", "about": "about bob", "location": "Oslo", "public": True, "username": "Bobby"
+        })
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(body['username'], 'Bobby')
+        self.assertEqual(body['location'], 'Oslo')
+
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+        self.assertEqual(row['name'], 'Bob')
+        self.assertTrue(row['is_public'])
+        self.assertIsNotNone(row['went_public'])
+        self.assertTrue(row['active'])
+        # all the changes were made with a single update
+        self.assertEqual(row['version'], version + 1)
+
+    @gen_test
+    @requires_database
+    async def test_update_user_if_match(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name) VALUES ($1, $2, $3)", 'BobSmith', TEST_ADDRESS, 'Bob')
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS), method="GET")
+        etag = resp.headers['Etag']
+
+        # If-Match uses the strong comparison
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Robert"
+        }, headers={'If-Match': 'W/{}'.format(etag)})
+        self.assertResponseCodeEqual(resp, 412)
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Robert"
+        }, headers={'If-Match': etag})
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['name'], 'Robert')
+        new_etag = resp.headers['Etag']
+        self.assertNotEqual(new_etag, etag)
+
+        # a second update based on the old version conflicts
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Bobby"
+        }, headers={'If-Match': etag})
+        self.assertResponseCodeEqual(resp, 412)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'version_conflict')
+
+        resp = await self.fetch_signed("/user/bobsmith", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Bobby"
+        }, headers={'If-Match': '"{}-1"'.format(TEST_ADDRESS_2)})
+        self.assertResponseCodeEqual(resp, 412)
+
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+        self.assertEqual(row['name'], 'Robert')
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Bobby", "public": True, "expected_version": row['version']
+        })
+        self.assertResponseCodeEqual(resp, 200)
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Bob", "expected_version": row['version']
+        })
+        self.assertResponseCodeEqual(resp, 412)
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Bob", "expected_version": "latest"
+        })
+        self.assertResponseCodeEqual(resp, 400)
+
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+        self.assertEqual(row['name'], 'Bobby')
+        self.assertTrue(row['is_public'])
+        self.assertIsNotNone(row['went_public'])
+
+        # unconditional updates still work
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "name": "Bob"
+        }, headers={'If-Match': '*'})
+        self.assertResponseCodeEqual(resp, 200)
+
     @gen_test
     @requires_database
     async def test_update_user_duplicate_username(self):
@@ -603,12 +922,6 @@ class AppHandlerTestWithForcedPublic(AsyncHandlerTest):
         path = "/v1{}".format(path)
         return super().get_url(path)
 
-    @gen_test
-    async def test_generate_username_length(self):
-        for n in [0, 5]:
-            id = generate_username(n).split('user')[1]
-            self.assertEqual(len(id), n)
-
     @gen_test
     @requires_database
     @requires_moto
@@ -657,3 +970,20 @@ class AppHandlerTestWithForcedPublic(AsyncHandlerTest):
         self.assertIsNotNone(row)
         self.assertTrue(row['is_app'])
         self.assertTrue(row['is_public'])
+
+        # a conditional update that doesn't change is_app doesn't publish an
+        # app that has been made private
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow("UPDATE users SET is_public = FALSE WHERE toshi_id = $1 RETURNING version",
+                                     TEST_ADDRESS)
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body={'is_app': True, 'name': 'Bot', 'expected_version': row['version']})
+        self.assertResponseCodeEqual(resp, 200)
+
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+
+        self.assertTrue(row['is_app'])
+        self.assertFalse(row['is_public'])
+        self.assertEqual(row['name'], 'Bot')
@@ -0,0 +1,97 @@
+import json
+import unittest
+
+from collections import OrderedDict
+from decimal import Decimal
+
+from toshiid.cache import UserRecord
+from toshiid.handlers import user_row_for_json, parse_user_fields, user_columns, UserJSONSerializer
+
+from toshiid.test.test_user import TEST_ADDRESS, TEST_ADDRESS_2, TEST_PAYMENT_ADDRESS
+
+class MockRequest:
+    protocol = 'https'
+    host = 'identity.service.toshi.org'
+
+class UserJSONSerializerTest(unittest.TestCase):
+
+    def assertSerializesLikeUserRowForJson(self, row):
+        request = MockRequest()
+        expected = user_row_for_json(request, row)
+        serialized = UserJSONSerializer(request).serialize(row)
+        self.assertEqual(json.loads(serialized), expected)
+        # keys should come out in the same order
+        self.assertEqual(list(json.loads(serialized, object_pairs_hook=OrderedDict).keys()), list(expected.keys()))
+
+    def test_user(self):
+        self.assertSerializesLikeUserRowForJson({
+            'toshi_id': TEST_ADDRESS, 'username': 'BobSmith', 'payment_address': TEST_PAYMENT_ADDRESS,
+            'avatar': None, 'name': 'Bob "Bobby" Smith', 'about': None, 'location': 'Zürich',
+            'is_app': False, 'is_public': True, 'reputation_score': Decimal('4.40'),
+            'average_rating': Decimal('3.5'), 'review_count': 10, 'featured': False,
+            'category_ids': [], 'category_tags': [], 'category_names': []
+        })
+
+    def test_user_without_values(self):
+        self.assertSerializesLikeUserRowForJson(UserRecord({
+            'toshi_id': TEST_ADDRESS, 'username': 'BobSmith', 'avatar': 'https://example.com/bob.png'
+        }))
+
+    def test_app_with_categories(self):
+        self.assertSerializesLikeUserRowForJson({
+            'toshi_id': TEST_ADDRESS_2, 'username': 'TestBot', 'payment_address': TEST_ADDRESS_2,
+            'avatar': '/avatar/{}.png'.format(TEST_ADDRESS_2), 'name': 'Test Bot', 'about': 'A bot </script>',
+            'location': None, 'is_app': True, 'is_public': True, 'reputation_score': None,
+            'average_rating': None, 'review_count': 0, 'featured': None,
+            'category_ids': [1, 2, 3], 'category_tags': ['games', 'social', 'gone'],
+            'category_names': ['Games', 'Social', None]
+        })
+
+    def test_app_without_categories(self):
+        self.assertSerializesLikeUserRowForJson(UserRecord({
+            'toshi_id': TEST_ADDRESS_2, 'username': 'TestBot', 'is_app': True, 'featured': True
+        }))
+
+    def test_serialize_many(self):
+        request = MockRequest()
+        rows = [UserRecord({'toshi_id': TEST_ADDRESS, 'username': 'BobSmith'}),
+                UserRecord({'toshi_id': TEST_ADDRESS_2, 'username': 'TestBot', 'is_app': True})]
+        self.assertEqual(json.loads(UserJSONSerializer(request).serialize_many(rows)),
+                         [user_row_for_json(request, row) for row in rows])
+        self.assertEqual(UserJSONSerializer(request).serialize_many([]), '[]')
+
+    def test_fields(self):
+        request = MockRequest()
+        app = {'toshi_id': TEST_ADDRESS_2, 'username': 'TestBot', 'avatar': None, 'is_app': True, 'featured': True,
+               'category_ids': [1], 'category_tags': ['games'], 'category_names': ['Games']}
+        user = {'toshi_id': TEST_ADDRESS, 'username': 'BobSmith', 'avatar': None, 'is_app': False}
+        fields = parse_user_fields(['categories,avatar', 'username'])
+        self.assertEqual(fields, ('username', 'avatar', 'categories'))
+
+        serializer = UserJSONSerializer(request, fields)
+        self.assertEqual(json.loads(serializer.serialize(app)), {
+            'username': 'TestBot',
+            'avatar': 'https://identity.service.toshi.org/identicon/{}.png'.format(TEST_ADDRESS_2),
+            'categories': [{'id': 1, 'tag': 'games', 'name': 'Games'}]
+        })
+        self.assertEqual(json.loads(serializer.serialize(user)), {
+            'username': 'BobSmith',
+            'avatar': 'https://identity.service.toshi.org/identicon/{}.png'.format(TEST_ADDRESS)
+        })
+        # rows only need the columns for the requested fields
+        self.assertEqual(json.loads(UserJSONSerializer(request, ('name',)).serialize({'name': 'Bob'})), {'name': 'Bob'})
+
+        full = dict(user, payment_address=None, name='Bob', about=None, location=None, is_public=False,
+                    reputation_score=None, average_rating=None, review_count=0)
+        self.assertEqual(user_row_for_json(request, full, fields), json.loads(UserJSONSerializer(request, fields).serialize(full)))
+
+    def test_parse_fields(self):
+        self.assertIsNone(parse_user_fields([]))
+        self.assertIsNone(parse_user_fields(['', ' , ']))
+        self.assertEqual(parse_user_fields([' name , toshi_id']), ('toshi_id', 'name'))
+        self.assertRaises(ValueError, parse_user_fields, ['name,password'])
+
+    def test_user_columns(self):
+        self.assertEqual(user_columns(None), "users.*")
+        self.assertEqual(user_columns(('username', 'avatar')), "users.avatar, users.toshi_id, users.username")
+        self.assertEqual(user_columns(('public',), 'version'), "users.is_public, users.version")